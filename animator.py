@@ -0,0 +1,158 @@
+"""
+AutoLight Animator
+Main light effects, turns the lighting state and sensor trips into led array targets
+"""
+
+from subsystems.leds import (
+    PCA9685LedArray,
+    NullAnimation,
+    PowerUnits,
+    FadeAnimation,
+    FadeOutAnimation,
+)
+from data_types import LightingData, Animations
+from mapping import compile_mapping
+from settings import Settings
+from utils import SYSTEM_CLOCK, SystemClock, TimerHeap, VirtualClock, square_wave
+
+
+class Animator:
+    """Effects of the main light, one frame per animate_frame call"""
+
+    def __init__(
+        self,
+        settings: Settings,
+        led_array: PCA9685LedArray,
+        clock: SystemClock | VirtualClock = SYSTEM_CLOCK,
+    ) -> None:
+        self.settings = settings
+        self.led_array = led_array
+        self.clock = clock
+        self._compile_mapping()
+
+        # Walking leds kept on after their sensors clear, at their last level
+        self.timers = TimerHeap()
+        self._held: dict[int, float] = {}
+        self._fading: set[int] = set()
+        self._previous = [0.0] * self.settings.led_count
+
+    def _compile_mapping(self):
+        import numpy as np
+
+        self._mapping = compile_mapping(self.settings)
+        self._mapping_radius = self.settings.walking_activation_radius
+        # Reused by every walking frame
+        self._trips = np.zeros(self.settings.sensor_count, dtype=np.float32)
+        self._levels = np.zeros(self.settings.led_count, dtype=np.float32)
+
+    def next_deadline(self) -> float | None:
+        """When the next hold or fade out ends, walking frames need no other wake-ups"""
+        return self.timers.next_deadline()
+
+    def _release(self, index: int):
+        self._held.pop(index, None)
+        self._fading.discard(index)
+        self.timers.cancel(index)
+
+    def _release_all(self):
+        self.timers.clear()
+        self._held.clear()
+        self._fading.clear()
+        self._previous = [0.0] * self.settings.led_count
+
+    def _hold_expired(self, index: int, deadline: float):
+        fade_out = self.settings.walking_fade_outs[index]
+        if fade_out > 0:
+            self._fading.add(index)
+            self.led_array.set_animation(index, FadeOutAnimation(deadline, fade_out))
+            self.timers.schedule(index, deadline + fade_out, lambda _: self._release(index))
+        else:
+            self._release(index)
+
+    def _hold(self, index: int, level: float, now: float) -> float:
+        """Keep led index at level after its sensors clear, the level it is left at"""
+        hold = self.settings.walking_holds[index]
+        if hold <= 0 and self.settings.walking_fade_outs[index] <= 0:
+            return 0.0
+        self._held[index] = level
+        self.timers.schedule(
+            index, now + hold, lambda deadline: self._hold_expired(index, deadline)
+        )
+        return level
+
+    def animate_frame(
+        self, lighting_data: LightingData, sensor_trips: tuple[bool, ...] | list[bool]
+    ):
+        """Set every main led for one frame of the current effect"""
+        if self._held and (
+            lighting_data.power is False or lighting_data.effect != Animations.WALKING
+        ):
+            self._release_all()
+        if lighting_data.power is False:
+            for index in range(self.settings.led_count):
+                self.led_array.set_power_state(index, False)
+            return
+        if lighting_data.effect == Animations.WALKING:
+            if (
+                not self.settings.sensor_mapping
+                and self.settings.walking_activation_radius != self._mapping_radius
+            ):
+                self._compile_mapping()  # Radius changed by a config reload
+
+            now = self.clock.time()
+            self.timers.run_expired(now)
+
+            # Weighted sum of the trips per led, capped at full brightness
+            self._trips[:] = sensor_trips
+            levels = self._mapping.dot(self._trips, out=self._levels)
+            levels.clip(0.0, 1.0, out=levels)
+            previous = self._previous
+            for index, level in enumerate(levels.tolist()):
+                tripped_level = level
+                if level > 0:
+                    if index in self._held:
+                        self._release(index)
+                elif index in self._held:
+                    level = self._held[index]
+                elif previous[index] > 0:
+                    level = self._hold(index, previous[index], now)
+                previous[index] = tripped_level
+
+                self.led_array.set_power_state(index, level > 0)
+                self.led_array.set_brightness(
+                    index, lighting_data.brightness * level, PowerUnits.BITS8
+                )
+                if index not in self._fading:
+                    self.led_array.set_animation(index, NullAnimation())
+        elif lighting_data.effect == Animations.STEADY:
+            for i in range(self.settings.led_count):
+                self.led_array.set_power_state(i, True)
+                self.led_array.set_brightness(
+                    i, lighting_data.brightness, PowerUnits.BITS8
+                )
+                self.led_array.set_animation(i, NullAnimation())
+        elif lighting_data.effect == Animations.BLINK:
+            if square_wave(self.clock.time(), self.settings.blink_animation_hz, 1) == 1:
+                for index in range(self.settings.led_count):
+                    self.led_array.set_power_state(index, True)
+                    self.led_array.set_brightness(
+                        index, lighting_data.brightness, PowerUnits.BITS8
+                    )
+                    self.led_array.set_animation(index, NullAnimation())
+            else:
+                for index in range(self.settings.led_count):
+                    self.led_array.set_power_state(index, False)
+                    self.led_array.set_brightness(
+                        index, lighting_data.brightness, PowerUnits.BITS8
+                    )
+                    self.led_array.set_animation(index, NullAnimation())
+        elif lighting_data.effect == Animations.FADE:
+            for index in range(self.settings.led_count):
+                self.led_array.set_power_state(index, True)
+                self.led_array.set_brightness(
+                    index, lighting_data.brightness, PowerUnits.BITS8
+                )
+                self.led_array.set_animation(
+                    index,
+                    FadeAnimation(self.settings.fade_animation_multiplier),
+                )
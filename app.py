@@ -0,0 +1,936 @@
+"""
+Auto-Light runtime
+Hardware, Home Assistant and animation threads for the normal run mode
+"""
+
+import copy
+import signal
+import sys
+import threading
+import atexit
+import time
+import functools
+import json
+
+from ha_mqtt_discoverable import Settings as HASettings
+from ha_mqtt_discoverable.sensors import (
+    BinarySensorInfo,
+    SensorInfo,
+    DeviceInfo,
+    LightInfo,
+)
+from paho.mqtt.client import Client, MQTTMessage
+
+import psutil
+import yaml
+
+from loguru import logger
+
+from subsystems.leds import (
+    PCA9685LedArray,
+    PCA9685ExtraChannel,
+    LedSettings,
+)
+from subsystems.framebuffer import FrameBufferWriter
+from subsystems.i2c import configure_bus_frequency, enable_tracing
+from subsystems.sensors import VL53L0XSensor, GPIOSensor, NullSensor
+from subsystems.mqtt import (
+    AggregateSensorPublisher,
+    MqttConnection,
+    SensorStatePublisher,
+    apply_light_command,
+    decode_json_payload,
+    SharedBinarySensor,
+    SharedLight,
+    SharedSensor,
+)
+
+from terminal import banner, is_interactive
+from utils import SYSTEM_CLOCK, TimerHeap, VirtualClock, is_os_64bit
+from data_types import (
+    LIGHT_EFFECTS,
+    EXTRA_LIGHT_EFFECTS,
+    Animations,
+    load_lighting_state,
+    save_lighting_state,
+)
+
+import checks
+from animator import Animator
+from control import ControlServer
+from renderer import RendererProcess
+from metrics import REGISTRY, MetricsServer
+from settings import (
+    ConfigWatcher,
+    GPIOSensorTypedSettings,
+    LIVE_SETTINGS,
+    Settings,
+    VL53L0XTypedSettings,
+)
+from startup import StartupPipeline
+from state import StateSnapshot, StateStore
+from version import __version__
+
+
+class Main:
+    def __init__(self, settings: Settings, args) -> None:
+        self.settings = settings
+        self.args = args
+        # Settings pinned whatever the config file says, kept across reloads
+        self.settings_overrides: dict[str, object] = {}
+        self.sensors = None
+        self.led_array = None
+        self.renderer = None
+        self.ha_light = None
+        self.ha_ready_time = None
+
+        # Replaced by subsystems.sim drivers and a virtual clock in Main.simulated()
+        self.pca_driver = None
+        self.mqtt_client = None
+        self.clock = SYSTEM_CLOCK
+
+        # Application start time
+        self.startup_time = time.time()
+
+        # Visual setup
+        if self.settings.do_banner:
+            banner()
+
+        atexit.register(self.at_exit)
+
+        # I2C trace, before any device is created so every transaction is recorded
+        if self.settings.i2c_trace_enabled:
+            self.enable_i2c_trace()
+
+        # Bus clock, before any device is created
+        if self.settings.i2c_frequency:
+            configure_bus_frequency(
+                self.settings.led_i2c_bus,
+                self.settings.i2c_frequency,
+                self.settings.i2c_switch_at_startup,
+            )
+
+        # Session recording, before startup so the config is the first record
+        self.recorder = None
+        if getattr(args, "record", None):
+            from recorder import SessionRecorder
+
+            self.recorder = SessionRecorder(
+                args.record, settings.root_settings, settings.sensor_distance_delta
+            )
+
+        # Startup phases, independent hardware and network bring-up run concurrently
+        startup = StartupPipeline()
+        startup.add("sanity", self.init_sanity)
+        startup.add("state", self.init_state)
+        startup.add("sensors", self.init_sensors, ("sanity",))
+        startup.add("pca", self.init_pca, ("sanity",))
+        startup.add("extra_lights", self.init_extra_lights, ("pca",))
+        startup.add("ha_entities", self.init_ha_entities, ("sanity",))
+        startup.add(
+            "threads",
+            self.init_threads,
+            ("state", "sensors", "pca", "extra_lights", "ha_entities"),
+        )
+        startup.add("mqtt_connect", self.init_mqtt_connect, ("state", "ha_entities"))
+        startup.add("control", self.init_control, ("state", "ha_entities"))
+        startup.add("metrics", self.init_metrics)
+        startup.add("config_watch", self.init_config_watch, ("threads",))
+        startup.run()
+        startup.log_report()
+
+        logger.success(f"Auto-Light version {__version__} is up!")
+
+        # Real-time render thread, once everything startup allocates exists
+        if self.settings.realtime_enabled and self.led_array:
+            from realtime import RealtimeTuner
+
+            RealtimeTuner(self.settings, self.led_array).start()
+
+        # Main loop
+        while True:
+            if self.cpu_sensor and self.mqtt.is_connected():
+                self.cpu_sensor.set_state(psutil.cpu_percent())
+
+            if self.mem_sensor and self.mqtt.is_connected():
+                self.mem_sensor.set_state(psutil.virtual_memory()[2])
+
+            logger.debug(
+                f"Sensor publishes: {self.sensor_publisher.sent.value:.0f} sent, "
+                f"{self.sensor_publisher.suppressed.value:.0f} suppressed"
+            )
+            if self.aggregate_publisher:
+                logger.debug(
+                    f"Aggregate publishes: {self.aggregate_publisher.sent.value:.0f} sent, "
+                    f"{self.aggregate_publisher.suppressed.value:.0f} suppressed"
+                )
+
+            time.sleep(self.settings.debug_update_rate)
+
+    @classmethod
+    def simulated(
+        cls, settings: Settings, clock: VirtualClock | None = None
+    ) -> "Main":
+        """Main wired to simulated hardware and MQTT, without starting any threads or loops
+
+        With a VirtualClock, animations follow simulated time instead of the wall clock
+        """
+        from subsystems.sim import SimulatedMqttClient, SimulatedPCA9685, SimulatedSensor
+
+        main = cls.__new__(cls)
+        main.settings = copy.copy(settings)
+        # Never touch the files of a real installation
+        main.settings_overrides = {"state_file_path": None, "discovery_cache_path": None}
+        for name, value in main.settings_overrides.items():
+            setattr(main.settings, name, value)
+
+        main.args = None
+        main.ha_light = None
+        main.ha_ready_time = None
+        main.renderer = None
+        main.recorder = None
+        main.startup_time = time.time()
+        main.pca_driver = SimulatedPCA9685(frequency=settings.led_freq)
+        main.mqtt_client = SimulatedMqttClient()
+        main.clock = clock or SYSTEM_CLOCK
+
+        main.init_state()
+        main.sensors = [
+            SimulatedSensor(sensor.get("calibration") or 20)
+            for sensor in settings.sensor_settings
+        ]
+        main.init_pca()
+        main.led_array.enable_recovery = False
+        main.extra_timers = TimerHeap()
+        main.extra_lights = [
+            PCA9685ExtraChannel(
+                main.led_array,
+                extra.get("channel"),
+                SimulatedSensor(),
+                extra.get("hold", 0.0),
+                extra.get("fade_out", 0.0),
+                main.extra_timers,
+            )
+            for extra in settings.extra_led_settings
+        ]
+        main.init_ha_entities()
+        return main
+
+    def enable_i2c_trace(self):
+        tracer = enable_tracing(self.settings.i2c_trace_size)
+
+        def dump(signum, frame):
+            # Not in the handler itself, it may interrupt a log call holding the sink lock
+            threading.Thread(
+                target=tracer.dump,
+                args=(self.settings.i2c_trace_dump_path,),
+                name="i2c_trace_dump",
+            ).start()
+
+        signal.signal(signal.SIGUSR1, dump)
+        logger.info(
+            f"Tracing the last {tracer.size} I2C transactions, "
+            f"send SIGUSR1 to write them to {self.settings.i2c_trace_dump_path}"
+        )
+
+    def log_level(self) -> str | int:
+        """Log level chosen by main.py, for processes started from here"""
+        if self.args.trace:
+            return 0
+        if self.args.verbose:
+            return "DEBUG"
+        if is_interactive():
+            return self.settings.interactive_log_level
+        return self.settings.regular_log_level
+
+    def init_sanity(self):
+        # Quick sanity checks
+        if not checks.run_sanity(self.settings):
+            sys.exit()
+
+    def init_state(self):
+        # Last known lighting state, so the stairs light up without the network
+        lighting_data, extra_lighting_data = load_lighting_state(
+            self.settings.state_file_path, self.settings.extra_led_count
+        )
+        self.state = StateStore(
+            lighting_data, extra_lighting_data, self.settings.sensor_count, self.clock
+        )
+        self.state.add_listener(self.on_state_change)
+
+    def init_sensors(self):
+        # Create physical sensors
+        self.sensors = self.create_sensors()
+        logger.info(
+            f"Initialized {self.settings.sensor_count} sensors of type {type(self.sensors[0]).__name__}"
+        )
+
+    def init_pca(self):
+        if self.settings.renderer_process:
+            # Leds are driven from their own process, started with the other threads
+            self.renderer = RendererProcess(
+                self.settings,
+                self.log_level(),
+                self.settings.renderer_channel_path,
+                self.settings.renderer_heartbeat_timeout,
+            )
+            logger.info("Leds are driven by a separate renderer process")
+            return
+
+        # Physical led outputs
+        self.led_array = PCA9685LedArray(
+            LedSettings(
+                led_count=self.settings.led_count,
+                freq=self.settings.led_freq,
+                fps=self.settings.led_fps_on,
+                driver=self.settings.led_driver,
+                i2c_bus=self.settings.led_i2c_bus,
+            ),
+            pca=self.pca_driver,
+            clock=self.clock,
+        )
+        logger.info(f"Initialized {self.settings.led_count} leds over PCA")
+
+        # Live frames for local observers
+        if self.settings.frame_buffer_enabled:
+            self.led_array.frame_buffer = FrameBufferWriter(
+                self.settings.frame_buffer_path,
+                len(self.led_array.duty_cycles),
+                self.settings.sensor_count,
+            )
+            logger.info(f"Publishing frames to {self.settings.frame_buffer_path}")
+
+        self.animator = Animator(self.settings, self.led_array, self.clock)
+
+    def init_extra_lights(self):
+        # Owned by the renderer process when there is one
+        self.extra_timers = TimerHeap()
+        self.extra_lights = [] if self.renderer else self.create_extra_lights()
+
+    def init_ha_entities(self):
+        # MQTT, connected in the background once the entities exist
+        self.mqtt_settings = HASettings.MQTT(
+            host=self.settings.mqtt_host,
+            port=self.settings.mqtt_port,
+            username=self.settings.mqtt_user,
+            password=self.settings.mqtt_pass,
+        )
+        self.mqtt = MqttConnection(
+            self.mqtt_settings, self.settings.discovery_cache_path, self.mqtt_client
+        )
+
+        # Home Assistant Device Class
+        self.device_info = DeviceInfo(
+            name=self.settings.device_name,
+            identifiers=self.settings.device_id,
+        )
+
+        # Create Home Assistant sensors
+        self.ha_sensors = self.create_ha_sensors(self.device_info)
+        self.sensor_publisher = SensorStatePublisher(
+            self.mqtt,
+            self.ha_sensors,
+            self.settings.sensor_distance_delta,
+            self.settings.sensor_distance_min_interval,
+            self.settings.aggregate_entity_interval
+            if self.settings.aggregate_enabled
+            else 0.0,
+        )
+
+        # Bulk sensor topic for dashboards and other consumers
+        self.aggregate_publisher = None
+        if self.settings.aggregate_enabled:
+            self.aggregate_publisher = AggregateSensorPublisher(
+                self.mqtt,
+                self.settings.aggregate_topic,
+                self.settings.aggregate_include_distances,
+                self.settings.aggregate_distance_quantum,
+            )
+
+        # Create Home Assistant Light
+        self.ha_light, self.ha_light_info = self.create_ha_light(
+            self.ha_light_callback, self.device_info
+        )
+
+        # Create Home Asisstant Extra Lights
+        self.ha_extra_lights = self.create_ha_extra_lights(self.device_info)
+
+        # Create Home Assistant Debug Devices
+        self.cpu_sensor = None
+        self.mem_sensor = None
+        if self.settings.create_debug_entities:
+            sensor_info = SensorInfo(
+                device=self.device_info,
+                name="CPU Usage",
+                icon="mdi:cpu-64-bit" if is_os_64bit() else "mdi:cpu-32-bit",
+                unit_of_measurement="%",
+                unique_id="cpu",
+            )
+            self.cpu_sensor = SharedSensor(
+                HASettings(mqtt=self.mqtt_settings, entity=sensor_info), self.mqtt
+            )
+
+            sensor_info = SensorInfo(
+                device=self.device_info,
+                name="Memory Usage",
+                icon="mdi:memory",
+                unit_of_measurement="%",
+                unique_id="mem",
+            )
+            self.mem_sensor = SharedSensor(
+                HASettings(mqtt=self.mqtt_settings, entity=sensor_info), self.mqtt
+            )
+
+    def init_threads(self):
+        # Sensor thread
+        self.sensor_thread = threading.Thread(
+            target=self.sensor_loop, name="sensors", daemon=True
+        )
+        self.sensor_thread.start()
+
+        if self.renderer:
+            self.state.add_listener(self.renderer.on_state_change, initial=True)
+            self.renderer.start()
+            logger.info(f"Lights ready: {round(time.time() - self.startup_time, 2)}s")
+            return
+
+        # Launch led thread
+        self.led_update_thread = threading.Thread(
+            target=self.led_array.update_loop, name="leds", daemon=True
+        )
+        self.led_update_thread.start()
+
+        # Animation thread
+        self.animator_thread = threading.Thread(
+            target=self.animator_loop, name="animator", daemon=True
+        )
+        self.animator_thread.start()
+
+        # Extra Animation thread
+        self.extra_animator_thread = threading.Thread(
+            target=self.extra_animator_loop, name="extra_animator", daemon=True
+        )
+        if self.settings.extra_led_count > 0:
+            self.extra_animator_thread.start()
+
+        logger.info(f"Lights ready: {round(time.time() - self.startup_time, 2)}s")
+
+    def init_mqtt_connect(self):
+        # Home Assistant discovery and state sync happen on every (re)connect
+        self.mqtt.on_ready = self.ha_sync
+        self.mqtt.connect()
+
+        connect_check = threading.Timer(
+            self.settings.mqtt_timeout, self.check_mqtt_connected
+        )
+        connect_check.daemon = True
+        connect_check.start()
+
+    def init_control(self):
+        # Local control API, bypasses the MQTT broker
+        self.control_server = None
+        if self.settings.control_enabled:
+            self.control_server = ControlServer(
+                self.settings.control_socket_path, self.control_request
+            )
+            self.control_server.start()
+
+    def init_metrics(self):
+        # Local Prometheus-style metrics endpoint
+        self.metrics_server = None
+        if self.settings.metrics_enabled:
+            self.metrics_server = MetricsServer(
+                self.settings.metrics_host, self.settings.metrics_port
+            )
+            self.metrics_server.start()
+
+    def init_config_watch(self):
+        # Apply config edits without a restart
+        self.config_watcher = None
+        if self.settings.hot_reload:
+            self.config_watcher = ConfigWatcher(
+                self.settings.config_file, self.reload_settings
+            )
+            self.config_watcher.start()
+
+    def reload_settings(self):
+        """Apply the changes of the config file to the running subsystems"""
+        try:
+            settings = Settings(self.settings.config_file)
+        except (OSError, ValueError, TypeError, AttributeError, yaml.YAMLError) as e:
+            logger.error(f"Ignoring unreadable config {self.settings.config_file}, {repr(e)}")
+            return
+        for name, value in self.settings_overrides.items():
+            setattr(settings, name, value)
+
+        changed = self.settings.changes(settings)
+        if not changed:
+            logger.debug("Config file written without changes")
+            return
+
+        if self.recorder:
+            self.recorder.config(settings.root_settings)
+
+        applied = [name for name in changed if name in LIVE_SETTINGS]
+        restart = [name for name in changed if name not in LIVE_SETTINGS]
+        if "sensor_settings" in restart and self.apply_sensor_settings(
+            settings.sensor_settings
+        ):
+            restart.remove("sensor_settings")
+            applied.append("sensor_settings")
+
+        self.settings.update(settings, applied)
+
+        # Settings held by subsystems rather than read from self.settings
+        # The renderer process watches the config file itself
+        if self.led_array:
+            self.led_array.set_fps(self.settings.led_fps_on)
+            self.led_array.set_freq(self.settings.led_freq)
+        self.sensor_publisher.distance_delta = self.settings.sensor_distance_delta
+        self.sensor_publisher.distance_min_interval = (
+            self.settings.sensor_distance_min_interval
+        )
+        if self.aggregate_publisher:
+            self.aggregate_publisher.include_distances = (
+                self.settings.aggregate_include_distances
+            )
+            self.aggregate_publisher.distance_quantum = (
+                self.settings.aggregate_distance_quantum
+            )
+
+        if applied:
+            logger.info(f"Config reloaded, applied {', '.join(applied)}")
+        if restart:
+            logger.warning(
+                f"Config changes to {', '.join(restart)} need a restart to take effect"
+            )
+
+    def apply_sensor_settings(
+        self, sensor_settings: list[VL53L0XTypedSettings | GPIOSensorTypedSettings]
+    ) -> bool:
+        """Retune or recreate only the sensors whose config changed
+
+        Returns:
+            bool: Changes were applied, False if they need a restart (sensor added,
+            removed, changed type or moved to another XSHUT pin)
+        """
+        old_settings = self.settings.sensor_settings
+        if len(sensor_settings) != len(old_settings):
+            return False
+
+        changes = []
+        for index, (before, after) in enumerate(zip(old_settings, sensor_settings)):
+            if before == after:
+                continue
+            if before.get("type") != after.get("type"):
+                return False
+            if after.get("type") == "vl53l0x_i2c" and before.get(
+                "xshut_pin"
+            ) != after.get("xshut_pin"):
+                return False  # Addresses are assigned by the startup XSHUT sequence
+            changes.append((index, before, after))
+
+        for index, before, after in changes:
+            sensor = self.sensors[index]
+            if isinstance(sensor, VL53L0XSensor):
+                sensor.trip_distance = after.get("calibration")
+                if before.get("timing_budget") != after.get("timing_budget"):
+                    sensor.retune(after.get("timing_budget"))
+                logger.info(f"Retuned sensor {index}")
+            elif isinstance(sensor, GPIOSensor):
+                sensor.close()
+                self.sensors[index] = GPIOSensor(
+                    after.get("pin"),
+                    after.get("invert", False),
+                    after.get("pullup", False),
+                    after.get("bounce_time", 0.0),
+                )
+                logger.info(f"Recreated sensor {index} on pin {after.get('pin')}")
+        return True
+
+    def ha_sync(self, published: int, skipped: int):
+        """Publish the full local state to Home Assistant after MQTT (re)connects"""
+        logger.info(
+            f"Home Assistant discovery: {published} configs published, {skipped} unchanged"
+        )
+
+        if published:
+            time.sleep(0.1)  # Home Assistant needs this small delay for new configs
+
+        snapshot = self.state.snapshot
+        self.ha_light.publish_state(snapshot.lighting, LIGHT_EFFECTS)
+        for index, light in enumerate(self.ha_extra_lights):
+            light.publish_state(snapshot.extras[index], EXTRA_LIGHT_EFFECTS)
+        self.sensor_publisher.reset()
+        if self.aggregate_publisher:
+            self.aggregate_publisher.reset()
+
+        if self.ha_ready_time is None:
+            self.ha_ready_time = time.time() - self.startup_time
+            logger.success("MQTT Client Connected")
+            logger.info(f"Home Assistant ready: {round(self.ha_ready_time, 2)}s")
+        else:
+            logger.success("MQTT Client Reconnected")
+
+    def check_mqtt_connected(self):
+        if not self.mqtt.is_connected():
+            logger.warning(
+                f"MQTT is not connected after {self.settings.mqtt_timeout}s, "
+                f"lights keep running locally while retrying in the background"
+            )
+
+    def ha_light_callback(self, client: Client, user_data, message: MQTTMessage):
+        if self.recorder:
+            self.recorder.command(message.payload)
+
+        if not self.ha_light:
+            logger.error("Callback was called without an existing ha_light")
+            return
+
+        if not self.ha_light_info:
+            logger.error("Callback was called without an existing ha_light_info")
+            return
+
+        # Make sure received payload is json
+        try:
+            payload = decode_json_payload(message.payload)
+        except ValueError as e:
+            logger.error(f"Ony JSON schema is supported for light entities! {e}")
+            return
+
+        if not payload.keys() & {"state", "brightness", "effect"}:
+            logger.warning(f"Unknown light payload: {payload}")
+            return
+
+        # All fields of the command are applied as one state transition
+        try:
+            self.state.update_lighting(
+                lambda lighting_data: apply_light_command(
+                    lighting_data, payload, LIGHT_EFFECTS, self.ha_light_info.payload_on
+                ),
+                self.echo_light_state,
+            )
+        except (KeyError, ValueError, TypeError) as e:
+            logger.warning(f"Invalid light payload {payload}, {repr(e)}")
+
+    def ha_extra_light_callback(
+        self, client: Client, user_data, message: MQTTMessage, index: int
+    ):
+        if self.recorder:
+            self.recorder.command(message.payload, index)
+
+        if not self.ha_extra_lights:
+            logger.error("Callback was called without an existing ha_extra_lights")
+            return
+
+        # Make sure received payload is json
+        try:
+            payload = decode_json_payload(message.payload)
+        except ValueError as e:
+            logger.error(f"Ony JSON schema is supported for light entities! {e}")
+            return
+
+        try:
+            self.state.update_extra(
+                index,
+                lambda extra_lighting_data: apply_light_command(
+                    extra_lighting_data,
+                    payload,
+                    EXTRA_LIGHT_EFFECTS,
+                    self.ha_light_info.payload_on,
+                ),
+                lambda snapshot: self.echo_light_state(snapshot, index),
+            )
+        except (KeyError, ValueError, TypeError) as e:
+            logger.warning(f"Invalid extra light payload {payload}, {repr(e)}")
+
+    def echo_light_state(self, snapshot: StateSnapshot, index: int | None = None):
+        """Publish the state for a command that changed nothing
+
+        Home Assistant's optimistic UI has already shown the command, and would otherwise
+        never hear back from a repeated or no-op one
+        """
+        if not self.mqtt.is_connected():
+            return
+        if index is None:
+            self.ha_light.publish_state(snapshot.lighting, LIGHT_EFFECTS)
+        else:
+            self.ha_extra_lights[index].publish_state(snapshot.extras[index], EXTRA_LIGHT_EFFECTS)
+
+    def on_state_change(self, old: StateSnapshot, new: StateSnapshot):
+        """Publish and persist lighting changes, sensor trips are published by poll_sensors"""
+        if new.lighting == old.lighting and new.extras == old.extras:
+            return
+
+        if self.mqtt.is_connected():
+            if new.lighting != old.lighting:
+                self.ha_light.publish_state(new.lighting, LIGHT_EFFECTS)
+            for index, extra in enumerate(new.extras):
+                if extra != old.extras[index]:
+                    self.ha_extra_lights[index].publish_state(extra, EXTRA_LIGHT_EFFECTS)
+        save_lighting_state(self.settings.state_file_path, new.lighting, list(new.extras))
+
+    def control_request(self, request: dict) -> dict:
+        """Handle a local control API request, see control.py"""
+        light = request.get("light", "main")
+        index = None if light == "main" else int(light)
+        if index is not None and not 0 <= index < self.settings.extra_led_count:
+            raise IndexError(f"No extra light {index}")
+        if self.recorder and request.keys() & {"state", "brightness", "effect"}:
+            self.recorder.command(json.dumps(request).encode(), index, control=True)
+
+        if index is None:
+            snapshot = self.state.update_lighting(
+                lambda lighting_data: apply_light_command(
+                    lighting_data, request, LIGHT_EFFECTS, self.ha_light_info.payload_on
+                )
+            )
+            lighting_data = snapshot.lighting
+            effects = LIGHT_EFFECTS
+        else:
+            snapshot = self.state.update_extra(
+                index,
+                lambda extra_lighting_data: apply_light_command(
+                    extra_lighting_data,
+                    request,
+                    EXTRA_LIGHT_EFFECTS,
+                    self.ha_light_info.payload_on,
+                ),
+            )
+            lighting_data = snapshot.extras[index]
+            effects = EXTRA_LIGHT_EFFECTS
+
+        return {
+            "ok": True,
+            "light": light,
+            "state": self.ha_light_info.payload_on
+            if lighting_data.power
+            else self.ha_light_info.payload_off,
+            "brightness": lighting_data.brightness,
+            "effect": next(
+                (name for name, effect in effects.items() if effect == lighting_data.effect),
+                None,
+            ),
+        }
+
+    def create_ha_light(self, callback, device_info):
+        # Information about the light
+        ha_light_info = LightInfo(
+            name=self.settings.light_name,
+            icon=self.settings.light_icon,
+            device=device_info,
+            unique_id=self.settings.light_id,
+            brightness=True,
+            color_mode=False,
+            effect=True,
+            effect_list=list(LIGHT_EFFECTS.keys()),
+        )
+
+        ha_light_settings = HASettings(mqtt=self.mqtt_settings, entity=ha_light_info)
+
+        ha_light = SharedLight(ha_light_settings, self.mqtt, callback)
+
+        return ha_light, ha_light_info
+
+    def create_extra_lights(self):
+        logger.debug(f"Using extra light config: {self.settings.extra_led_settings}")
+
+        extra_lights: list[PCA9685ExtraChannel] = []
+
+        for i in range(self.settings.extra_led_count):
+            sensor_setting = self.settings.extra_led_settings[i].get('sensor') or {}
+
+            if sensor_setting.get("type") == "gpio":
+                sensor = GPIOSensor(
+                    sensor_setting.get("pin"),
+                    sensor_setting.get("invert", False),
+                    sensor_setting.get("pullup", False),
+                    sensor_setting.get("bounce_time", 0)
+                )
+            else:
+                sensor = NullSensor()
+
+            extra_lights.append(
+                PCA9685ExtraChannel(
+                    self.led_array,
+                    self.settings.extra_led_settings[i].get('channel'),
+                    sensor,
+                    self.settings.extra_led_settings[i].get('hold', 0.0),
+                    self.settings.extra_led_settings[i].get('fade_out', 0.0),
+                    self.extra_timers,
+                )
+            )
+
+        return extra_lights
+
+    def create_ha_extra_lights(self, device_info):
+        if not self.ha_light:
+            logger.critical(
+                "Extra lights are being created before main lights. Exiting"
+            )
+            sys.exit()
+
+        ha_lights: list[SharedLight] = []
+
+        for i in range(self.settings.extra_led_count):
+            # Information about the light
+            ha_light_info = LightInfo(
+                name=self.settings.extra_led_settings[i].get(
+                    "ha_name",
+                    f"Extra Channel {self.settings.extra_led_settings[i].get('channel', '?')}",
+                ),
+                icon=self.settings.extra_led_settings[i].get("ha_icon", "mdi:lightbulb"),
+                device=device_info,
+                unique_id=self.settings.extra_led_settings[i].get(
+                    "ha_id",
+                    f"extra{self.settings.extra_led_settings[i].get('channel')}",
+                ),
+                brightness=True,
+                color_mode=False,
+                effect=True,
+                effect_list=list(EXTRA_LIGHT_EFFECTS.keys()),
+            )
+
+            ha_light_settings = HASettings(
+                mqtt=self.mqtt_settings, entity=ha_light_info
+            )
+
+            ha_lights.append(
+                SharedLight(
+                    ha_light_settings,
+                    self.mqtt,
+                    functools.partial(self.ha_extra_light_callback, index=i),
+                )
+            )
+
+        return ha_lights
+
+    def create_sensors(self):
+        sensors: list[VL53L0XSensor | GPIOSensor] = []
+
+        vl_sensors: list[VL53L0XSensor] = []
+        vl_budgets: list[int] = []
+
+        io_sensors: list[GPIOSensor] = []
+
+        for sensor in self.settings.sensor_settings:
+            logger.trace(f"Adding new sensor, {sensor}")
+            if sensor.get("type") == "vl53l0x_i2c":
+                s = VL53L0XSensor(
+                    sensor.get("xshut_pin"), trip_distance=sensor.get("calibration")
+                )
+                vl_budgets.append(sensor.get("timing_budget"))
+                vl_sensors.append(s)
+            else:
+                s = GPIOSensor(
+                    sensor.get("pin"),
+                    sensor.get("invert", False),
+                    sensor.get("pullup", False),
+                    sensor.get("bounce_time", 0.0),
+                )
+                io_sensors.append(s)
+            sensors.append(s)
+
+        for index, s in enumerate(vl_sensors):
+            # Physical device, one at a time as each starts at the shared default address
+            vl_sensors[index].begin()
+            vl_sensors[index].timing_budget = vl_budgets[index]
+
+        return sensors
+
+    def create_ha_sensors(self, device_info):
+        ha_sensors: list[SharedBinarySensor] = []
+
+        for index in range(self.settings.sensor_count):
+            # HA entity
+            sensor_info = BinarySensorInfo(
+                name=self.settings.sensor_naming_scheme.format(index+1),
+                device_class=self.settings.sensor_device_class,
+                unique_id=self.settings.sensor_id_scheme.format(index),
+                device=device_info,
+            )
+            ha_sensor = SharedBinarySensor(
+                HASettings(mqtt=self.mqtt_settings, entity=sensor_info), self.mqtt
+            )
+            ha_sensors.append(ha_sensor)
+
+        return ha_sensors
+
+    def sensor_loop(self):
+        frame_meter = REGISTRY.frame_meter("sensors")
+        trips = [False] * len(self.sensors)
+        distances: list[float | None] = [None] * len(self.sensors)
+        while True:
+            frame_start = time.perf_counter()
+            self.poll_sensors(trips, distances)
+            frame_meter.frame(time.perf_counter() - frame_start)
+            self.clock.sleep(0.05)
+
+    def poll_sensors(self, trips: list[bool], distances: list[float | None]):
+        """Read every sensor once, store the trips and publish the changes"""
+        for i, s in enumerate(self.sensors):
+            trips[i] = s.tripped
+            distances[i] = s.distance if s.has_distance else None
+            self.sensor_publisher.publish(i, trips[i], distances[i])
+        self.state.set_sensor_trips(trips)
+        if self.recorder:
+            self.recorder.sensors(trips, distances)
+        if self.led_array and self.led_array.frame_buffer:
+            self.led_array.frame_buffer.update_sensors(trips, distances)
+        if self.aggregate_publisher:
+            self.aggregate_publisher.publish(trips, distances)
+
+    def animator_loop(self):
+        logger.info("Animation loop started")
+        frame_meter = REGISTRY.frame_meter("animator")
+        snapshot = self.state.snapshot
+        while True:
+            # One frame, or less when a command or sensor trip changes the state
+            timeout = 1 / (
+                self.settings.led_fps_on
+                if snapshot.lighting.power
+                else self.settings.led_fps_off
+            )
+            if snapshot.lighting.power and snapshot.lighting.effect == Animations.WALKING:
+                # Walking frames only change with the state or a hold timer, config reloads
+                # are picked up within a second
+                deadline = self.animator.next_deadline()
+                timeout = 1.0 if deadline is None else min(max(deadline - self.clock.time(), 0.0), 1.0)
+            snapshot = self.state.wait(snapshot.version, timeout)
+            frame_start = time.perf_counter()
+
+            self.animator.animate_frame(snapshot.lighting, snapshot.sensor_trips)
+            frame_meter.frame(time.perf_counter() - frame_start)
+
+    def extra_animator_loop(self):
+        frame_meter = REGISTRY.frame_meter("extra_animator")
+        while True:
+            self.clock.sleep(1 / self.settings.led_fps_on)
+            frame_start = time.perf_counter()
+            extras = self.state.snapshot.extras
+            self.extra_timers.run_expired(self.clock.time())
+            for index, light in enumerate(self.extra_lights):
+                light.animation_cycle(extras[index])
+            frame_meter.frame(time.perf_counter() - frame_start)
+
+    def at_exit(self):
+        if getattr(self, "config_watcher", None):
+            self.config_watcher.stop()
+
+        if self.recorder:
+            self.recorder.close()
+
+        if self.renderer:
+            self.renderer.stop()
+
+        if self.led_array and self.led_array.frame_buffer:
+            self.led_array.frame_buffer.close()
+
+        if getattr(self, "control_server", None):
+            self.control_server.stop()
+
+        for sensor in self.sensors or []:
+            if isinstance(sensor, VL53L0XSensor):
+                sensor.end()
+
+        logger.info("Auto-Light stopped")
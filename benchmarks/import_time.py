@@ -0,0 +1,96 @@
+"""
+AutoLight import-time budget check
+Runs a light CLI mode under `python -X importtime` and fails when startup
+imports exceed the time budget or pull in hardware and networking modules
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that must only load in the run modes that need them
+FORBIDDEN_MODULES = [
+    "ha_mqtt_discoverable",
+    "paho",
+    "psutil",
+    "rich",
+    "board",
+    "busio",
+    "adafruit_pca9685",
+    "adafruit_vl53l0x",
+    "gpiozero",
+    "smbus2",
+    "numpy",
+    "app",
+    "subsystems",
+]
+
+
+def measure(cli_args: list[str]):
+    """Run main.py with the given arguments, returns {module: (self_us, cumulative_us)}"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", os.path.join(ROOT, "main.py"), *cli_args],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+    )
+
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line.removeprefix("import time:").split("|")
+        modules[name.strip()] = (int(self_us), int(cumulative_us))
+    return modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--budget-ms",
+        type=float,
+        default=100.0,
+        help="Maximum total import time in milliseconds",
+    )
+    parser.add_argument(
+        "--top", type=int, default=10, help="Number of slowest imports to show"
+    )
+    parser.add_argument(
+        "cli_args",
+        nargs="*",
+        default=["--version"],
+        help="Arguments passed to main.py (default: --version)",
+    )
+    args = parser.parse_args()
+
+    modules = measure(args.cli_args)
+    total_ms = sum(self_us for self_us, _ in modules.values()) / 1000
+
+    print(f"main.py {' '.join(args.cli_args)}: {len(modules)} modules, {total_ms:.1f}ms")
+    slowest = sorted(modules.items(), key=lambda item: item[1][1], reverse=True)
+    for name, (_, cumulative_us) in slowest[: args.top]:
+        print(f"  {cumulative_us / 1000:8.1f}ms  {name}")
+
+    passing = True
+
+    leaked = sorted(
+        name for name in modules if name.split(".")[0] in FORBIDDEN_MODULES
+    )
+    if leaked:
+        print(f"FAIL: heavy modules imported at startup: {', '.join(leaked)}")
+        passing = False
+
+    if total_ms > args.budget_ms:
+        print(f"FAIL: import time {total_ms:.1f}ms is over budget {args.budget_ms}ms")
+        passing = False
+
+    if passing:
+        print("PASS")
+    sys.exit(0 if passing else 1)
+
+
+if __name__ == "__main__":
+    main()
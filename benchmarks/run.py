@@ -0,0 +1,329 @@
+"""
+AutoLight hardware-free benchmarks
+Times the render, animation, sensor, settings and MQTT callback paths against
+simulated hardware, writes the results as JSON and flags regressions against a baseline
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import timeit
+from array import array
+from typing import Callable
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+sys.path.insert(0, ROOT)
+
+from loguru import logger  # noqa: E402
+
+from data_types import Animations, LightingData, LIGHT_EFFECTS  # noqa: E402
+from settings import Settings  # noqa: E402
+from subsystems.leds import (  # noqa: E402
+    BlinkAnimation,
+    FadeAnimation,
+    LedSettings,
+    LedSync,
+    NullAnimation,
+    PCA9685LedArray,
+    PowerUnits,
+)
+from subsystems.sim import NullBusioI2C, NullSMBus, SimulatedPCA9685  # noqa: E402
+from utils import surround_list  # noqa: E402
+
+# name -> zero-argument function timed per call
+Benchmark = tuple[str, Callable[[], object]]
+
+
+def led_render_benchmarks(settings: Settings) -> list[Benchmark]:
+    """One PCA9685LedArray frame per animation and sync mode"""
+    modes = {"off": None, "steady": NullAnimation()}
+    for sync in LedSync:
+        modes[f"blink_{sync.name.lower()}"] = BlinkAnimation(sync=sync)
+    for sync in (LedSync.SYNC, LedSync.STAGGERED):
+        modes[f"fade_{sync.name.lower()}"] = FadeAnimation(sync=sync)
+
+    benchmarks = []
+    for mode, animation in modes.items():
+        led_array = PCA9685LedArray(
+            LedSettings(led_count=settings.led_count, auto_shutdown=False),
+            pca=SimulatedPCA9685(),
+        )
+        for index in range(settings.led_count):
+            led_array.set_power_state(index, animation is not None)
+            led_array.set_brightness(index, 200, PowerUnits.BITS8)
+            led_array.set_animation(index, animation or NullAnimation())
+
+        benchmarks.append(
+            (
+                f"leds.render_frame[{mode}]",
+                lambda led_array=led_array: led_array.render_frame(time.time()),
+            )
+        )
+    return benchmarks
+
+
+def pca9685_driver_benchmarks() -> list[Benchmark]:
+    """CPU cost of the Adafruit and direct smbus2 drivers, on buses that discard every write"""
+    duty_cycles = array("H", [index * 4096 for index in range(16)])
+    drivers = {}
+    try:
+        import adafruit_pca9685
+
+        drivers["adafruit"] = adafruit_pca9685.PCA9685(NullBusioI2C())
+    except ImportError as e:
+        print(f"Skipping the adafruit driver benchmarks, {e}")
+    try:
+        from subsystems.pca9685 import SMBusPCA9685
+
+        drivers["smbus2"] = SMBusPCA9685(NullSMBus())
+    except ImportError as e:
+        print(f"Skipping the smbus2 driver benchmarks, {e}")
+
+    def channel_write(pca):
+        pca.channels[0].duty_cycle = duty_cycles[5]
+
+    def frame_write(pca):
+        # What PCA9685LedArray writes per frame with each driver
+        if hasattr(pca, "write_channels"):
+            pca.write_channels(duty_cycles, 0, 16)
+        else:
+            for index in range(16):
+                pca.channels[index].duty_cycle = duty_cycles[index]
+
+    benchmarks = []
+    for name, pca in drivers.items():
+        benchmarks.append(
+            (f"pca9685.channel_write[{name}]", lambda pca=pca: channel_write(pca))
+        )
+        benchmarks.append(
+            (f"pca9685.frame_write[{name}]", lambda pca=pca: frame_write(pca))
+        )
+    return benchmarks
+
+
+def animator_benchmarks(main) -> list[Benchmark]:
+    """One Animator frame per main light effect"""
+    trips = [index % 3 == 0 for index in range(main.settings.sensor_count)]
+    benchmarks = []
+    for effect in (
+        Animations.WALKING,
+        Animations.STEADY,
+        Animations.BLINK,
+        Animations.FADE,
+    ):
+        lighting_data = LightingData(power=True, brightness=200, effect=effect)
+        benchmarks.append(
+            (
+                f"animator.animate_frame[{effect.name.lower()}]",
+                lambda data=lighting_data: main.animator.animate_frame(data, trips),
+            )
+        )
+    off = LightingData(power=False)
+    benchmarks.append(
+        ("animator.animate_frame[off]", lambda: main.animator.animate_frame(off, trips))
+    )
+    return benchmarks
+
+
+def surround_list_benchmarks() -> list[Benchmark]:
+    benchmarks = []
+    for size in (8, 32, 128):
+        trips = [index % 4 == 0 for index in range(size)]
+        for radius in (1, 3):
+            benchmarks.append(
+                (
+                    f"utils.surround_list[n={size},r={radius}]",
+                    lambda trips=trips, radius=radius: surround_list(trips, radius),
+                )
+            )
+    return benchmarks
+
+
+def sensor_benchmarks(main) -> list[Benchmark]:
+    """Sensor loop iteration, steady and with every sensor changing"""
+    trips = [False] * len(main.sensors)
+    distances: list[float | None] = [None] * len(main.sensors)
+    state = {"near": False}
+
+    def changing():
+        state["near"] = not state["near"]
+        for sensor in main.sensors:
+            sensor.set_distance(5 if state["near"] else 500)
+        main.poll_sensors(trips, distances)
+
+    return [
+        ("main.poll_sensors[steady]", lambda: main.poll_sensors(trips, distances)),
+        ("main.poll_sensors[changing]", changing),
+    ]
+
+
+def mqtt_benchmarks(main) -> list[Benchmark]:
+    """Light command messages through the shared client to the light callback"""
+    topic = main.ha_light._command_topic
+    client = main.mqtt.client
+    effects = list(LIGHT_EFFECTS)
+    state = {"index": 0}
+
+    def command():
+        state["index"] += 1
+        payload = {
+            "state": "ON",
+            "brightness": state["index"] % 256,
+            "effect": effects[state["index"] % len(effects)],
+        }
+        client.deliver(topic, json.dumps(payload).encode())
+
+    return [
+        ("mqtt.light_command", command),
+        ("mqtt.light_command[invalid]", lambda: client.deliver(topic, b"not json")),
+    ]
+
+
+def settings_benchmarks(config_file: str) -> list[Benchmark]:
+    return [("settings.load", lambda: Settings(config_file))]
+
+
+def time_benchmark(func: Callable[[], object], repeat: int, min_time: float) -> dict:
+    """Per-call timing statistics in seconds"""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    number = max(1, int(number * min_time / 0.2))
+    runs = [total / number for total in timer.repeat(repeat=repeat, number=number)]
+    return {
+        "calls": number,
+        "repeat": repeat,
+        "min": min(runs),
+        "median": statistics.median(runs),
+        "mean": statistics.mean(runs),
+        "stdev": statistics.stdev(runs) if len(runs) > 1 else 0.0,
+    }
+
+
+def git_revision() -> str | None:
+    try:
+        result = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+        )
+    except OSError:
+        return None
+    return result.stdout.strip() or None
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    """Names of benchmarks slower than the baseline by more than threshold
+
+    Compares the fastest run, the estimate least affected by other load on the machine
+    """
+    regressions = []
+    for name, result in results["benchmarks"].items():
+        previous = baseline.get("benchmarks", {}).get(name)
+        if previous is None:
+            continue
+        if result["min"] > previous["min"] * (1 + threshold):
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "-c", "--config", default=os.path.join(ROOT, "config.yaml"), help="Config file"
+    )
+    parser.add_argument(
+        "-k", "--filter", default="", help="Only run benchmarks containing this text"
+    )
+    parser.add_argument("--repeat", type=int, default=5, help="Timing runs per benchmark")
+    parser.add_argument(
+        "--min-time",
+        type=float,
+        default=0.2,
+        help="Approximate seconds per timing run",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="Results file (default: benchmarks/results/<timestamp>.json)",
+    )
+    parser.add_argument("--compare", help="Baseline results file to compare against")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.10,
+        help="Allowed slowdown against the baseline (default: 0.10)",
+    )
+    args = parser.parse_args()
+
+    # Every simulated command and publish would otherwise be logged
+    logger.remove()
+
+    from app import Main
+
+    settings = Settings(args.config)
+    main_sim = Main.simulated(settings)
+
+    benchmarks = led_render_benchmarks(settings)
+    benchmarks += pca9685_driver_benchmarks()
+    benchmarks += animator_benchmarks(main_sim)
+    benchmarks += surround_list_benchmarks()
+    benchmarks += sensor_benchmarks(main_sim)
+    benchmarks += mqtt_benchmarks(main_sim)
+    benchmarks += settings_benchmarks(args.config)
+
+    results = {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "config": os.path.relpath(args.config, ROOT),
+        "benchmarks": {},
+    }
+
+    print(f"{'benchmark':<40}{'median':>12}{'min':>12}{'stdev':>10}")
+    for name, func in benchmarks:
+        if args.filter not in name:
+            continue
+        result = time_benchmark(func, args.repeat, args.min_time)
+        results["benchmarks"][name] = result
+        print(
+            f"{name:<40}{result['median'] * 1e6:>10.2f}us{result['min'] * 1e6:>10.2f}us"
+            f"{result['stdev'] / result['median'] * 100:>9.1f}%"
+        )
+
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"{datetime.datetime.now():%Y%m%d-%H%M%S}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+
+    if not args.compare:
+        return
+
+    with open(args.compare) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.threshold)
+    for name in regressions:
+        previous = baseline["benchmarks"][name]["min"]
+        current = results["benchmarks"][name]["min"]
+        print(
+            f"REGRESSION: {name} {previous * 1e6:.2f}us -> {current * 1e6:.2f}us "
+            f"(+{(current / previous - 1) * 100:.0f}%)"
+        )
+    if regressions:
+        sys.exit(1)
+    print(f"PASS: no benchmark slower than baseline by more than {args.threshold:.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+"""
+AutoLight I2C Calibration
+Measures transaction rate and errors against the attached devices at each candidate bus
+clock, and recommends the fastest one that stays error free on this wiring
+"""
+
+import subprocess
+import time
+from dataclasses import dataclass
+
+import smbus2
+from loguru import logger
+from smbus2 import i2c_msg
+
+from subsystems.i2c import get_bus_frequency, list_devices, set_bus_frequency
+
+CANDIDATE_FREQUENCIES = (100_000, 400_000, 1_000_000)
+
+# Fastest clock in each datasheet, Fast-mode Plus and Fast-mode
+DEVICE_MAX_FREQUENCY = {"PCA9685": 1_000_000, "VL53L0X": 400_000}
+
+_PCA9685_ADDRESS = 0x40
+_PCA9685_SUBADR1 = 0x02
+_VL53L0X_MODEL_ID_REGISTER = 0xC0
+_VL53L0X_MODEL_ID = 0xEE
+
+
+@dataclass
+class SpeedResult:
+    frequency: int
+    transactions: int = 0
+    errors: int = 0
+    duration: float = 0.0
+    applied: bool = True
+
+    @property
+    def rate(self) -> float:
+        return self.transactions / self.duration if self.duration else 0.0
+
+    @property
+    def error_rate(self) -> float:
+        return self.errors / self.transactions if self.transactions else 1.0
+
+
+class I2CCalibration:
+    """Runs the devices found on the bus through verified transactions at every candidate clock"""
+
+    def __init__(
+        self,
+        bus: int = 1,
+        frequencies: tuple[int, ...] = CANDIDATE_FREQUENCIES,
+        duration: float = 2.0,
+    ) -> None:
+        self.bus = bus
+        self.frequencies = frequencies
+        self.duration = duration
+        self.devices: dict[int, str] = {}
+
+    def identify(self, smbus: smbus2.SMBus) -> dict[int, str]:
+        """Attached devices by address, PCA9685, VL53L0X or unknown"""
+        devices = {}
+        for address in list_devices(smbus):
+            if address == _PCA9685_ADDRESS:
+                devices[address] = "PCA9685"
+                continue
+            try:
+                model = smbus.read_byte_data(address, _VL53L0X_MODEL_ID_REGISTER)
+            except OSError:
+                model = None
+            devices[address] = "VL53L0X" if model == _VL53L0X_MODEL_ID else "unknown"
+        return devices
+
+    def _transaction(self, smbus: smbus2.SMBus, address: int, kind: str, sequence: int) -> bool:
+        """One verified transaction, False if the device answered with the wrong data"""
+        if kind == "PCA9685":
+            # Sub-addresses only answer with the SUB bits of MODE1 set, so writing one is harmless
+            pattern = (sequence * 2) & 0xFE  # Bit 0 is read-only
+            read = i2c_msg.read(address, 1)
+            smbus.i2c_rdwr(i2c_msg.write(address, bytes((_PCA9685_SUBADR1, pattern))))
+            smbus.i2c_rdwr(i2c_msg.write(address, bytes((_PCA9685_SUBADR1,))), read)
+            return bytes(read)[0] == pattern
+        if kind == "VL53L0X":
+            return (
+                smbus.read_byte_data(address, _VL53L0X_MODEL_ID_REGISTER) == _VL53L0X_MODEL_ID
+            )
+        smbus.read_byte(address)
+        return True
+
+    def measure(self, frequency: int) -> SpeedResult:
+        result = SpeedResult(frequency)
+        with smbus2.SMBus(self.bus) as smbus:
+            # Restored afterwards, the sub-address is the only register written
+            saved = None
+            if _PCA9685_ADDRESS in self.devices:
+                saved = smbus.read_byte_data(_PCA9685_ADDRESS, _PCA9685_SUBADR1)
+
+            devices = list(self.devices.items())
+            start = time.perf_counter()
+            while time.perf_counter() - start < self.duration:
+                address, kind = devices[result.transactions % len(devices)]
+                try:
+                    if not self._transaction(smbus, address, kind, result.transactions):
+                        result.errors += 1
+                except OSError:
+                    result.errors += 1
+                result.transactions += 1
+            result.duration = time.perf_counter() - start
+
+            if saved is not None:
+                smbus.write_byte_data(_PCA9685_ADDRESS, _PCA9685_SUBADR1, saved)
+        return result
+
+    def max_frequency(self) -> int | None:
+        """Slowest datasheet limit of the identified devices"""
+        limits = [
+            DEVICE_MAX_FREQUENCY[kind]
+            for kind in self.devices.values()
+            if kind in DEVICE_MAX_FREQUENCY
+        ]
+        return min(limits) if limits else None
+
+    def run(self) -> list[SpeedResult]:
+        with smbus2.SMBus(self.bus) as smbus:
+            self.devices = self.identify(smbus)
+        if not self.devices:
+            logger.error(f"No devices answered on I2C bus {self.bus}")
+            return []
+        logger.info(
+            "Calibrating with "
+            + ", ".join(f"{kind} at 0x{address:x}" for address, kind in self.devices.items())
+        )
+
+        original = get_bus_frequency(self.bus)
+        limit = self.max_frequency()
+        results = []
+        try:
+            for frequency in self.frequencies:
+                if limit and frequency > limit:
+                    logger.info(
+                        f"Skipping {frequency / 1000:g}kHz, above the {limit / 1000:g}kHz device limit"
+                    )
+                    continue
+                if frequency != get_bus_frequency(self.bus):
+                    try:
+                        if not set_bus_frequency(self.bus, frequency):
+                            raise OSError("the bus did not come back at the new clock")
+                    except (OSError, subprocess.SubprocessError) as e:
+                        logger.warning(
+                            f"Can not switch the bus to {frequency / 1000:g}kHz, {repr(e)}"
+                        )
+                        results.append(SpeedResult(frequency, applied=False))
+                        continue
+                logger.info(f"Measuring at {frequency / 1000:g}kHz for {self.duration:g}s")
+                results.append(self.measure(frequency))
+        finally:
+            if original and get_bus_frequency(self.bus) != original:
+                try:
+                    set_bus_frequency(self.bus, original)
+                except (OSError, subprocess.SubprocessError) as e:
+                    logger.error(f"Could not restore the bus to {original}Hz, {repr(e)}")
+        return results
+
+
+def recommend(results: list[SpeedResult]) -> SpeedResult | None:
+    """Fastest measured clock without errors, only if every slower measured clock was error free too"""
+    best = None
+    for result in sorted(results, key=lambda result: result.frequency):
+        if not result.applied:
+            continue
+        if result.errors:
+            break
+        best = result
+    return best
+
+
+def report(results: list[SpeedResult], best: SpeedResult | None) -> list[str]:
+    lines = [f"{'clock':>10}{'transactions/s':>16}{'errors':>10}{'error rate':>12}"]
+    for result in results:
+        if not result.applied:
+            lines.append(f"{result.frequency / 1000:>8g}k{'not applied':>16}")
+            continue
+        lines.append(
+            f"{result.frequency / 1000:>8g}k{result.rate:>16.0f}"
+            f"{result.errors:>10}{result.error_rate:>12.2%}"
+        )
+
+    if best is None:
+        lines.append("No clock was error free, check the wiring, pull-ups and cable length")
+    else:
+        lines.append(
+            f"Recommended: {best.frequency / 1000:g}kHz, set i2c.frequency: {best.frequency} "
+            f"in config.yaml, or dtparam=i2c_arm_baudrate={best.frequency} in /boot/firmware/config.txt"
+        )
+    return lines
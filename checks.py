@@ -1,11 +1,13 @@
 from loguru import logger
 
+from mapping import mapping_errors
 from settings import Settings
 
 
 def run_sanity(settings: Settings):
     passing = True
-    if settings.sensor_count > settings.led_count:
+    # A mapping may drive any led from any sensor
+    if not settings.sensor_mapping and settings.sensor_count > settings.led_count:
         logger.critical(
             f"Led segments {settings.led_count} does "
             f"not match number of sensors "
@@ -17,6 +19,14 @@ def run_sanity(settings: Settings):
         logger.critical(f"Length of main led count ({settings.led_count}) plus extra leds ({settings.extra_led_count}) is over 16")
         passing = False
 
+    for error in mapping_errors(settings):
+        logger.critical(error)
+        passing = False
+
+    if settings.led_driver not in ("smbus2", "adafruit"):
+        logger.critical(f"Led driver {settings.led_driver} must be smbus2 or adafruit")
+        passing = False
+
     if passing:
         logger.success("All sanity checks passed")
     else:
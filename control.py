@@ -0,0 +1,110 @@
+"""
+AutoLight Local Control
+Newline-delimited JSON over a Unix domain socket, without the MQTT broker round trip
+
+Request: {"light": "main" | <extra light index>, "state": "ON", "brightness": 128, "effect": "Fade"}
+Every command field is optional, a request without any only reads the state.
+Response: {"ok": true, "light": "main", "state": "ON", "brightness": 128, "effect": "Fade"}
+or {"ok": false, "error": "..."}
+"""
+
+import errno
+import json
+import os
+import socket
+import socketserver
+import stat
+import sys
+import threading
+from typing import Callable
+
+from loguru import logger
+
+
+class _ControlHandler(socketserver.StreamRequestHandler):
+    server: "ControlServer"
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError("Request must be a JSON object")
+                response = self.server.request_handler(request)
+            except (ValueError, KeyError, IndexError, TypeError) as e:
+                response = {"ok": False, "error": repr(e)}
+
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+            self.wfile.flush()
+
+
+def _remove_stale_socket(socket_path: str):
+    """Unlink a socket left behind by an unclean shutdown, raise if it is anything else"""
+    try:
+        mode = os.lstat(socket_path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise OSError(errno.EEXIST, f"{socket_path} exists and is not a socket")
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(socket_path)
+        except FileNotFoundError:
+            return
+        except ConnectionRefusedError:
+            os.unlink(socket_path)
+            return
+    raise OSError(errno.EADDRINUSE, f"Another AutoLight instance is serving {socket_path}")
+
+
+class ControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Local control endpoint, each request is answered by request_handler"""
+
+    daemon_threads = True
+
+    def __init__(
+        self, socket_path: str, request_handler: Callable[[dict], dict]
+    ) -> None:
+        self.socket_path = socket_path
+        self.request_handler = request_handler
+
+        # Never take over the socket of a running instance
+        os.makedirs(os.path.dirname(socket_path) or ".", mode=0o750, exist_ok=True)
+        _remove_stale_socket(socket_path)
+
+        super().__init__(socket_path, _ControlHandler)
+        os.chmod(socket_path, 0o660)
+
+        self.thread = threading.Thread(
+            target=self.serve_forever, name="control", daemon=True
+        )
+
+    def start(self):
+        self.thread.start()
+        logger.info(f"Local control listening on {self.socket_path}")
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+
+def send_request(socket_path: str, request: dict) -> dict:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(request).encode() + b"\n")
+        with sock.makefile("rb") as f:
+            return json.loads(f.readline())
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print(f"Usage: {sys.argv[0]} <socket path> '<json request>'")
+        sys.exit(2)
+
+    print(json.dumps(send_request(sys.argv[1], json.loads(sys.argv[2]))))
@@ -1,6 +1,10 @@
+import json
+import os
 from dataclasses import dataclass
 from enum import Enum
 
+from loguru import logger
+
 
 class Animations(Enum):
     STEADY = 0
@@ -20,14 +24,14 @@ class ExtraEffects(Enum):
     SENSOR = 1
 
 
-@dataclass
+@dataclass(frozen=True)
 class LightingData:
     power: bool = True
     brightness: int = 255
     effect: Animations = Animations.WALKING
 
 
-@dataclass
+@dataclass(frozen=True)
 class ExtraLightData:
     power: bool = True
     brightness: int = 255
@@ -43,3 +47,61 @@ LIGHT_EFFECTS = {
 }
 
 EXTRA_LIGHT_EFFECTS = {"Steady": ExtraEffects.STEADY, "Sensor": ExtraEffects.SENSOR}
+
+
+def load_lighting_state(
+    path: str | None, extra_count: int
+) -> tuple[LightingData, list[ExtraLightData]]:
+    """Last known lighting state saved by save_lighting_state, or defaults"""
+    lighting_data = LightingData()
+    extra_lighting_data = [ExtraLightData() for _ in range(extra_count)]
+
+    if not path or not os.path.exists(path):
+        return lighting_data, extra_lighting_data
+
+    try:
+        with open(path) as f:
+            data = json.load(f)
+
+        lighting_data = LightingData(
+            power=data["light"]["power"],
+            brightness=data["light"]["brightness"],
+            effect=Animations[data["light"]["effect"]],
+        )
+        for index, extra in enumerate(data.get("extra", [])[:extra_count]):
+            extra_lighting_data[index] = ExtraLightData(
+                power=extra["power"],
+                brightness=extra["brightness"],
+                effect=ExtraEffects[extra["effect"]],
+            )
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        logger.warning(f"Ignoring unreadable lighting state {path}, {repr(e)}")
+
+    return lighting_data, extra_lighting_data
+
+
+def save_lighting_state(
+    path: str | None,
+    lighting_data: LightingData,
+    extra_lighting_data: list[ExtraLightData],
+):
+    if not path:
+        return
+
+    data = {
+        "light": {
+            "power": lighting_data.power,
+            "brightness": lighting_data.brightness,
+            "effect": lighting_data.effect.name,
+        },
+        "extra": [
+            {"power": extra.power, "brightness": extra.brightness, "effect": extra.effect.name}
+            for extra in extra_lighting_data
+        ],
+    }
+    try:
+        with open(path + ".tmp", "w") as f:
+            json.dump(data, f)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        logger.warning(f"Could not save lighting state to {path}, {repr(e)}")
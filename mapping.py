@@ -0,0 +1,63 @@
+"""
+AutoLight Sensor Mapping
+Which leds each sensor lights, and how bright, compiled into one matrix so a walking frame is
+a single matrix-vector product over the trip vector, whatever the staircase layout
+"""
+
+from settings import Settings
+
+
+def _pairs(entry: dict) -> list[tuple[object, object]]:
+    """(led, weight) pairs of one mapping entry, leds is a list sharing weight, or led: weight"""
+    leds = entry.get("leds", [])
+    if isinstance(leds, dict):
+        return list(leds.items())
+    if isinstance(leds, list):
+        return [(led, entry.get("weight", 1.0)) for led in leds]
+    return [(leds, entry.get("weight", 1.0))]
+
+
+def mapping_errors(settings: Settings) -> list[str]:
+    """Problems with the configured mapping, empty when it is usable"""
+    errors = []
+    for number, entry in enumerate(settings.sensor_mapping):
+        if not isinstance(entry, dict):
+            errors.append(f"Mapping entry {number} is not a mapping of sensor and leds")
+            continue
+        sensor = entry.get("sensor")
+        if not isinstance(sensor, int) or not 0 <= sensor < settings.sensor_count:
+            errors.append(
+                f"Mapping entry {number} sensor {sensor} is not one of the "
+                f"{settings.sensor_count} sensors"
+            )
+        for led, weight in _pairs(entry):
+            if not isinstance(led, int) or not 0 <= led < settings.led_count:
+                errors.append(
+                    f"Mapping entry {number} led {led} is not one of the {settings.led_count} leds"
+                )
+            if not isinstance(weight, (int, float)) or weight < 0:
+                errors.append(f"Mapping entry {number} weight {weight} is not a positive number")
+    return errors
+
+
+def compile_mapping(settings: Settings):
+    """led_count x sensor_count weights, from the mapping or else the walking activation radius
+
+    Without a mapping, sensor i lights leds i - radius to i + radius, like surround_list
+    """
+    # Imported here, only the animator needs numpy
+    import numpy as np
+
+    matrix = np.zeros((settings.led_count, settings.sensor_count), dtype=np.float32)
+    if settings.sensor_mapping:
+        for entry in settings.sensor_mapping:
+            for led, weight in _pairs(entry):
+                matrix[led, entry["sensor"]] += weight
+        return matrix
+
+    radius = settings.walking_activation_radius
+    for sensor in range(settings.sensor_count):
+        first = max(sensor - radius, 0)
+        last = min(sensor + radius, settings.sensor_count - 1, settings.led_count - 1)
+        matrix[first : last + 1, sensor] = 1.0
+    return matrix
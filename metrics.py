@@ -0,0 +1,267 @@
+"""
+AutoLight Metrics
+Low-cost counters for the hot loops, exposed as Prometheus text on a local HTTP endpoint
+"""
+
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
+
+from loguru import logger
+
+_get_ident = threading.get_ident
+
+
+def _format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
+
+
+class Counter:
+    """Monotonic counter
+
+    Every thread adds to its own cell, so increments need no lock and are never lost
+    """
+
+    kind = "counter"
+
+    def __init__(self, name: str, labels: dict[str, str]) -> None:
+        self.name = name
+        self.labels = labels
+        self._cells: dict[int, float] = {}
+
+    def inc(self, amount: float = 1):
+        ident = _get_ident()
+        cells = self._cells
+        cells[ident] = cells.get(ident, 0) + amount
+
+    @property
+    def value(self) -> float:
+        return sum(list(self._cells.values()))
+
+    def samples(self) -> list[tuple[str, dict[str, str], float]]:
+        return [(self.name, self.labels, self.value)]
+
+
+class Gauge:
+    """Value that is set, or read from a function when the metrics are rendered"""
+
+    kind = "gauge"
+
+    def __init__(
+        self, name: str, labels: dict[str, str], function: Callable[[], float] | None = None
+    ) -> None:
+        self.name = name
+        self.labels = labels
+        self.function = function
+        self._value = 0.0
+
+    def set(self, value: float):
+        self._value = value
+
+    @property
+    def value(self) -> float:
+        return self.function() if self.function else self._value
+
+    def samples(self) -> list[tuple[str, dict[str, str], float]]:
+        return [(self.name, self.labels, self.value)]
+
+
+class Summary:
+    """Count, sum and maximum of observed values, per-thread cells like Counter"""
+
+    kind = "summary"
+
+    def __init__(self, name: str, labels: dict[str, str]) -> None:
+        self.name = name
+        self.labels = labels
+        self._cells: dict[int, list[float]] = {}
+
+    def observe(self, value: float):
+        cell = self._cells.get(_get_ident())
+        if cell is None:
+            cell = self._cells[_get_ident()] = [0, 0.0, 0.0]
+        cell[0] += 1
+        cell[1] += value
+        if value > cell[2]:
+            cell[2] = value
+
+    def samples(self) -> list[tuple[str, dict[str, str], float]]:
+        cells = list(self._cells.values())
+        return [
+            (f"{self.name}_count", self.labels, sum(cell[0] for cell in cells)),
+            (f"{self.name}_sum", self.labels, sum(cell[1] for cell in cells)),
+            (f"{self.name}_max", self.labels, max((cell[2] for cell in cells), default=0.0)),
+        ]
+
+
+class FrameMeter:
+    """Frame counter, frame time summary and achieved fps gauge for one loop"""
+
+    def __init__(self, registry: "Registry", loop: str, window: float = 1.0) -> None:
+        self.frames = registry.counter(
+            "autolight_frames_total", "Frames completed per loop", loop=loop
+        )
+        self.frame_time = registry.summary(
+            "autolight_frame_seconds", "Time spent rendering each frame", loop=loop
+        )
+        self.fps = registry.gauge("autolight_fps", "Achieved frames per second", loop=loop)
+        self.window = window
+
+        self._window_start = time.perf_counter()
+        self._window_frames = 0
+
+    def frame(self, duration: float):
+        self.frames.inc()
+        self.frame_time.observe(duration)
+
+        self._window_frames += 1
+        now = time.perf_counter()
+        if now - self._window_start >= self.window:
+            self.fps.set(self._window_frames / (now - self._window_start))
+            self._window_start = now
+            self._window_frames = 0
+
+
+class Registry:
+    """All metrics of the process, rendered in the Prometheus text format"""
+
+    def __init__(self) -> None:
+        self._metrics: dict[tuple[str, tuple], Counter | Gauge | Summary] = {}
+        self._help: dict[str, tuple[str, str]] = {}
+        self._collectors: list[Callable[[], list[tuple[str, str, str, dict[str, str], float]]]] = []
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name: str, help: str, labels: dict[str, str], **kwargs):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            metric = self._metrics.get(key)
+            if metric is None:
+                metric = self._metrics[key] = cls(name, labels, **kwargs)
+                self._help.setdefault(name, (cls.kind, help))
+            return metric
+
+    def counter(self, name: str, help: str = "", **labels: str) -> Counter:
+        return self._get(Counter, name, help, labels)
+
+    def gauge(
+        self,
+        name: str,
+        help: str = "",
+        function: Callable[[], float] | None = None,
+        **labels: str,
+    ) -> Gauge:
+        return self._get(Gauge, name, help, labels, function=function)
+
+    def summary(self, name: str, help: str = "", **labels: str) -> Summary:
+        return self._get(Summary, name, help, labels)
+
+    def metrics(self) -> list[Counter | Gauge | Summary]:
+        with self._lock:
+            return list(self._metrics.values())
+
+    def frame_meter(self, loop: str) -> FrameMeter:
+        return FrameMeter(self, loop)
+
+    def add_collector(
+        self, collector: Callable[[], list[tuple[str, str, str, dict[str, str], float]]]
+    ):
+        """Add a function returning (name, kind, help, labels, value) samples at render time"""
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        families: dict[str, list[str]] = {}
+        with self._lock:
+            metrics = list(self._metrics.values())
+            help_texts = dict(self._help)
+
+        for metric in metrics:
+            lines = families.setdefault(metric.name, [])
+            for sample_name, labels, value in metric.samples():
+                lines.append(f"{sample_name}{_format_labels(labels)} {value}")
+
+        for collector in list(self._collectors):
+            try:
+                samples = collector()
+            except Exception as e:
+                logger.warning(f"Metrics collector {collector} failed, {repr(e)}")
+                continue
+            for name, kind, help, labels, value in samples:
+                help_texts.setdefault(name, (kind, help))
+                families.setdefault(name, []).append(
+                    f"{name}{_format_labels(labels)} {value}"
+                )
+
+        output = []
+        for name, lines in families.items():
+            kind, help = help_texts.get(name, ("untyped", ""))
+            if help:
+                output.append(f"# HELP {name} {help}")
+            output.append(f"# TYPE {name} {kind}")
+            output.extend(lines)
+        return "\n".join(output) + "\n"
+
+
+def thread_cpu_samples() -> list[tuple[str, str, str, dict[str, str], float]]:
+    """CPU time used by each live thread"""
+    samples = []
+    for thread in threading.enumerate():
+        try:
+            clock = time.pthread_getcpuclockid(thread.ident)
+            seconds = time.clock_gettime(clock)
+        except (AttributeError, OSError, TypeError):
+            continue  # Thread exited, or not supported on this platform
+        samples.append(
+            (
+                "autolight_thread_cpu_seconds_total",
+                "counter",
+                "CPU time used by each thread",
+                {"thread": thread.name},
+                seconds,
+            )
+        )
+    return samples
+
+
+REGISTRY = Registry()
+REGISTRY.add_collector(thread_cpu_samples)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    server: "MetricsServer"
+
+    def do_GET(self):
+        if self.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+
+        body = self.server.registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes are not worth a log line
+
+
+class MetricsServer(ThreadingHTTPServer):
+    """Serves the registry at http://host:port/metrics"""
+
+    daemon_threads = True
+
+    def __init__(self, host: str, port: int, registry: Registry = REGISTRY) -> None:
+        self.registry = registry
+        super().__init__((host, port), _MetricsHandler)
+        self.thread = threading.Thread(
+            target=self.serve_forever, name="metrics", daemon=True
+        )
+
+    def start(self):
+        self.thread.start()
+        logger.info(
+            f"Metrics available at http://{self.server_address[0]}:{self.server_address[1]}/metrics"
+        )
@@ -0,0 +1,148 @@
+"""
+AutoLight Profiler
+Low-overhead sampling profiler for every thread, with collapsed-stack output for flamegraph tools
+"""
+
+import _thread
+import atexit
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from loguru import logger
+
+from metrics import REGISTRY
+
+
+def _frame_name(code) -> str:
+    module = os.path.splitext(os.path.basename(code.co_filename))[0]
+    return f"{module}:{getattr(code, 'co_qualname', code.co_name)}"
+
+
+class SamplingProfiler:
+    """Sample the stacks of all threads at a fixed interval for a fixed window"""
+
+    def __init__(
+        self,
+        duration: float = 30.0,
+        output_path: str = "autolight-profile.collapsed",
+        interval: float = 0.005,
+        exit_when_done: bool = True,
+    ) -> None:
+        self.duration = duration
+        self.output_path = output_path
+        self.interval = interval
+        self.exit_when_done = exit_when_done
+
+        self.stacks: Counter[str] = Counter()
+        self.self_samples: Counter[str] = Counter()
+        self.total_samples: Counter[str] = Counter()
+        self.sample_count = 0
+
+        self._start_time: float | None = None
+        self._finished = False
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def start(self):
+        self._start_time = time.perf_counter()
+        atexit.register(self.finish)
+        self._thread.start()
+        logger.info(f"Profiling all threads for {self.duration}s")
+
+    def _sample(self, own_ident: int, thread_names: dict[int, str]):
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+
+            names = []
+            while frame is not None:
+                names.append(_frame_name(frame.f_code))
+                frame = frame.f_back
+            names.reverse()
+
+            thread_name = thread_names.get(ident, f"thread-{ident}")
+            self.stacks[";".join([thread_name, *names])] += 1
+            if names:
+                self.self_samples[names[-1]] += 1
+                for name in set(names):
+                    self.total_samples[name] += 1
+        self.sample_count += 1
+
+    def _run(self):
+        own_ident = threading.get_ident()
+        thread_names: dict[int, str] = {}
+        names_refreshed = 0.0
+
+        end_time = self._start_time + self.duration
+        next_sample = time.perf_counter()
+        while not self._finished:
+            now = time.perf_counter()
+            if now >= end_time:
+                break
+
+            # threading.enumerate() is comparatively slow, refresh names once a second
+            if now - names_refreshed > 1:
+                thread_names = {t.ident: t.name for t in threading.enumerate()}
+                names_refreshed = now
+
+            with self._lock:
+                self._sample(own_ident, thread_names)
+
+            next_sample += self.interval
+            time.sleep(max(0.0, next_sample - time.perf_counter()))
+
+        self.finish()
+        if self.exit_when_done:
+            _thread.interrupt_main()
+
+    def write_collapsed(self, path: str):
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+    def summary(self, top: int = 15) -> list[str]:
+        elapsed = time.perf_counter() - self._start_time
+        lines = [f"Profiled {self.sample_count} samples over {elapsed:.1f}s", ""]
+
+        # Render stages, from the frame meters of each loop
+        lines.append(f"{'stage':<16}{'frames':>8}{'fps':>8}{'mean ms':>10}{'max ms':>10}")
+        frame_times = {}
+        fps = {}
+        for metric in REGISTRY.metrics():
+            if metric.name == "autolight_frame_seconds":
+                frame_times[metric.labels["loop"]] = metric.samples()
+            elif metric.name == "autolight_fps":
+                fps[metric.labels["loop"]] = metric.value
+        for loop, (count, total, maximum) in sorted(frame_times.items()):
+            frames = count[2]
+            mean = total[2] / frames * 1000 if frames else 0.0
+            lines.append(
+                f"{loop:<16}{frames:>8.0f}{fps.get(loop, 0.0):>8.1f}{mean:>10.3f}{maximum[2] * 1000:>10.3f}"
+            )
+
+        # Hottest functions
+        samples = max(self.sample_count, 1)
+        lines += ["", f"{'self %':>7}{'total %':>9}  function"]
+        for name, count in self.self_samples.most_common(top):
+            lines.append(
+                f"{count / samples * 100:>7.1f}{self.total_samples[name] / samples * 100:>9.1f}  {name}"
+            )
+        return lines
+
+    def finish(self):
+        with self._lock:
+            if self._finished:
+                return
+            self._finished = True
+
+        try:
+            self.write_collapsed(self.output_path)
+            logger.info(f"Collapsed stacks written to {self.output_path}")
+        except OSError as e:
+            logger.error(f"Could not write profile to {self.output_path}, {repr(e)}")
+
+        for line in self.summary():
+            logger.info(line)
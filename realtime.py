@@ -0,0 +1,141 @@
+"""
+AutoLight Real-time Mode
+SCHED_FIFO priority and CPU pinning for the render thread, locked memory and a frozen GC,
+with frame jitter measured before and after so the effect is visible
+"""
+
+import ctypes
+import ctypes.util
+import gc
+import os
+import threading
+import time
+from array import array
+
+from loguru import logger
+
+from settings import Settings
+
+_MCL_CURRENT = 1
+_MCL_FUTURE = 2
+
+
+class JitterMeter:
+    """Intervals between frame starts, in a preallocated ring so recording never allocates"""
+
+    def __init__(self, size: int = 4096) -> None:
+        self.size = size
+        self._intervals = array("d", [0.0]) * size
+        self._count = 0
+        self._last = 0.0
+
+    def record(self, now: float):
+        if self._last:
+            self._intervals[self._count % self.size] = now - self._last
+            self._count += 1
+        self._last = now
+
+    def stats(self) -> dict[str, float]:
+        """Mean interval, and the deviation of intervals from it, in milliseconds"""
+        intervals = sorted(self._intervals[: min(self._count, self.size)])
+        if not intervals:
+            return {"frames": 0, "mean": 0.0, "stdev": 0.0, "p99": 0.0, "max": 0.0}
+
+        mean = sum(intervals) / len(intervals)
+        deviations = sorted(abs(interval - mean) for interval in intervals)
+        variance = sum(deviation**2 for deviation in deviations) / len(deviations)
+        return {
+            "frames": len(intervals),
+            "mean": mean * 1000,
+            "stdev": variance**0.5 * 1000,
+            "p99": deviations[int((len(deviations) - 1) * 0.99)] * 1000,
+            "max": deviations[-1] * 1000,
+        }
+
+
+def set_thread_realtime(priority: int, cpu: int | None):
+    """SCHED_FIFO and CPU affinity for the calling thread (Linux applies both per thread)"""
+    if cpu is not None:
+        try:
+            os.sched_setaffinity(0, {cpu})
+            logger.info(f"Render thread pinned to CPU {cpu}")
+        except (OSError, AttributeError) as e:
+            logger.warning(f"Could not pin the render thread to CPU {cpu}, {repr(e)}")
+
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+        logger.info(f"Render thread running as SCHED_FIFO priority {priority}")
+    except PermissionError:
+        logger.warning(
+            "SCHED_FIFO needs root or CAP_SYS_NICE, the render thread keeps normal scheduling"
+        )
+    except (OSError, AttributeError) as e:
+        logger.warning(f"Could not set SCHED_FIFO, {repr(e)}")
+
+
+def lock_memory() -> bool:
+    """Keep every current and future page resident, so the render thread never page-faults"""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        if libc.mlockall(_MCL_CURRENT | _MCL_FUTURE) == 0:
+            logger.info("Memory locked")
+            return True
+        error = ctypes.get_errno()
+    except (OSError, AttributeError) as e:
+        logger.warning(f"Could not lock memory, {repr(e)}")
+        return False
+
+    logger.warning(
+        f"Could not lock memory, {os.strerror(error)} "
+        f"(needs root, CAP_IPC_LOCK or a higher RLIMIT_MEMLOCK)"
+    )
+    return False
+
+
+class RealtimeTuner:
+    """Measure render jitter, switch the render thread to real-time, measure again"""
+
+    def __init__(self, settings: Settings, led_array) -> None:
+        self.settings = settings
+        self.led_array = led_array
+        self.thread = threading.Thread(target=self._run, name="realtime", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def _measure(self, label: str) -> dict[str, float]:
+        jitter = JitterMeter()
+        self.led_array.jitter = jitter
+        time.sleep(self.settings.realtime_measure_seconds)
+        self.led_array.jitter = None
+
+        stats = jitter.stats()
+        logger.info(
+            f"Render jitter {label}: {stats['frames']:.0f} frames, "
+            f"interval {stats['mean']:.3f}ms, stdev {stats['stdev']:.3f}ms, "
+            f"p99 {stats['p99']:.3f}ms, max {stats['max']:.3f}ms"
+        )
+        return stats
+
+    def _run(self):
+        measure = self.settings.realtime_measure_seconds > 0
+        if measure:
+            self._measure("before real-time mode")
+
+        self.led_array.call_in_loop(
+            lambda: set_thread_realtime(
+                self.settings.realtime_priority, self.settings.realtime_cpu
+            )
+        )
+
+        if self.settings.realtime_lock_memory:
+            lock_memory()
+
+        if self.settings.realtime_gc_freeze:
+            # Everything allocated during startup is never scanned by the GC again
+            gc.collect()
+            gc.freeze()
+            logger.info(f"GC frozen with {gc.get_freeze_count()} objects")
+
+        if measure:
+            self._measure("in real-time mode")
@@ -0,0 +1,280 @@
+"""
+AutoLight Session Recorder
+Records every input of a running installation to one file, and replays it through the
+real animator and led pipeline on simulated hardware, to reproduce stutters on a workstation
+
+Session files are JSON lines, each with a "t" wall clock timestamp and a "type":
+    config   the whole configuration, first in every file and again after every reload
+    light    a main light command payload
+    extra    an extra light command payload, with its "index"
+             both with "source": "control" when the command came from the local control API
+    sensor   a sensor trip edge or distance change, with "index", "tripped" and "distance"
+"""
+
+import copy
+import json
+import os
+import statistics
+import tempfile
+import threading
+import time
+from array import array
+from dataclasses import dataclass, field
+
+import yaml
+from loguru import logger
+
+SESSION_VERSION = 1
+
+
+def _redact(config: dict) -> dict:
+    """Config without broker credentials, session files are meant to be shared"""
+    config = copy.deepcopy(config)
+    mqtt = (config.get("home_assistant") or {}).get("mqtt") or {}
+    for key in ("username", "password"):
+        if key in mqtt:
+            mqtt[key] = "<redacted>"
+    return config
+
+
+class SessionRecorder:
+    """Appends inputs to a session file as they arrive, safe to call from any thread"""
+
+    def __init__(self, path: str, config: dict, distance_delta: float = 10.0) -> None:
+        self.path = path
+        self.distance_delta = distance_delta
+        self._file = open(path, "w", buffering=1)
+        self._lock = threading.Lock()
+        self._trips: list[bool | None] = []
+        self._distances: list[float | None] = []
+        self.config(config)
+        logger.info(f"Recording the session to {path}")
+
+    def _write(self, record: dict):
+        line = json.dumps(record, separators=(",", ":"))
+        with self._lock:
+            if not self._file.closed:
+                self._file.write(line + "\n")
+
+    def config(self, config: dict):
+        self._write(
+            {
+                "t": time.time(),
+                "type": "config",
+                "version": SESSION_VERSION,
+                "config": _redact(config),
+            }
+        )
+
+    def command(self, payload: bytes, index: int | None = None, control: bool = False):
+        """Raw light command, index is None for the main light, control for local control requests"""
+        record = {
+            "t": time.time(),
+            "type": "light" if index is None else "extra",
+            "payload": payload.decode("utf-8", "replace"),
+        }
+        if index is not None:
+            record["index"] = index
+        if control:
+            record["source"] = "control"
+        self._write(record)
+
+    def sensors(self, trips: list[bool], distances: list[float | None]):
+        """Record the sensors whose trip changed, or whose distance moved by distance_delta"""
+        if len(self._trips) != len(trips):
+            self._trips = [None] * len(trips)
+            self._distances = [None] * len(trips)
+
+        now = time.time()
+        for index, (tripped, distance) in enumerate(zip(trips, distances)):
+            last = self._distances[index]
+            moved = distance is not None and (
+                last is None or abs(distance - last) >= self.distance_delta
+            )
+            if tripped == self._trips[index] and not moved:
+                continue
+            self._trips[index] = tripped
+            if distance is not None:
+                self._distances[index] = distance
+            self._write(
+                {
+                    "t": now,
+                    "type": "sensor",
+                    "index": index,
+                    "tripped": bool(tripped),
+                    "distance": distance,
+                }
+            )
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def load_session(path: str) -> list[dict]:
+    """Every record of a session file, in time order"""
+    with open(path) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    if not records or records[0].get("type") != "config":
+        raise ValueError(f"{path} is not an AutoLight session, it does not start with a config")
+    if records[0].get("version") != SESSION_VERSION:
+        raise ValueError(f"{path} has session version {records[0].get('version')}")
+    return sorted(records, key=lambda record: record["t"])
+
+
+def _replay_config(config: dict) -> dict:
+    """Recorded config, without the features that write files or start processes"""
+    config = copy.deepcopy(config)
+    config.setdefault("misc", {})["state_file"] = ""
+    config.setdefault("misc", {})["hot_reload"] = False
+    config.setdefault("frame_buffer", {})["enabled"] = False
+    config.setdefault("renderer", {})["process"] = False
+    return config
+
+
+def _percentile(values: list[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[int((len(ordered) - 1) * fraction)] if ordered else 0.0
+
+
+@dataclass
+class ReplayReport:
+    duration: float = 0.0
+    wall_time: float = 0.0
+    events: dict[str, int] = field(default_factory=dict)
+    frame_costs: list[float] = field(default_factory=list)
+    event_costs: list[float] = field(default_factory=list)
+    output_frames: int = 0
+    latencies: list[float] = field(default_factory=list)
+    no_output: int = 0
+
+    def summary(self) -> list[str]:
+        def row(name: str, values: list[float], scale: float) -> str:
+            return f"{name:<22}" + "".join(
+                f"{value * scale:>10.1f}"
+                for value in (
+                    min(values),
+                    statistics.median(values),
+                    _percentile(values, 0.99),
+                    max(values),
+                )
+            )
+
+        lines = [
+            f"Replayed {self.duration:.1f}s of session in {self.wall_time:.2f}s "
+            f"({', '.join(f'{count} {kind}' for kind, count in self.events.items())})",
+            f"{'':<22}{'min':>10}{'median':>10}{'p99':>10}{'max':>10}",
+        ]
+        if self.frame_costs:
+            lines.append(row("frame cost (us)", self.frame_costs, 1e6))
+        if self.event_costs:
+            lines.append(row("input cost (us)", self.event_costs, 1e6))
+        if self.latencies:
+            lines.append(row("input to output (ms)", self.latencies, 1e3))
+        lines.append(
+            f"{len(self.frame_costs)} frames rendered, {self.output_frames} changed the output, "
+            f"{self.no_output} inputs changed nothing"
+        )
+        return lines
+
+
+def replay_session(path: str, tail: float = 1.0) -> ReplayReport:
+    """Feed a session through Main.simulated on a virtual clock, one led frame at a time
+
+    Latency is simulated time from an input to the first frame with different duty cycles,
+    costs are real time
+    """
+    # Imported here, so recording never loads the simulated hardware
+    from app import Main
+    from settings import Settings
+    from utils import VirtualClock
+
+    records = load_session(path)
+    report = ReplayReport()
+
+    with tempfile.TemporaryDirectory(prefix="autolight-replay-") as directory:
+        config_file = os.path.join(directory, "config.yaml")
+        with open(config_file, "w") as f:
+            yaml.safe_dump(_replay_config(records[0]["config"]), f)
+
+        clock = VirtualClock(records[0]["t"])
+        main = Main.simulated(Settings(config_file), clock)
+        client = main.mqtt.client
+        light_topic = main.ha_light._command_topic
+        extra_topics = [light._command_topic for light in main.ha_extra_lights]
+        trips = [False] * len(main.sensors)
+        distances: list[float | None] = [None] * len(main.sensors)
+
+        end = records[-1]["t"] + tail
+        previous = array("H", main.led_array.duty_cycles)
+        pending: list[float] = []
+        index = 1
+        wall_start = time.perf_counter()
+
+        while clock.time() <= end:
+            now = clock.time()
+            if index < len(records) and records[index]["t"] <= now:
+                # Inputs from an earlier frame that never showed up in the output
+                report.no_output += len(pending)
+                pending.clear()
+
+            while index < len(records) and records[index]["t"] <= now:
+                record = records[index]
+                index += 1
+                kind = record["type"]
+                report.events[kind] = report.events.get(kind, 0) + 1
+
+                event_start = time.perf_counter()
+                if kind in ("light", "extra") and record.get("source") == "control":
+                    try:
+                        main.control_request(json.loads(record["payload"]))
+                    except (ValueError, KeyError, IndexError, TypeError) as e:
+                        logger.warning(f"Invalid control request {record['payload']}, {repr(e)}")
+                elif kind == "light":
+                    client.deliver(light_topic, record["payload"].encode())
+                elif kind == "extra":
+                    client.deliver(extra_topics[record["index"]], record["payload"].encode())
+                elif kind == "sensor":
+                    main.sensors[record["index"]].set_reading(
+                        record["tripped"], record["distance"]
+                    )
+                    main.poll_sensors(trips, distances)
+                elif kind == "config":
+                    with open(config_file, "w") as f:
+                        yaml.safe_dump(_replay_config(record["config"]), f)
+                    main.reload_settings()
+                else:
+                    logger.warning(f"Skipping unknown session record {kind}")
+                    continue
+                report.event_costs.append(time.perf_counter() - event_start)
+                pending.append(record["t"])
+
+            snapshot = main.state.snapshot
+            frame_start = time.perf_counter()
+            main.animator.animate_frame(snapshot.lighting, snapshot.sensor_trips)
+            main.extra_timers.run_expired(now)
+            for light_index, light in enumerate(main.extra_lights):
+                light.animation_cycle(snapshot.extras[light_index])
+            main.led_array.render_frame(now)
+            report.frame_costs.append(time.perf_counter() - frame_start)
+
+            if main.led_array.duty_cycles != previous:
+                previous = array("H", main.led_array.duty_cycles)
+                report.output_frames += 1
+                report.latencies += [now - t for t in pending]
+                pending.clear()
+
+            clock.sleep(
+                1
+                / (
+                    main.settings.led_fps_on
+                    if snapshot.lighting.power
+                    else main.settings.led_fps_off
+                )
+            )
+
+        report.no_output += len(pending)
+        report.duration = end - records[0]["t"]
+        report.wall_time = time.perf_counter() - wall_start
+
+    return report
@@ -0,0 +1,367 @@
+"""
+AutoLight Renderer Process
+Runs the animator and PCA9685 writes in their own process, away from the GIL of the
+MQTT, sensor and logging threads, fed through a shared-memory state channel
+
+Channel layout, little endian:
+    0   4s   magic b"ALRC"
+    4   u16  layout version
+    6   u16  extra light count
+    8   u16  sensor count
+    12  u32  CRC-32 of the state
+    16  u64  sequence, odd while the state is being written
+    24  u64  state version
+    32  4B   main light: power u8, effect u8, brightness u16
+    36  4B   per extra light, same as the main light
+    ..  u8   trip state per sensor
+    ..  u64  heartbeat, 8 byte aligned, counted up by the renderer for every written frame
+    ..  u32  renderer pid
+
+The renderer checks the CRC as well as the sequence, plain mmap stores are not ordered
+between the Pi's ARM cores
+"""
+
+import mmap
+import os
+import signal
+import struct
+import sys
+import threading
+import time
+import zlib
+
+from loguru import logger
+
+from data_types import Animations, ExtraEffects, ExtraLightData, LightingData
+from metrics import REGISTRY
+from state import StateSnapshot
+
+MAGIC = b"ALRC"
+LAYOUT_VERSION = 2
+
+_HEADER = struct.Struct("<4sHHH")
+_CHECKSUM = struct.Struct("<I")
+_SEQUENCE = struct.Struct("<Q")
+_LIGHT = struct.Struct("<BBH")
+_HEARTBEAT = struct.Struct("<QI")
+_CHECKSUM_OFFSET = 12
+_SEQUENCE_OFFSET = 16
+_STATE_OFFSET = 24
+_READ_ATTEMPTS = 100
+
+
+def _offsets(extra_count: int, sensor_count: int) -> tuple[int, int]:
+    """Offset of the heartbeat, and the total size"""
+    trips = _STATE_OFFSET + 8 + _LIGHT.size * (1 + extra_count)
+    heartbeat = (trips + sensor_count + 7) & ~7
+    return heartbeat, heartbeat + _HEARTBEAT.size
+
+
+class RenderChannel:
+    """Lighting state from the main process to the renderer, heartbeats back
+
+    The main process is the only state writer (a seqlock), the renderer the only
+    heartbeat writer, so neither side ever waits on the other
+    """
+
+    def __init__(
+        self, path: str, extra_count: int = 0, sensor_count: int = 0, create: bool = False
+    ) -> None:
+        self.path = path
+
+        if create:
+            heartbeat_offset, size = _offsets(extra_count, sensor_count)
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+            try:
+                os.ftruncate(fd, size)
+                self._map = mmap.mmap(fd, size)
+            finally:
+                os.close(fd)
+            _HEADER.pack_into(self._map, 0, MAGIC, LAYOUT_VERSION, extra_count, sensor_count)
+        else:
+            fd = os.open(path, os.O_RDWR)
+            try:
+                self._map = mmap.mmap(fd, 0)
+            finally:
+                os.close(fd)
+            magic, version, extra_count, sensor_count = _HEADER.unpack_from(self._map, 0)
+            if magic != MAGIC or version != LAYOUT_VERSION:
+                raise ValueError(f"{path} is not an AutoLight render channel (layout {version})")
+            heartbeat_offset, _ = _offsets(extra_count, sensor_count)
+
+        self.extra_count = extra_count
+        self.sensor_count = sensor_count
+        self._heartbeat_offset = heartbeat_offset
+        self._state = struct.Struct(
+            f"<Q{'BBH' * (1 + extra_count)}{sensor_count}B"
+        )
+        self._sequence = _SEQUENCE.unpack_from(self._map, _SEQUENCE_OFFSET)[0]
+        self._heartbeat = 0
+
+    # Main process side
+
+    def write_state(self, snapshot: StateSnapshot):
+        values = [snapshot.version]
+        for light in (snapshot.lighting, *snapshot.extras):
+            values += (light.power, light.effect.value, light.brightness)
+        values += snapshot.sensor_trips
+
+        self._sequence += 1
+        _SEQUENCE.pack_into(self._map, _SEQUENCE_OFFSET, self._sequence)
+        self._state.pack_into(self._map, _STATE_OFFSET, *values)
+        _CHECKSUM.pack_into(
+            self._map,
+            _CHECKSUM_OFFSET,
+            zlib.crc32(self._map[_STATE_OFFSET : _STATE_OFFSET + self._state.size]),
+        )
+        self._sequence += 1
+        _SEQUENCE.pack_into(self._map, _SEQUENCE_OFFSET, self._sequence)
+
+    def read_heartbeat(self) -> tuple[int, int]:
+        """Heartbeat count and pid of the renderer"""
+        return _HEARTBEAT.unpack_from(self._map, self._heartbeat_offset)
+
+    # Renderer side
+
+    def read_state(self) -> StateSnapshot | None:
+        """Latest consistent state, None before the first write
+
+        Also None when no consistent read succeeds in a few attempts, such as when the
+        main process died halfway through a write, so the caller keeps its last state
+        """
+        for _ in range(_READ_ATTEMPTS):
+            (before,) = _SEQUENCE.unpack_from(self._map, _SEQUENCE_OFFSET)
+            if before & 1:
+                continue
+            (checksum,) = _CHECKSUM.unpack_from(self._map, _CHECKSUM_OFFSET)
+            state = self._map[_STATE_OFFSET : _STATE_OFFSET + self._state.size]
+            (after,) = _SEQUENCE.unpack_from(self._map, _SEQUENCE_OFFSET)
+            if before == after and (before == 0 or zlib.crc32(state) == checksum):
+                values = self._state.unpack(state)
+                break
+        else:
+            return None
+        if before == 0:
+            return None
+
+        lighting = LightingData(bool(values[1]), values[3], Animations(values[2]))
+        extras = tuple(
+            ExtraLightData(
+                bool(values[4 + 3 * index]),
+                values[6 + 3 * index],
+                ExtraEffects(values[5 + 3 * index]),
+            )
+            for index in range(self.extra_count)
+        )
+        trips_start = 4 + 3 * self.extra_count
+        return StateSnapshot(
+            values[0], lighting, extras, tuple(bool(trip) for trip in values[trips_start:])
+        )
+
+    def beat(self):
+        self._heartbeat += 1
+        _HEARTBEAT.pack_into(self._map, self._heartbeat_offset, self._heartbeat, os.getpid())
+
+    def close(self, unlink: bool = False):
+        self._map.close()
+        if unlink and os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def run_renderer(config_file: str, channel_path: str, log_level: str | int):
+    """Renderer process entry point, owns the PCA9685, the animator and the extra lights"""
+    # Imported here, so only the renderer process touches the led hardware
+    from animator import Animator
+    from settings import ConfigWatcher, LIVE_SETTINGS, Settings
+    from subsystems.framebuffer import FrameBufferWriter
+    from subsystems.leds import LedSettings, PCA9685ExtraChannel, PCA9685LedArray
+    from subsystems.sensors import GPIOSensor, NullSensor
+    from utils import TimerHeap
+
+    settings = Settings(config_file)
+
+    logger.remove()
+    logger.add(sys.stderr, level=log_level)
+    if settings.log_to_file:
+        logger.add(settings.log_file_path, level=log_level)
+
+    # SIGTERM from the watchdog or shutdown still runs atexit, which blanks the leds
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    channel = RenderChannel(channel_path)
+    parent = os.getppid()
+
+    led_array = PCA9685LedArray(
+        LedSettings(
+            led_count=settings.led_count,
+            freq=settings.led_freq,
+            fps=settings.led_fps_on,
+            driver=settings.led_driver,
+            i2c_bus=settings.led_i2c_bus,
+        )
+    )
+    if settings.frame_buffer_enabled:
+        led_array.frame_buffer = FrameBufferWriter(
+            settings.frame_buffer_path, len(led_array.duty_cycles), settings.sensor_count
+        )
+    animator = Animator(settings, led_array)
+
+    extra_timers = TimerHeap()
+    extra_lights = []
+    for extra in settings.extra_led_settings:
+        sensor_setting = extra.get("sensor") or {}
+        if sensor_setting.get("type") == "gpio":
+            sensor = GPIOSensor(
+                sensor_setting.get("pin"),
+                sensor_setting.get("invert", False),
+                sensor_setting.get("pullup", False),
+                sensor_setting.get("bounce_time", 0),
+            )
+        else:
+            sensor = NullSensor()
+        extra_lights.append(
+            PCA9685ExtraChannel(
+                led_array,
+                extra.get("channel"),
+                sensor,
+                extra.get("hold", 0.0),
+                extra.get("fade_out", 0.0),
+                extra_timers,
+            )
+        )
+
+    def reload_settings():
+        new_settings = Settings(config_file)
+        live = [name for name in settings.changes(new_settings) if name in LIVE_SETTINGS]
+        settings.update(new_settings, live)
+        led_array.set_fps(settings.led_fps_on)
+        led_array.set_freq(settings.led_freq)
+
+    if settings.hot_reload:
+        ConfigWatcher(config_file, reload_settings).start()
+
+    threading.Thread(target=led_array.update_loop, name="leds", daemon=True).start()
+    logger.info(f"Renderer process {os.getpid()} started")
+
+    if settings.realtime_enabled:
+        from realtime import RealtimeTuner
+
+        RealtimeTuner(settings, led_array).start()
+
+    no_distances = [None] * settings.sensor_count
+    snapshot = None
+    frames = 0
+    while os.getppid() == parent:  # Never outlive the main process
+        snapshot = channel.read_state() or snapshot
+        power = snapshot.lighting.power if snapshot else True
+        time.sleep(1 / (settings.led_fps_on if power else settings.led_fps_off))
+        if snapshot is None:
+            continue
+
+        animator.animate_frame(snapshot.lighting, snapshot.sensor_trips)
+        extra_timers.run_expired(led_array.clock.time())
+        for index, light in enumerate(extra_lights):
+            light.animation_cycle(snapshot.extras[index])
+        if led_array.frame_buffer:
+            led_array.frame_buffer.update_sensors(snapshot.sensor_trips, no_distances)
+        # Only frames the leds thread wrote count, so a dead or stuck I2C thread stops the beats
+        if led_array.frames != frames:
+            frames = led_array.frames
+            channel.beat()
+
+    logger.warning("Main process is gone, renderer exiting")
+
+
+class RendererProcess:
+    """Starts the renderer process, feeds it every state change and respawns it when it stops beating"""
+
+    def __init__(
+        self,
+        settings,
+        log_level: str | int,
+        channel_path: str,
+        heartbeat_timeout: float = 2.0,
+    ) -> None:
+        import multiprocessing
+
+        self.settings = settings
+        self.log_level = log_level
+        self.heartbeat_timeout = heartbeat_timeout
+        # Never fork a process already running MQTT and logging threads
+        self._context = multiprocessing.get_context("spawn")
+        self.channel = RenderChannel(
+            channel_path, settings.extra_led_count, settings.sensor_count, create=True
+        )
+        self.process = None
+        self._stopped = threading.Event()
+        self._watchdog = threading.Thread(
+            target=self._watch, name="renderer_watchdog", daemon=True
+        )
+        self.restarts = REGISTRY.counter(
+            "autolight_renderer_restarts_total", "Renderer process respawns by the watchdog"
+        )
+
+    def _spawn(self):
+        self.process = self._context.Process(
+            target=run_renderer,
+            args=(self.settings.config_file, self.channel.path, self.log_level),
+            name="renderer",
+            daemon=True,
+        )
+        self.process.start()
+
+    def start(self):
+        """Spawn the renderer, on_state_change must have written the first state"""
+        self._spawn()
+        self._watchdog.start()
+
+    def on_state_change(self, old: StateSnapshot, new: StateSnapshot):
+        """StateStore listener, called in version order"""
+        self.channel.write_state(new)
+
+    def _watch(self):
+        backoff = 1.0
+        last_beat, _ = self.channel.read_heartbeat()
+        last_progress = time.monotonic()
+        # A new process needs time to import, and to bring up the PCA9685
+        grace = 15.0
+
+        while not self._stopped.wait(0.5):
+            beat, pid = self.channel.read_heartbeat()
+            now = time.monotonic()
+            if beat != last_beat and pid == self.process.pid:
+                last_beat, last_progress, grace = beat, now, 0.0
+                backoff = 1.0
+                continue
+
+            alive = self.process.is_alive()
+            if alive and now - last_progress < self.heartbeat_timeout + grace:
+                continue
+
+            if alive:
+                logger.error(
+                    f"Renderer process {self.process.pid} stopped responding, restarting it"
+                )
+                self.process.terminate()
+                self.process.join(2)
+                if self.process.is_alive():
+                    self.process.kill()
+            else:
+                logger.error(
+                    f"Renderer process exited with code {self.process.exitcode}, restarting it"
+                )
+            self.process.join()
+
+            if self._stopped.wait(backoff):
+                return
+            backoff = min(backoff * 2, 30.0)
+            self.restarts.inc()
+            self._spawn()
+            last_progress, grace = time.monotonic(), 15.0
+
+    def stop(self):
+        self._stopped.set()
+        if self.process and self.process.is_alive():
+            self.process.terminate()
+            self.process.join(2)
+        self.channel.close(unlink=True)
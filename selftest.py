@@ -0,0 +1,225 @@
+"""
+AutoLight Self-test
+Checks that the configured PCA9685 and VL53L0X sensors answer where they should, and with
+--bench measures channel writes, frame commits and each sensor's ranging rate and noise
+"""
+
+import statistics
+import time
+from dataclasses import dataclass
+
+from loguru import logger
+
+from settings import Settings
+from subsystems.i2c import get_bus_frequency, list_devices
+from subsystems.leds import PCA9685_ADDRESS
+
+_VL53L0X_DEFAULT_ADDRESS = 0x29
+
+
+@dataclass
+class Check:
+    name: str
+    passed: bool | None  # None for information only
+    detail: str
+
+
+def _timings(values: list[float]) -> str:
+    ordered = sorted(values)
+    return (
+        f"median {statistics.median(ordered) * 1e6:.0f}us, "
+        f"p99 {ordered[int((len(ordered) - 1) * 0.99)] * 1e6:.0f}us, "
+        f"max {ordered[-1] * 1e6:.0f}us"
+    )
+
+
+class SelfTest:
+    """Hardware qualification, run with AutoLight stopped"""
+
+    def __init__(
+        self,
+        settings: Settings,
+        bench: bool = False,
+        writes: int = 200,
+        ranging_time: float = 2.0,
+    ) -> None:
+        self.settings = settings
+        self.bench = bench
+        self.writes = writes
+        self.ranging_time = ranging_time
+        self.checks: list[Check] = []
+
+    def check(self, name: str, passed: bool | None, detail: str = ""):
+        self.checks.append(Check(name, passed, detail))
+        logger.debug(f"{name}: {detail}")
+
+    def _scan(self) -> list[int] | None:
+        import smbus2
+
+        try:
+            with smbus2.SMBus(self.settings.led_i2c_bus) as bus:
+                return list_devices(bus)
+        except OSError as e:
+            self.check(
+                f"i2c-{self.settings.led_i2c_bus}", False, f"can not open the bus, {repr(e)}"
+            )
+            return None
+
+    def run(self) -> list[Check]:
+        addresses = self._scan()
+        if addresses is None:
+            return self.checks
+        frequency = get_bus_frequency(self.settings.led_i2c_bus)
+        detail = " ".join(f"0x{address:x}" for address in addresses) or "no devices"
+        if frequency:
+            detail = f"{frequency / 1000:g}kHz, {detail}"
+        self.check(f"i2c-{self.settings.led_i2c_bus}", None, detail)
+
+        self.check_pca(PCA9685_ADDRESS in addresses)
+        self.check_sensors()
+        return self.checks
+
+    def check_pca(self, present: bool):
+        name = f"pca9685@0x{PCA9685_ADDRESS:x}"
+        if not present:
+            self.check(name, False, "no answer")
+            return
+        self.check(name, True, f"answers, {self.settings.led_driver} driver")
+        if not self.bench:
+            return
+
+        from subsystems.leds import LedSettings, PCA9685LedArray
+
+        try:
+            led_array = PCA9685LedArray(
+                LedSettings(
+                    led_count=self.settings.led_count,
+                    freq=self.settings.led_freq,
+                    driver=self.settings.led_driver,
+                    i2c_bus=self.settings.led_i2c_bus,
+                )
+            )
+        except (OSError, ValueError) as e:
+            self.check(f"{name} setup", False, repr(e))
+            return
+
+        # Every write is 0, so the leds stay dark while the bus is exercised
+        writes = []
+        try:
+            for _ in range(self.writes):
+                for channel in range(len(led_array.duty_cycles)):
+                    start = time.perf_counter()
+                    led_array.set_raw_channel_value(channel, 0)
+                    writes.append(time.perf_counter() - start)
+            self.check(f"{name} channel write", True, _timings(writes))
+        except OSError as e:
+            self.check(
+                f"{name} channel write", False, f"failed after {len(writes)} writes, {repr(e)}"
+            )
+            return
+
+        frames = []
+        try:
+            for _ in range(self.writes):
+                start = time.perf_counter()
+                led_array.render_frame(time.time())
+                frames.append(time.perf_counter() - start)
+            self.check(
+                f"{name} frame commit",
+                True,
+                f"{led_array.get_led_count()} leds, {_timings(frames)}",
+            )
+        except OSError as e:
+            self.check(
+                f"{name} frame commit", False, f"failed after {len(frames)} frames, {repr(e)}"
+            )
+
+    def check_sensors(self):
+        from subsystems.sensors import GPIOSensor, VL53L0XSensor
+
+        vl_sensors: list[tuple[int, VL53L0XSensor]] = []
+        for index, sensor in enumerate(self.settings.sensor_settings):
+            if sensor.get("type") == "vl53l0x_i2c":
+                vl_sensors.append(
+                    (
+                        index,
+                        VL53L0XSensor(
+                            sensor.get("xshut_pin"), trip_distance=sensor.get("calibration")
+                        ),
+                    )
+                )
+            else:
+                gpio = GPIOSensor(
+                    sensor.get("pin"),
+                    sensor.get("invert", False),
+                    sensor.get("pullup", False),
+                    sensor.get("bounce_time", 0.0),
+                )
+                self.check(
+                    f"sensor {index} gpio{sensor.get('pin')}",
+                    None,
+                    "tripped" if gpio.tripped else "clear",
+                )
+                gpio.close()
+
+        if vl_sensors and _VL53L0X_DEFAULT_ADDRESS in (self._scan() or []):
+            self.check(
+                f"vl53l0x@0x{_VL53L0X_DEFAULT_ADDRESS:x}",
+                False,
+                "answers with every XSHUT low, a sensor is not wired to its XSHUT pin",
+            )
+            return
+
+        # Powered up one at a time, like the startup sequence, each must appear at the default address
+        for index, sensor in vl_sensors:
+            name = f"sensor {index} vl53l0x@0x{sensor._address:x}"
+            sensor.xshut.value = 1
+            time.sleep(0.05)
+            if _VL53L0X_DEFAULT_ADDRESS not in (self._scan() or []):
+                sensor.xshut.value = 0
+                self.check(name, False, f"no answer after raising XSHUT pin {sensor.shut_pin}")
+                continue
+            sensor.begin(thread=False)
+            timing_budget = self.settings.sensor_settings[index].get("timing_budget")
+            if timing_budget:
+                sensor.timing_budget = timing_budget
+            if sensor._address not in (self._scan() or []):
+                self.check(name, False, "did not move to its address")
+                continue
+            self.check(name, True, f"answers, XSHUT pin {sensor.shut_pin}")
+
+            if self.bench:
+                self.bench_sensor(name, sensor)
+            sensor.stop()
+
+    def bench_sensor(self, name: str, sensor):
+        distances = []
+        errors = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < self.ranging_time:
+            try:
+                distances.append(sensor.device.distance)
+            except OSError:
+                errors += 1
+        elapsed = time.perf_counter() - start
+
+        if not distances:
+            self.check(f"{name} ranging", False, f"no samples, {errors} errors")
+            return
+        self.check(
+            f"{name} ranging",
+            errors == 0,
+            f"{len(distances) / elapsed:.1f}Hz, mean {statistics.mean(distances):.1f}cm, "
+            f"noise {statistics.pstdev(distances):.2f}cm, {errors} errors",
+        )
+
+
+def report(checks: list[Check]) -> list[str]:
+    width = max((len(check.name) for check in checks), default=0) + 2
+    lines = []
+    for check in checks:
+        status = {True: "PASS", False: "FAIL", None: "INFO"}[check.passed]
+        lines.append(f"{check.name:<{width}}{status:<6}{check.detail}")
+    failed = sum(check.passed is False for check in checks)
+    lines.append(f"{failed} of {sum(check.passed is not None for check in checks)} checks failed")
+    return lines
@@ -1,10 +1,35 @@
 import os
+import select
+import struct
 import sys
+import threading
+import time
 import yaml
 
 from loguru import logger
 
-from typing import TypedDict
+from typing import Callable, TypedDict
+
+# Settings applied to a running instance, everything else needs a restart
+# sensor_settings is applied too when no sensor is added, removed or readdressed
+LIVE_SETTINGS = {
+    "led_freq",
+    "led_fps_on",
+    "led_fps_off",
+    "blink_animation_hz",
+    "fade_animation_multiplier",
+    "walking_activation_radius",
+    "walking_holds",
+    "walking_fade_outs",
+    "sensor_distance_delta",
+    "sensor_distance_min_interval",
+    "aggregate_include_distances",
+    "aggregate_distance_quantum",
+    "debug_update_rate",
+    "state_file_path",
+    "i2c_trace_dump_path",
+}
+
 
 class VL53L0XTypedSettings(TypedDict):
     type: str
@@ -24,6 +49,8 @@ class LedTypedSettings(TypedDict):
     freq: int
     fps_on: int
     fps_off: int
+    driver: str
+    i2c_bus: int
 
 class _ExtraLedTypedSetting(TypedDict):
     channel: int
@@ -31,6 +58,8 @@ class _ExtraLedTypedSetting(TypedDict):
     ha_icon: str
     ha_id: str
     sensor: GPIOSensorTypedSettings | None
+    hold: float
+    fade_out: float
 
 
 ExtraLedsTypedSettings = list[_ExtraLedTypedSetting]
@@ -41,8 +70,15 @@ class _BlinkAnimationTypedSettings(TypedDict):
 class _FadeAnimationTypedSettings(TypedDict):
     fade_speed_multiplier: float
 
+class _WalkingSegmentTypedSettings(TypedDict):
+    hold: float
+    fade_out: float
+
 class _WalkingAnimationTypedSettings(TypedDict):
     activation_radius: int
+    hold: float
+    fade_out: float
+    segments: dict[int, _WalkingSegmentTypedSettings]
 
 class AnimationTypedSettings(TypedDict):
     blink: _BlinkAnimationTypedSettings
@@ -69,17 +105,28 @@ class SensorEntitiesTypedSettings(TypedDict):
     naming_scheme: str
     id_scheme: str
     device_class: str
+    distance_delta: float
+    distance_min_interval: float
 
 class DebuggingEntitiesTypedSettings(TypedDict):
     create_debug_entities: bool
     update_rate: float
 
+class AggregateTypedSettings(TypedDict):
+    enabled: bool
+    topic: str
+    include_distances: bool
+    distance_quantum: float
+    entity_interval: float
+
 class HomeAssistantTypedSettings(TypedDict):
     mqtt: MqttTypedSettings
     device: DeviceTypedSettings
     light_entity: LightEntityTypedSettings
     sensor_entities: SensorEntitiesTypedSettings
     debugging_entities: DebuggingEntitiesTypedSettings
+    aggregate: AggregateTypedSettings
+    discovery_cache: str
 
 class LoggingTypedSettings(TypedDict):
     interactive_log_level: str
@@ -88,8 +135,50 @@ class LoggingTypedSettings(TypedDict):
     file_logging: bool
     rich_traceback: bool
 
+class ControlTypedSettings(TypedDict):
+    enabled: bool
+    socket_path: str
+
+class MetricsTypedSettings(TypedDict):
+    enabled: bool
+    host: str
+    port: int
+
+class I2CTraceTypedSettings(TypedDict):
+    enabled: bool
+    size: int
+    dump_path: str
+
+class FrameBufferTypedSettings(TypedDict):
+    enabled: bool
+    path: str
+
+class RendererTypedSettings(TypedDict):
+    process: bool
+    channel_path: str
+    heartbeat_timeout: float
+
+class SensorMappingTypedSetting(TypedDict):
+    sensor: int
+    leds: list[int] | dict[int, float]
+    weight: float
+
+class I2CTypedSettings(TypedDict):
+    frequency: int
+    switch_at_startup: bool
+
+class RealtimeTypedSettings(TypedDict):
+    enabled: bool
+    priority: int
+    cpu: int | None
+    lock_memory: bool
+    gc_freeze: bool
+    measure_seconds: float
+
 class MiscTypedSettings(TypedDict):
     do_banner: bool
+    state_file: str
+    hot_reload: bool
 
 class Settings:
     def __init__(self, config_file="config.yaml"):
@@ -111,6 +200,11 @@ class Settings:
         self.led_freq = self.led_settings.get("freq", 200)
         self.led_fps_on = self.led_settings.get("fps_on", 120)
         self.led_fps_off = self.led_settings.get("fps_off", 60)
+        self.led_driver = self.led_settings.get("driver", "adafruit")
+        self.led_i2c_bus = self.led_settings.get("i2c_bus", 1)
+
+        # Sensor to LED Mapping
+        self.sensor_mapping: list[SensorMappingTypedSetting] = self.root_settings.get("mapping") or []
 
         # Extra Led Settings
         self.extra_led_settings: ExtraLedsTypedSettings = self.root_settings.get("extra_leds", [])
@@ -131,10 +225,22 @@ class Settings:
         # Animation/Walking
         self.walking_animation_settings = self.animation_settings.get("walking", {})
         self.walking_activation_radius = self.walking_animation_settings.get("activation_radius", 1)
+        walking_hold = self.walking_animation_settings.get("hold", 0.0)
+        walking_fade_out = self.walking_animation_settings.get("fade_out", 0.0)
+        walking_segments: dict[int, _WalkingSegmentTypedSettings] = self.walking_animation_settings.get("segments") or {}
+        # Per led, segments override the walking hold and fade out
+        self.walking_holds: list[float] = [
+            walking_segments.get(index, {}).get("hold", walking_hold) for index in range(self.led_count or 0)
+        ]
+        self.walking_fade_outs: list[float] = [
+            walking_segments.get(index, {}).get("fade_out", walking_fade_out) for index in range(self.led_count or 0)
+        ]
 
         # HA Settings
         self.ha_settings: HomeAssistantTypedSettings = self.root_settings.get("home_assistant", {})
 
+        self.discovery_cache_path = self.ha_settings.get("discovery_cache", ".discovery_cache.json")
+
         # Ha/Mqtt
         self.mqtt_settings = self.ha_settings.get("mqtt", {})
 
@@ -163,6 +269,8 @@ class Settings:
         self.sensor_naming_scheme = self.sensor_entity_settings.get("naming_scheme", "Sensor {0}")
         self.sensor_id_scheme = self.sensor_entity_settings.get("id_scheme", "sensor_{0}")
         self.sensor_device_class = self.sensor_entity_settings.get("device_class", "motion")
+        self.sensor_distance_delta = self.sensor_entity_settings.get("distance_delta", 2.0)
+        self.sensor_distance_min_interval = self.sensor_entity_settings.get("distance_min_interval", 1.0)
 
         # Ha/Debug
         self.debug_entity_settings = self.ha_settings.get("debugging_entities", {})
@@ -170,6 +278,15 @@ class Settings:
         self.create_debug_entities = self.debug_entity_settings.get("create_debug_entities", True)
         self.debug_update_rate = self.debug_entity_settings.get("update_rate", 15)
 
+        # Ha/Aggregate
+        self.aggregate_settings = self.ha_settings.get("aggregate", {})
+
+        self.aggregate_enabled = self.aggregate_settings.get("enabled", False)
+        self.aggregate_topic = self.aggregate_settings.get("topic", f"autolight/{self.device_id}/sensors")
+        self.aggregate_include_distances = self.aggregate_settings.get("include_distances", False)
+        self.aggregate_distance_quantum = self.aggregate_settings.get("distance_quantum", 5.0)
+        self.aggregate_entity_interval = self.aggregate_settings.get("entity_interval", 0.0)
+
         # Logging Settings
         self.logging_settings: LoggingTypedSettings = self.root_settings.get("logging", {})
 
@@ -181,9 +298,185 @@ class Settings:
 
         self.rich_tracebacks = self.logging_settings.get("rich_traceback", True)
 
+        # Local Control Settings
+        self.control_settings: ControlTypedSettings = self.root_settings.get("control", {})
+
+        self.control_enabled = self.control_settings.get("enabled", False)
+        self.control_socket_path = self.control_settings.get("socket_path", "/run/autolight/control.sock")
+
+        # Metrics Settings
+        self.metrics_settings: MetricsTypedSettings = self.root_settings.get("metrics", {})
+
+        self.metrics_enabled = self.metrics_settings.get("enabled", False)
+        self.metrics_host = self.metrics_settings.get("host", "127.0.0.1")
+        self.metrics_port = self.metrics_settings.get("port", 9105)
+
+        # I2C Trace Settings
+        self.i2c_trace_settings: I2CTraceTypedSettings = self.root_settings.get("i2c_trace", {})
+
+        self.i2c_trace_enabled = self.i2c_trace_settings.get("enabled", False)
+        self.i2c_trace_size = self.i2c_trace_settings.get("size", 4096)
+        self.i2c_trace_dump_path = self.i2c_trace_settings.get("dump_path", "i2c-trace.txt")
+
+        # Frame Buffer Settings
+        self.frame_buffer_settings: FrameBufferTypedSettings = self.root_settings.get("frame_buffer", {})
+
+        self.frame_buffer_enabled = self.frame_buffer_settings.get("enabled", False)
+        self.frame_buffer_path = self.frame_buffer_settings.get("path", "/dev/shm/autolight-frame")
+
+        # Renderer Settings
+        self.renderer_settings: RendererTypedSettings = self.root_settings.get("renderer", {})
+
+        self.renderer_process = self.renderer_settings.get("process", False)
+        self.renderer_channel_path = self.renderer_settings.get("channel_path", "/dev/shm/autolight-render")
+        self.renderer_heartbeat_timeout = self.renderer_settings.get("heartbeat_timeout", 2.0)
+
+        # I2C Settings
+        self.i2c_settings: I2CTypedSettings = self.root_settings.get("i2c", {})
+
+        self.i2c_frequency = self.i2c_settings.get("frequency", None)
+        self.i2c_switch_at_startup = self.i2c_settings.get("switch_at_startup", False)
+
+        # Realtime Settings
+        self.realtime_settings: RealtimeTypedSettings = self.root_settings.get("realtime", {})
+
+        self.realtime_enabled = self.realtime_settings.get("enabled", False)
+        self.realtime_priority = self.realtime_settings.get("priority", 50)
+        self.realtime_cpu = self.realtime_settings.get("cpu", None)
+        self.realtime_lock_memory = self.realtime_settings.get("lock_memory", True)
+        self.realtime_gc_freeze = self.realtime_settings.get("gc_freeze", True)
+        self.realtime_measure_seconds = self.realtime_settings.get("measure_seconds", 5.0)
+
         # Misc Settings
         self.misc_settings: MiscTypedSettings = self.root_settings.get("misc", {})
 
         self.do_banner = self.misc_settings.get("do_banner", True)
-
-
+        self.state_file_path = self.misc_settings.get("state_file", ".last_state.json")
+        self.hot_reload = self.misc_settings.get("hot_reload", False)
+
+    def changes(self, other: "Settings") -> list[str]:
+        """Names of the settings that differ in other, raw config sections are left out"""
+        return [
+            name
+            for name, value in vars(other).items()
+            if name != "root_settings"
+            and not isinstance(value, dict)
+            and getattr(self, name, None) != value
+        ]
+
+    def update(self, other: "Settings", names: list[str]):
+        """Take the given settings from other, in place so every holder sees them"""
+        for name in names:
+            setattr(self, name, getattr(other, name))
+
+
+class ConfigWatcher:
+    """Call callback once the config file has been written
+
+    Uses inotify on the containing directory, so editors that save by renaming a
+    temporary file are seen too, and falls back to polling the file's mtime
+    """
+
+    _IN_CLOSE_WRITE = 0x00000008
+    _IN_MOVED_TO = 0x00000080
+    _IN_CREATE = 0x00000100
+
+    def __init__(
+        self,
+        path: str,
+        callback: Callable[[], None],
+        poll_interval: float = 1.0,
+        settle_time: float = 0.2,
+    ) -> None:
+        self.path = os.path.abspath(path)
+        self.callback = callback
+        self.poll_interval = poll_interval
+        # Editors may write a file in several steps, wait for them to finish
+        self.settle_time = settle_time
+
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="config_watch", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _inotify_fd(self) -> int | None:
+        """inotify descriptor watching the config directory, or None when unavailable"""
+        import ctypes
+        import ctypes.util
+
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            fd = libc.inotify_init1(os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+
+        mask = self._IN_CLOSE_WRITE | self._IN_MOVED_TO | self._IN_CREATE
+        if libc.inotify_add_watch(fd, os.path.dirname(self.path).encode(), mask) < 0:
+            os.close(fd)
+            return None
+        return fd
+
+    def _file_written(self, fd: int, timeout: float) -> bool:
+        """Read pending inotify events, True if any of them is for the config file"""
+        if not select.select([fd], [], [], timeout)[0]:
+            return False
+
+        name = os.path.basename(self.path).encode()
+        buffer = os.read(fd, 65536)
+        offset = 0
+        written = False
+        while offset < len(buffer):
+            _, _, _, length = struct.unpack_from("iIII", buffer, offset)
+            offset += 16
+            if buffer[offset : offset + length].rstrip(b"\0") == name:
+                written = True
+            offset += length
+        return written
+
+    def _run(self):
+        fd = self._inotify_fd()
+        if fd is None:
+            logger.debug(f"inotify unavailable, polling {self.path} for changes")
+            self._poll()
+            return
+
+        logger.debug(f"Watching {self.path} for changes")
+        try:
+            while not self._stopped.is_set():
+                if not self._file_written(fd, 0.5):
+                    continue
+                # Swallow the rest of the save before reloading once
+                while self._file_written(fd, self.settle_time):
+                    pass
+                self._notify()
+        finally:
+            os.close(fd)
+
+    def _signature(self) -> tuple[int, int, int] | None:
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def _poll(self):
+        last = self._signature()
+        while not self._stopped.wait(self.poll_interval):
+            current = self._signature()
+            if current is None or current == last:
+                continue
+            time.sleep(self.settle_time)
+            last = self._signature()
+            self._notify()
+
+    def _notify(self):
+        try:
+            self.callback()
+        except Exception as e:
+            logger.exception(f"Config reload failed, {repr(e)}")
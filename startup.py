@@ -0,0 +1,128 @@
+"""
+AutoLight Startup Pipeline
+Startup phases run as a dependency graph, independent phases run concurrently
+"""
+
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable
+
+from loguru import logger
+
+
+@dataclass
+class StartupPhase:
+    """A named startup step and the phases it waits for"""
+
+    name: str
+    func: Callable[[], None]
+    depends: tuple[str, ...] = ()
+    start: float | None = None
+    end: float | None = None
+    thread: str = field(default="", repr=False)
+
+    @property
+    def duration(self) -> float | None:
+        if self.start is None or self.end is None:
+            return None
+        return self.end - self.start
+
+
+class StartupPipeline:
+    """Run startup phases as soon as their dependencies have finished"""
+
+    def __init__(self) -> None:
+        self.phases: dict[str, StartupPhase] = {}
+        self.start_time: float | None = None
+        self.end_time: float | None = None
+
+    def add(self, name: str, func: Callable[[], None], depends: tuple[str, ...] = ()):
+        if name in self.phases:
+            raise ValueError(f"Startup phase {name} already exists")
+        self.phases[name] = StartupPhase(name, func, tuple(depends))
+
+    def _ordered(self) -> list[StartupPhase]:
+        """Phases in dependency order
+
+        Raises:
+            ValueError: Unknown dependency or dependency cycle
+        """
+        ordered: list[StartupPhase] = []
+        visiting: set[str] = set()
+        done: set[str] = set()
+
+        def visit(name: str, path: tuple[str, ...]):
+            if name in done:
+                return
+            if name not in self.phases:
+                raise ValueError(f"Startup phase {path[-1]} depends on unknown phase {name}")
+            if name in visiting:
+                raise ValueError(f"Startup phase cycle: {' -> '.join(path + (name,))}")
+
+            visiting.add(name)
+            for dependency in self.phases[name].depends:
+                visit(dependency, path + (name,))
+            visiting.remove(name)
+            done.add(name)
+            ordered.append(self.phases[name])
+
+        for name in self.phases:
+            visit(name, ())
+        return ordered
+
+    def _run_phase(self, phase: StartupPhase, futures: dict[str, Future]):
+        for dependency in phase.depends:
+            futures[dependency].result()  # Re-raises a failed dependency
+
+        phase.thread = threading.current_thread().name
+        phase.start = time.perf_counter()
+        try:
+            phase.func()
+        finally:
+            phase.end = time.perf_counter()
+
+    def run(self):
+        """Run every phase, re-raising the first failure (including SystemExit)"""
+        ordered = self._ordered()
+        self.start_time = time.perf_counter()
+
+        futures: dict[str, Future] = {}
+        # One worker per phase, a phase blocked on its dependencies never starves another
+        with ThreadPoolExecutor(
+            max_workers=max(len(ordered), 1), thread_name_prefix="startup"
+        ) as pool:
+            # Dependency order guarantees every awaited future already exists
+            for phase in ordered:
+                futures[phase.name] = pool.submit(self._run_phase, phase, futures)
+
+            try:
+                for phase in ordered:
+                    futures[phase.name].result()
+            finally:
+                self.end_time = time.perf_counter()
+
+    def report(self) -> list[str]:
+        """Per-phase timing table, in the order phases started"""
+        lines = [f"{'phase':<16}{'start':>9}{'duration':>10}  depends on"]
+        started = sorted(
+            (phase for phase in self.phases.values() if phase.start is not None),
+            key=lambda phase: phase.start,
+        )
+        for phase in started:
+            duration = (
+                f"{phase.duration:9.3f}s" if phase.duration is not None else "   failed"
+            )
+            lines.append(
+                f"{phase.name:<16}{phase.start - self.start_time:8.3f}s{duration}"
+                f"  {', '.join(phase.depends) or '-'}"
+            )
+        if self.end_time is not None:
+            lines.append(f"{'total':<16}{'':>9}{self.end_time - self.start_time:9.3f}s")
+        return lines
+
+    def log_report(self):
+        logger.info("Startup phases:")
+        for line in self.report():
+            logger.info(f"  {line}")
@@ -0,0 +1,172 @@
+"""
+AutoLight State Store
+Lighting and sensor state shared by the MQTT, control, sensor and animator threads
+"""
+
+import threading
+from collections import deque
+from dataclasses import dataclass, replace
+from typing import Callable
+
+from data_types import LightingData, ExtraLightData
+from utils import SYSTEM_CLOCK, SystemClock, VirtualClock
+
+
+@dataclass(frozen=True)
+class StateSnapshot:
+    """One consistent, immutable view of the whole state"""
+
+    version: int
+    lighting: LightingData
+    extras: tuple[ExtraLightData, ...]
+    sensor_trips: tuple[bool, ...]
+
+
+Listener = Callable[[StateSnapshot, StateSnapshot], None]
+
+
+class StateStore:
+    """Versioned state, replaced as a whole on every change
+
+    Readers take the current snapshot with a single attribute read and never lock.
+    Writers compare-and-swap against the version they read, and every change wakes wait()
+    """
+
+    def __init__(
+        self,
+        lighting: LightingData,
+        extras: list[ExtraLightData],
+        sensor_count: int,
+        clock: SystemClock | VirtualClock = SYSTEM_CLOCK,
+    ) -> None:
+        self.clock = clock
+        self._snapshot = StateSnapshot(0, lighting, tuple(extras), (False,) * sensor_count)
+        self._changed = threading.Condition()
+        # Each listener with the version it was added at, it only hears of newer ones
+        self._listeners: list[tuple[Listener, int]] = []
+        # Changes not yet passed to the listeners, and whether a thread is passing them.
+        # An entry for a single listener carries it as the third item, None for all
+        self._pending: deque[tuple[StateSnapshot, StateSnapshot, Listener | None]] = deque()
+        self._notifying = False
+
+    @property
+    def snapshot(self) -> StateSnapshot:
+        return self._snapshot
+
+    def add_listener(self, listener: Listener, initial: bool = False):
+        """Call listener(old, new) after every change
+
+        Listeners run in a writing thread, in version order, outside the state lock, so a
+        slow listener never holds up other writers or wait(). With initial, listener is
+        first called with the current snapshot as both arguments
+        """
+        with self._changed:
+            snapshot = self._snapshot
+            self._listeners.append((listener, snapshot.version))
+            if initial:
+                # Queued behind the pending changes, so it still arrives in version order
+                self._pending.append((snapshot, snapshot, listener))
+        self._notify()
+
+    def compare_and_swap(self, version: int, **changes) -> StateSnapshot | None:
+        """Apply changes if the state is still at version
+
+        Returns:
+            StateSnapshot | None: The new snapshot, or None if another writer got there first
+        """
+        with self._changed:
+            old = self._snapshot
+            if old.version != version:
+                return None
+            new = replace(old, version=version + 1, **changes)
+            self._snapshot = new
+            self._pending.append((old, new, None))
+            self._changed.notify_all()
+        self._notify()
+        return new
+
+    def _notify(self):
+        """Pass pending changes to the listeners, unless another writer already is"""
+        with self._changed:
+            if self._notifying:
+                return
+            self._notifying = True
+        try:
+            while True:
+                with self._changed:
+                    if not self._pending:
+                        self._notifying = False
+                        return
+                    old, new, only = self._pending.popleft()
+                    if only is None:
+                        listeners = [
+                            listener
+                            for listener, since in self._listeners
+                            if new.version > since
+                        ]
+                    else:
+                        listeners = [only]
+                for listener in listeners:
+                    listener(old, new)
+        except BaseException:
+            with self._changed:
+                self._notifying = False
+            raise
+
+    def update(
+        self,
+        changes: Callable[[StateSnapshot], dict],
+        unchanged: Callable[[StateSnapshot], None] | None = None,
+    ) -> StateSnapshot:
+        """Apply changes(snapshot) atomically, retrying if another writer interleaves
+
+        changes returns the fields to replace, nothing is written when they are all equal.
+        Listeners only see real changes, unchanged(snapshot) is called for the others
+        """
+        while True:
+            current = self._snapshot
+            fields = {
+                name: value
+                for name, value in changes(current).items()
+                if getattr(current, name) != value
+            }
+            if not fields:
+                if unchanged:
+                    unchanged(current)
+                return current
+            new = self.compare_and_swap(current.version, **fields)
+            if new is not None:
+                return new
+
+    def update_lighting(
+        self,
+        change: Callable[[LightingData], LightingData],
+        unchanged: Callable[[StateSnapshot], None] | None = None,
+    ) -> StateSnapshot:
+        return self.update(
+            lambda snapshot: {"lighting": change(snapshot.lighting)}, unchanged
+        )
+
+    def update_extra(
+        self,
+        index: int,
+        change: Callable[[ExtraLightData], ExtraLightData],
+        unchanged: Callable[[StateSnapshot], None] | None = None,
+    ) -> StateSnapshot:
+        def changes(snapshot: StateSnapshot) -> dict:
+            extras = list(snapshot.extras)
+            extras[index] = change(extras[index])
+            return {"extras": tuple(extras)}
+
+        return self.update(changes, unchanged)
+
+    def set_sensor_trips(self, trips: list[bool]) -> StateSnapshot:
+        return self.update(lambda snapshot: {"sensor_trips": tuple(trips)})
+
+    def wait(self, version: int, timeout: float | None = None) -> StateSnapshot:
+        """Block until the state is newer than version, or timeout passes"""
+        with self._changed:
+            self.clock.wait_for(
+                self._changed, lambda: self._snapshot.version != version, timeout
+            )
+            return self._snapshot
@@ -0,0 +1,211 @@
+"""
+AutoLight Frame Buffer
+Publishes every committed led frame and the sensor vector to a shared-memory file,
+for local observers reading at full frame rate without touching the render thread
+
+Layout, little endian:
+    0   4s   magic b"ALFB"
+    4   u16  layout version
+    6   u16  channel count
+    8   u16  sensor count
+    12  u32  CRC-32 of everything from the frame number on
+    16  u64  sequence, odd while a frame is being written
+    24  u64  frame number
+    32  f64  frame time, unix seconds
+    40  u16  duty cycle per PCA9685 channel
+    ..  u8   trip state per sensor
+    ..  f32  distance per sensor, 4 byte aligned, NaN without a distance sensor
+
+The sequence alone does not order plain mmap stores on a weakly ordered CPU such as the
+Pi's ARM cores, so readers also check the CRC and retry on a torn frame
+"""
+
+import mmap
+import os
+import struct
+import sys
+import time
+import zlib
+from array import array
+from dataclasses import dataclass
+
+MAGIC = b"ALFB"
+LAYOUT_VERSION = 2
+
+_HEADER = struct.Struct("<4sHHH")
+_CHECKSUM = struct.Struct("<I")
+_SEQUENCE = struct.Struct("<Q")
+_FRAME = struct.Struct("<Qd")
+_CHECKSUM_OFFSET = 12
+_SEQUENCE_OFFSET = 16
+_FRAME_OFFSET = 24
+_DUTY_OFFSET = 40
+
+
+def _offsets(channel_count: int, sensor_count: int) -> tuple[int, int, int]:
+    """Offsets of the trips and distances, and the total size"""
+    trips = _DUTY_OFFSET + 2 * channel_count
+    distances = (trips + sensor_count + 3) & ~3
+    return trips, distances, distances + 4 * sensor_count
+
+
+@dataclass
+class Frame:
+    sequence: int
+    frame: int
+    time: float
+    duty_cycles: list[int]
+    trips: list[bool]
+    distances: list[float | None]
+
+
+class FrameBufferWriter:
+    """Single-writer seqlock over an mmap'd file, usually in /dev/shm"""
+
+    def __init__(self, path: str, channel_count: int = 16, sensor_count: int = 0) -> None:
+        self.path = path
+        self.channel_count = channel_count
+        self.sensor_count = sensor_count
+        trips_offset, distances_offset, size = _offsets(channel_count, sensor_count)
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        _HEADER.pack_into(self._map, 0, MAGIC, LAYOUT_VERSION, channel_count, sensor_count)
+        self._sequence = 0
+        _SEQUENCE.pack_into(self._map, _SEQUENCE_OFFSET, 0)
+        self._frame = 0
+
+        # Typed views, so a commit copies whole arrays without packing each value
+        view = memoryview(self._map)
+        self._duty_view = view[_DUTY_OFFSET:trips_offset].cast("H")
+        self._trips_view = view[trips_offset : trips_offset + sensor_count]
+        self._distances_view = view[distances_offset:size].cast("f")
+        self._payload_view = view[_FRAME_OFFSET:size]
+
+        # Latest sensor vector, stored by the sensor thread and committed with the next frame
+        self.trips = array("B", [0]) * sensor_count
+        self.distances = array("f", [float("nan")]) * sensor_count
+
+    def update_sensors(self, trips: list[bool], distances: list[float | None]):
+        for index in range(self.sensor_count):
+            self.trips[index] = trips[index]
+            distance = distances[index]
+            self.distances[index] = float("nan") if distance is None else distance
+
+    def commit(self, duty_cycles: array, frame_time: float):
+        """Publish one frame, duty_cycles is an array("H") of every channel"""
+        self._sequence += 1
+        _SEQUENCE.pack_into(self._map, _SEQUENCE_OFFSET, self._sequence)
+
+        self._frame += 1
+        _FRAME.pack_into(self._map, _FRAME_OFFSET, self._frame, frame_time)
+        self._duty_view[:] = duty_cycles
+        self._trips_view[:] = self.trips
+        self._distances_view[:] = self.distances
+        _CHECKSUM.pack_into(self._map, _CHECKSUM_OFFSET, zlib.crc32(self._payload_view))
+
+        self._sequence += 1
+        _SEQUENCE.pack_into(self._map, _SEQUENCE_OFFSET, self._sequence)
+
+    def close(self, unlink: bool = True):
+        self._duty_view.release()
+        self._trips_view.release()
+        self._distances_view.release()
+        self._payload_view.release()
+        self._map.close()
+        if unlink and os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class FrameBufferReader:
+    """Any number of readers, each retries while the writer is mid-frame"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.channel_count, self.sensor_count = _HEADER.unpack_from(
+            self._map, 0
+        )
+        if magic != MAGIC or version != LAYOUT_VERSION:
+            raise ValueError(f"{path} is not an AutoLight frame buffer (layout {version})")
+
+        trips_offset, distances_offset, self._size = _offsets(
+            self.channel_count, self.sensor_count
+        )
+        self._payload = struct.Struct(
+            f"<Qd{self.channel_count}H"
+            f"{trips_offset - _DUTY_OFFSET - 2 * self.channel_count}x"
+            f"{self.sensor_count}B"
+            f"{distances_offset - trips_offset - self.sensor_count}x"
+            f"{self.sensor_count}f"
+        )
+
+    def read(self, retries: int = 100) -> Frame | None:
+        """Latest consistent frame, None before the first commit or if the writer never settles"""
+        for _ in range(retries):
+            (before,) = _SEQUENCE.unpack_from(self._map, _SEQUENCE_OFFSET)
+            if before & 1:
+                continue
+            (checksum,) = _CHECKSUM.unpack_from(self._map, _CHECKSUM_OFFSET)
+            payload = self._map[_FRAME_OFFSET : self._size]
+            (after,) = _SEQUENCE.unpack_from(self._map, _SEQUENCE_OFFSET)
+            if before != after:
+                continue
+            if before == 0:
+                return None
+            if zlib.crc32(payload) != checksum:
+                continue
+            values = self._payload.unpack(payload)
+
+            channels, sensors = self.channel_count, self.sensor_count
+            return Frame(
+                sequence=before,
+                frame=values[0],
+                time=values[1],
+                duty_cycles=list(values[2 : 2 + channels]),
+                trips=[bool(trip) for trip in values[2 + channels : 2 + channels + sensors]],
+                distances=[
+                    None if distance != distance else distance  # NaN
+                    for distance in values[2 + channels + sensors :]
+                ],
+            )
+        return None
+
+    def wait_next(self, frame: int, timeout: float = 1.0, interval: float = 0.001) -> Frame | None:
+        """Poll until a frame newer than frame is committed"""
+        end = time.monotonic() + timeout
+        while time.monotonic() < end:
+            latest = self.read()
+            if latest is not None and latest.frame != frame:
+                return latest
+            time.sleep(interval)
+        return None
+
+    def close(self):
+        self._map.close()
+
+
+if __name__ == "__main__":
+    # Minimal live view: python -m subsystems.framebuffer [path]
+    reader = FrameBufferReader(sys.argv[1] if len(sys.argv) > 1 else "/dev/shm/autolight-frame")
+    levels = " ▁▂▃▄▅▆▇█"
+    last = 0
+    try:
+        while True:
+            frame = reader.wait_next(last)
+            if frame is None:
+                continue
+            last = frame.frame
+            leds = "".join(levels[duty * (len(levels) - 1) // 65535] for duty in frame.duty_cycles)
+            trips = "".join("#" if trip else "." for trip in frame.trips)
+            print(f"\r{frame.frame:>10} |{leds}| {trips} ", end="", flush=True)
+            time.sleep(1 / 30)
+    except KeyboardInterrupt:
+        print()
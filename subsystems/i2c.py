@@ -1,7 +1,38 @@
-import smbus2
+import itertools
+import os
+import subprocess
+import threading
+import time
+from array import array
+from collections import deque
 
+from loguru import logger
+
+_shared_i2c = None
+_shared_i2c_lock = threading.Lock()  # Startup phases may ask for the bus at the same time
+_tracer: "I2CTracer | None" = None
+
+
+def get_shared_i2c():
+    """Blinka I2C bus shared by every device, created on first use, traced if enabled by then"""
+    global _shared_i2c
+    with _shared_i2c_lock:
+        if _shared_i2c is None:
+            import board
+            import busio
+
+            _shared_i2c = busio.I2C(board.SCL, board.SDA)
+            if _tracer is not None:
+                _shared_i2c = TracedI2C(_shared_i2c, _tracer)
+    return _shared_i2c
+
+
+def list_devices(bus: "smbus2.SMBus | None" = None):
+    if bus is None:
+        import smbus2
+
+        bus = smbus2.SMBus(1)
 
-def list_devices(bus: smbus2.SMBus = smbus2.SMBus(1)):
     addresses = []
     for address in range(3, 120):  # don't run on reserved addressed
         try:
@@ -13,5 +44,288 @@ def list_devices(bus: smbus2.SMBus = smbus2.SMBus(1)):
     return addresses
 
 
+def get_bus_frequency(bus: int = 1) -> int | None:
+    """Clock the bus driver was probed with, from the device tree, None if unknown"""
+    try:
+        with open(f"/sys/class/i2c-adapter/i2c-{bus}/of_node/clock-frequency", "rb") as f:
+            return int.from_bytes(f.read(4), "big")
+    except OSError:
+        return None
+
+
+def set_bus_frequency(bus: int, frequency: int) -> bool:
+    """Change the bus clock of a Pi at runtime, needs root and no open devices on the bus
+
+    Sets i2c_arm_baudrate in the live device tree, then rebinds the bus driver so it
+    probes again with the new clock. Raises OSError or SubprocessError if that is not possible
+
+    Returns:
+        bool: The bus runs at frequency afterwards
+    """
+    subprocess.run(
+        ["dtparam", f"i2c_arm_baudrate={frequency}"],
+        check=True,
+        capture_output=True,
+        timeout=10,
+    )
+    device = os.path.realpath(f"/sys/class/i2c-adapter/i2c-{bus}/device")
+    driver = os.path.realpath(os.path.join(device, "driver"))
+    with open(os.path.join(driver, "unbind"), "w") as f:
+        f.write(os.path.basename(device))
+    with open(os.path.join(driver, "bind"), "w") as f:
+        f.write(os.path.basename(device))
+
+    # The adapter, and its /dev node, come back with a new probe
+    end = time.monotonic() + 2
+    while not os.path.exists(f"/dev/i2c-{bus}") and time.monotonic() < end:
+        time.sleep(0.05)
+    return get_bus_frequency(bus) == frequency
+
+
+def configure_bus_frequency(bus: int, frequency: int, switch: bool = False):
+    """Check the bus clock against the configured one at startup
+
+    Only with switch is the bus switched at runtime, which needs root and briefly removes the
+    bus from every other process using it, otherwise a warning explains how to set it at boot
+    """
+    current = get_bus_frequency(bus)
+    if current == frequency:
+        logger.info(f"I2C bus {bus} running at {frequency / 1000:g}kHz")
+        return
+
+    if switch:
+        try:
+            if set_bus_frequency(bus, frequency):
+                logger.info(f"I2C bus {bus} switched from {current}Hz to {frequency / 1000:g}kHz")
+                return
+        except (OSError, subprocess.SubprocessError) as e:
+            logger.debug(f"Runtime I2C clock change failed, {repr(e)}")
+
+    logger.warning(
+        f"I2C bus {bus} runs at {current}Hz, not the configured {frequency}Hz. "
+        f"Add dtparam=i2c_arm_baudrate={frequency} to /boot/firmware/config.txt and reboot"
+    )
+
+
+NO_REGISTER = 0xFFFF  # Plain reads, which do not start with a register address
+
+
+class I2CTracer:
+    """Ring buffer of the most recent I2C transactions
+
+    Every column is a preallocated array, recording overwrites the oldest slot
+    without creating lists, tuples or dicts, so it can stay enabled in the frame loops
+    """
+
+    def __init__(self, size: int = 4096, snapshot_count: int = 8) -> None:
+        self.size = size
+        self._address = array("H", [0]) * size
+        self._register = array("H", [0]) * size
+        self._length = array("H", [0]) * size
+        self._start = array("d", [0.0]) * size
+        self._duration = array("d", [0.0]) * size
+        self._result = array("i", [0]) * size  # 0 or the errno of the failure
+        self._thread = array("L", [0]) * size
+
+        # next() on itertools.count is atomic, concurrent recorders never share a slot
+        self._sequence = itertools.count()
+        self.recorded = 0
+
+        self.snapshots: deque[tuple[float, str, list[str]]] = deque(maxlen=snapshot_count)
+
+    def record(
+        self,
+        address: int,
+        register: int,
+        length: int,
+        start: float,
+        duration: float,
+        result: int = 0,
+    ):
+        sequence = next(self._sequence)
+        slot = sequence % self.size
+        self._address[slot] = address
+        self._register[slot] = register
+        self._length[slot] = length
+        self._start[slot] = start
+        self._duration[slot] = duration
+        self._result[slot] = result
+        self._thread[slot] = threading.get_ident()
+        self.recorded = sequence + 1
+
+    def lines(self) -> list[str]:
+        """Recorded transactions, oldest first"""
+        recorded = self.recorded
+        first = max(0, recorded - self.size)
+        threads = {thread.ident: thread.name for thread in threading.enumerate()}
+
+        lines = []
+        for sequence in range(first, recorded):
+            slot = sequence % self.size
+            result = self._result[slot]
+            register = self._register[slot]
+            lines.append(
+                f"{self._start[slot]:.6f} "
+                f"{threads.get(self._thread[slot], self._thread[slot]):<16} "
+                f"0x{self._address[slot]:02x} "
+                f"{'read    ' if register == NO_REGISTER else f'reg 0x{register:02x}'} "
+                f"len {self._length[slot]:<3} {self._duration[slot] * 1e6:9.1f}us "
+                f"{'ok' if result == 0 else f'error {result}'}"
+            )
+        return lines
+
+    def snapshot(self, reason: str):
+        """Keep a copy of the buffer as it was when an error happened"""
+        self.snapshots.append((time.perf_counter(), reason, self.lines()))
+        logger.debug(f"I2C trace snapshot taken: {reason}")
+
+    def dump(self, path: str):
+        """Write the error snapshots and the current buffer to path"""
+        with open(path + ".tmp", "w") as f:
+            for taken, reason, lines in self.snapshots:
+                f.write(f"# snapshot at {taken:.6f}: {reason}\n")
+                f.writelines(line + "\n" for line in lines)
+                f.write("\n")
+            f.write(f"# current buffer, {self.recorded} transactions recorded\n")
+            f.writelines(line + "\n" for line in self.lines())
+        os.replace(path + ".tmp", path)
+        logger.info(f"I2C trace written to {path}")
+
+
+class TracedI2C:
+    """busio.I2C that records every transaction, the calls adafruit_bus_device makes"""
+
+    def __init__(self, i2c, tracer: I2CTracer) -> None:
+        self._i2c = i2c
+        self._tracer = tracer
+
+    def __getattr__(self, name: str):
+        return getattr(self._i2c, name)
+
+    def _call(self, address: int, register: int, length: int, function, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            result = function(*args, **kwargs)
+        except OSError as e:
+            self._tracer.record(
+                address, register, length, start, time.perf_counter() - start, e.errno or -1
+            )
+            raise
+        self._tracer.record(address, register, length, start, time.perf_counter() - start)
+        return result
+
+    def writeto(self, address: int, buffer, *, start: int = 0, end: int | None = None):
+        end = len(buffer) if end is None else end
+        register = buffer[start] if end > start else NO_REGISTER
+        return self._call(
+            address,
+            register,
+            max(end - start - 1, 0),
+            self._i2c.writeto,
+            address,
+            buffer,
+            start=start,
+            end=end,
+        )
+
+    def readfrom_into(self, address: int, buffer, *, start: int = 0, end: int | None = None):
+        end = len(buffer) if end is None else end
+        return self._call(
+            address,
+            NO_REGISTER,
+            end - start,
+            self._i2c.readfrom_into,
+            address,
+            buffer,
+            start=start,
+            end=end,
+        )
+
+    def writeto_then_readfrom(
+        self,
+        address: int,
+        buffer_out,
+        buffer_in,
+        *,
+        out_start: int = 0,
+        out_end: int | None = None,
+        in_start: int = 0,
+        in_end: int | None = None,
+    ):
+        out_end = len(buffer_out) if out_end is None else out_end
+        in_end = len(buffer_in) if in_end is None else in_end
+        register = buffer_out[out_start] if out_end > out_start else NO_REGISTER
+        return self._call(
+            address,
+            register,
+            in_end - in_start,
+            self._i2c.writeto_then_readfrom,
+            address,
+            buffer_out,
+            buffer_in,
+            out_start=out_start,
+            out_end=out_end,
+            in_start=in_start,
+            in_end=in_end,
+        )
+
+
+class TracedSMBus:
+    """smbus2.SMBus that records every transaction of the calls subsystems.pca9685 makes"""
+
+    def __init__(self, bus: "smbus2.SMBus", tracer: I2CTracer) -> None:
+        self._bus = bus
+        self._tracer = tracer
+
+    def __getattr__(self, name: str):
+        return getattr(self._bus, name)
+
+    def _call(self, address: int, register: int, length: int, function, *args):
+        start = time.perf_counter()
+        try:
+            result = function(*args)
+        except OSError as e:
+            self._tracer.record(
+                address, register, length, start, time.perf_counter() - start, e.errno or -1
+            )
+            raise
+        self._tracer.record(address, register, length, start, time.perf_counter() - start)
+        return result
+
+    def i2c_rdwr(self, *messages):
+        first = messages[0]
+        if first.flags & 0x0001:  # I2C_M_RD
+            register, length = NO_REGISTER, sum(message.len for message in messages)
+        else:
+            register = first.buf[0][0]
+            length = sum(message.len for message in messages) - 1
+        return self._call(first.addr, register, length, self._bus.i2c_rdwr, *messages)
+
+    def read_byte(self, address: int, *args):
+        return self._call(address, NO_REGISTER, 1, self._bus.read_byte, address, *args)
+
+    def read_byte_data(self, address: int, register: int, *args):
+        return self._call(
+            address, register, 1, self._bus.read_byte_data, address, register, *args
+        )
+
+    def write_byte_data(self, address: int, register: int, value: int, *args):
+        return self._call(
+            address, register, 1, self._bus.write_byte_data, address, register, value, *args
+        )
+
+
+def enable_tracing(size: int = 4096) -> I2CTracer:
+    """Start recording I2C transactions of every bus opened from now on"""
+    global _tracer
+    if _tracer is None:
+        _tracer = I2CTracer(size)
+    return _tracer
+
+
+def get_tracer() -> I2CTracer | None:
+    return _tracer
+
+
 if __name__ == "__main__":
     print(list_devices())
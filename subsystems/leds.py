@@ -3,22 +3,29 @@ AutoLight LED Subsystem
 Main and Extra Channel classes
 """
 
+from array import array
+from collections import deque
 from dataclasses import dataclass
 import math
 import random
 import sys
 import threading
 import time
-import board
-import busio
-import adafruit_pca9685
 import atexit
 import enum
+from typing import Callable
 
 from loguru import logger
 
+from metrics import REGISTRY
+from subsystems.framebuffer import FrameBufferWriter
+from subsystems.i2c import get_shared_i2c, get_tracer
 from subsystems.sensors import NullSensor, GPIOSensor, VL53L0XSensor
 from data_types import ExtraLightData, ExtraEffects
+from utils import SYSTEM_CLOCK, SystemClock, TimerHeap, VirtualClock
+
+
+PCA9685_ADDRESS = 0x40
 
 
 class PowerUnits(enum.Enum):
@@ -55,6 +62,14 @@ class FadeAnimation:
     sync: LedSync = LedSync.SYNC
 
 
+@dataclass
+class FadeOutAnimation:
+    """Linear fade from the led brightness to off, once"""
+
+    start: float = 0.0
+    duration: float = 1.0
+
+
 @dataclass
 class NullAnimation:
     """Steady brightness, animations disabled"""
@@ -70,15 +85,33 @@ class LedSettings:
     freq: int = 60
     fps: int = 240
     auto_shutdown: bool = True
+    driver: str = "adafruit"
+    i2c_bus: int = 1
 
 
 class PCA9685LedArray:
     """Array of PCA9685-Driven monochromatic leds starting at index 0"""
 
-    def __init__(self, settings: LedSettings = LedSettings()) -> None:
-        self.i2c = busio.I2C(board.SCL, board.SDA)
-        self.pca = adafruit_pca9685.PCA9685(self.i2c)
-        self.pca.reset()
+    def __init__(
+        self,
+        settings: LedSettings = LedSettings(),
+        pca=None,
+        clock: SystemClock | VirtualClock = SYSTEM_CLOCK,
+    ) -> None:
+        """
+        Args:
+            settings: Led array settings
+            pca: Already created PCA9685 driver, such as subsystems.sim.SimulatedPCA9685
+            clock: Source of animation time and frame sleeps, frame costs are always measured in real time
+        """
+        self.clock = clock
+        self.driver = settings.driver
+        self.i2c_bus = settings.i2c_bus
+        self.i2c = None  # Blinka bus, only created for the Adafruit driver
+        if pca is None:
+            self.pca = self._create_pca()
+        else:
+            self.pca = pca
 
         if settings.auto_shutdown:
             atexit.register(self.end)
@@ -89,20 +122,91 @@ class PCA9685LedArray:
         ]
         self._fps = settings.fps
 
+        # Per-animation rngs
+        self._rng_bools: list[bool | int] = [0] * len(self._led_data)
+        self._rng_bools_time = 0
+
         self.enable_recovery = True
 
+        # Optional I2C transaction trace, recorded by the bus, see subsystems.i2c.enable_tracing
+        self.tracer = get_tracer()
+
+        # Last value written to every channel, committed to frame_buffer after each frame
+        self.duty_cycles = array("H", [0]) * len(self.pca.channels)
+        self.frame_buffer: FrameBufferWriter | None = None
+
+        # Frame start intervals, see realtime.JitterMeter
+        self.jitter = None
+        # Callables to run once on the render thread itself, see call_in_loop
+        self._loop_calls: deque[Callable[[], None]] = deque()
+        # Frames written without an I2C error, counted by the render thread only
+        self.frames = 0
+
+        self.freq = settings.freq
         self.pca.frequency = settings.freq
 
+        # Metrics
+        self.frame_meter = REGISTRY.frame_meter("leds")
+        self.i2c_transactions = REGISTRY.counter(
+            "autolight_i2c_transactions_total",
+            "I2C transactions per device",
+            device=f"pca9685@0x{PCA9685_ADDRESS:x}",
+        )
+        self.i2c_errors = REGISTRY.counter(
+            "autolight_i2c_errors_total",
+            "Failed I2C transactions per device",
+            device=f"pca9685@0x{PCA9685_ADDRESS:x}",
+        )
+        self.recoveries = REGISTRY.counter(
+            "autolight_pca_recoveries_total", "PCA9685 resets after I2C errors"
+        )
+
         logger.debug(f"Created new LedArray with settings {settings}")
 
+    def _create_pca(self):
+        if self.driver == "smbus2":
+            # Only a missing smbus2 or /dev/i2c-N falls back, errors on the bus are raised
+            try:
+                from subsystems.pca9685 import SMBusPCA9685
+
+                pca = SMBusPCA9685(self.i2c_bus, PCA9685_ADDRESS)
+            except (ImportError, FileNotFoundError) as e:
+                logger.warning(
+                    f"Direct PCA9685 driver unavailable, {repr(e)}, falling back to the Adafruit driver"
+                )
+            else:
+                try:
+                    pca.reset()
+                except OSError:
+                    pca.bus.close()
+                    raise
+                return pca
+
+        import adafruit_pca9685
+
+        if self.i2c is None:
+            self.i2c = get_shared_i2c()
+        pca = adafruit_pca9685.PCA9685(self.i2c)
+        pca.reset()
+        return pca
+
+    @property
+    def _batched(self) -> bool:
+        return hasattr(self.pca, "write_channels")
+
     def set_freq(self, freq: int):
+        self.freq = freq
         self.pca.frequency = freq
 
     def set_fps(self, fps: float):
         self._fps = fps
 
     def set_raw_channel_value(self, channel: int, brightness: int):
-        self.pca.channels[channel].duty_cycle = brightness
+        self._write_channel(channel, brightness)
+
+    def call_in_loop(self, function: Callable[[], None]):
+        """Run function once on the render thread, before its next frame"""
+        self._loop_calls.append(function)
 
     def get_led_count(self):
         return len(self._led_data)
@@ -120,7 +224,7 @@ class PCA9685LedArray:
     def set_animation(
         self,
         index: int,
-        animation: NullAnimation | BlinkAnimation | FadeAnimation = NullAnimation(),
+        animation: NullAnimation | BlinkAnimation | FadeAnimation | FadeOutAnimation = NullAnimation(),
     ):
         self._led_data[index]["animation"] = animation
 
@@ -135,122 +239,137 @@ class PCA9685LedArray:
         for channel in self.pca.channels:
             channel.duty_cycle = 0
 
-    def update_loop(self):
+    def _write_channel(self, index: int, duty_cycle: int):
+        self.duty_cycles[index] = duty_cycle
+        self.pca.channels[index].duty_cycle = duty_cycle
+
+    def _store_channel(self, index: int, duty_cycle: int):
+        self.duty_cycles[index] = duty_cycle
+
+    def _write_frame(self):
+        """Write every main channel from duty_cycles in one transaction"""
+        self.pca.write_channels(self.duty_cycles, 0, len(self._led_data))
+
+    def _refresh_rng_bools(self):
+        # Filled in place, the render loop never allocates a new list
+        for index in range(len(self._rng_bools)):
+            self._rng_bools[index] = random.getrandbits(1)
+        self._rng_bools_time = self.clock.time()
+
+    def render_frame(self, loop_time: float):
+        """Write one frame of every main led to the PCA9685"""
+        # Drivers with write_channels get the whole frame in one transaction at the end
+        write = self._store_channel if self._batched else self._write_channel
+        for index, led in enumerate(self._led_data):
+            if self._led_data[index]["power"] is False:
+                write(index, 0)
+                continue
+
+            if isinstance(led["animation"], NullAnimation):
+                write(index, self._led_data[index]["brightness"])
+            elif isinstance(led["animation"], BlinkAnimation):
+                current_time = loop_time % (
+                    led["animation"].on_time + led["animation"].off_time
+                )
+                wave_output = current_time < led["animation"].on_time
+                if led["animation"].sync == LedSync.SYNC:
+                    if wave_output:
+                        write(index, self._led_data[index]["brightness"])
+                    else:
+                        write(index, 0)
+                elif led["animation"].sync == LedSync.STAGGERED:
+                    if (not wave_output) if index % 2 else wave_output:
+                        write(index, self._led_data[index]["brightness"])
+                    else:
+                        write(index, 0)
+                elif led["animation"].sync == LedSync.RANDOM_SYNC:
+                    if (
+                        self.clock.time() - self._rng_bools_time
+                        >= led["animation"].on_time
+                    ):
+                        self._refresh_rng_bools()
+                    if self._rng_bools[0]:
+                        write(index, self._led_data[index]["brightness"])
+                    else:
+                        write(index, 0)
+                elif led["animation"].sync == LedSync.RANDOM_UNSYNC:
+                    if (
+                        self.clock.time() - self._rng_bools_time
+                        >= led["animation"].on_time
+                    ):
+                        self._refresh_rng_bools()
+                    if self._rng_bools[index]:
+                        write(index, self._led_data[index]["brightness"])
+                    else:
+                        write(index, 0)
+                else:
+                    raise NotImplementedError(
+                        f"Sync mode {led['animation'].sync} is not implemented"
+                    )
 
-        # Per-animation rngs
-        last_rng_bools: list[bool | int] = [0] * len(self._led_data)
-        last_rng_bools_time = 0
+            elif isinstance(led["animation"], FadeAnimation):
+                wave_output = (
+                    1
+                    + (math.sin(loop_time * led["animation"].speed_multiplier))
+                ) / 2
+                if led["animation"].sync == LedSync.SYNC:
+                    if wave_output:
+                        write(
+                            index, int(self._led_data[index]["brightness"] * wave_output)
+                        )
+                    else:
+                        write(index, 0)
+                elif led["animation"].sync == LedSync.STAGGERED:
+                    if (not wave_output) if index % 2 else wave_output:
+                        write(
+                            index, int(self._led_data[index]["brightness"] * wave_output)
+                        )
+                    else:
+                        write(
+                            index, int(self._led_data[index]["brightness"] * (1 - wave_output))
+                        )
+                else:
+                    raise NotImplementedError(
+                        f"Sync mode {led['animation'].sync} is not implemented"
+                    )
 
+            elif isinstance(led["animation"], FadeOutAnimation):
+                remaining = 1 - (loop_time - led["animation"].start) / led["animation"].duration
+                write(index, int(self._led_data[index]["brightness"] * min(max(remaining, 0), 1)))
+
+        if self._batched:
+            self._write_frame()
+
+    def update_loop(self):
         while True:
-            loop_time = time.time()
-            time.sleep(1 / self._fps)
+            loop_time = self.clock.time()
+            self.clock.sleep(1 / self._fps)
+            frame_start = time.perf_counter()
+            if self.jitter:
+                self.jitter.record(frame_start)
+            while self._loop_calls:
+                self._loop_calls.popleft()()
             try:
-                for index, led in enumerate(self._led_data):
-                    if self._led_data[index]["power"] is False:
-                        self.pca.channels[index].duty_cycle = 0
-                        continue
-
-                    if isinstance(led["animation"], NullAnimation):
-                        self.pca.channels[index].duty_cycle = self._led_data[index][
-                            "brightness"
-                        ]
-                    elif isinstance(led["animation"], BlinkAnimation):
-                        current_time = loop_time % (
-                            led["animation"].on_time + led["animation"].off_time
-                        )
-                        wave_output = current_time < led["animation"].on_time
-                        if led["animation"].sync == LedSync.SYNC:
-                            if wave_output:
-                                self.pca.channels[index].duty_cycle = self._led_data[
-                                    index
-                                ]["brightness"]
-                            else:
-                                self.pca.channels[index].duty_cycle = 0
-                        elif led["animation"].sync == LedSync.STAGGERED:
-                            if (not wave_output) if index % 2 else wave_output:
-                                self.pca.channels[index].duty_cycle = self._led_data[
-                                    index
-                                ]["brightness"]
-                            else:
-                                self.pca.channels[index].duty_cycle = 0
-                        elif led["animation"].sync == LedSync.RANDOM_SYNC:
-                            if (
-                                time.time() - last_rng_bools_time
-                                >= led["animation"].on_time
-                            ):
-                                last_rng_bools = [
-                                    random.getrandbits(1)
-                                    for _ in range(len(self._led_data))
-                                ]
-                                last_rng_bools_time = time.time()
-                            if last_rng_bools[0]:
-                                self.pca.channels[index].duty_cycle = self._led_data[
-                                    index
-                                ]["brightness"]
-                            else:
-                                self.pca.channels[index].duty_cycle = 0
-                        elif led["animation"].sync == LedSync.RANDOM_UNSYNC:
-                            if (
-                                time.time() - last_rng_bools_time
-                                >= led["animation"].on_time
-                            ):
-                                last_rng_bools = [
-                                    random.getrandbits(1)
-                                    for _ in range(len(self._led_data))
-                                ]
-                                last_rng_bools_time = time.time()
-                            if last_rng_bools[index]:
-                                self.pca.channels[index].duty_cycle = self._led_data[
-                                    index
-                                ]["brightness"]
-                            else:
-                                self.pca.channels[index].duty_cycle = 0
-                        else:
-                            raise NotImplementedError(
-                                f"Sync mode {led['animation'].sync} is not implemented"
-                            )
-
-                    elif isinstance(led["animation"], FadeAnimation):
-                        wave_output = (
-                            1
-                            + (math.sin(loop_time * led["animation"].speed_multiplier))
-                        ) / 2
-                        if led["animation"].sync == LedSync.SYNC:
-                            if wave_output:
-                                self.pca.channels[index].duty_cycle = int(
-                                    self._led_data[index]["brightness"] * wave_output
-                                )
-                            else:
-                                self.pca.channels[index].duty_cycle = 0
-                        elif led["animation"].sync == LedSync.STAGGERED:
-                            if (not wave_output) if index % 2 else wave_output:
-                                self.pca.channels[index].duty_cycle = int(
-                                    self._led_data[index]["brightness"] * wave_output
-                                )
-                            else:
-                                self.pca.channels[index].duty_cycle = int(
-                                    self._led_data[index]["brightness"]
-                                    * (1 - wave_output)
-                                )
-                        else:
-                            raise NotImplementedError(
-                                f"Sync mode {led['animation'].sync} is not implemented"
-                            )
+                self.render_frame(loop_time)
+                if self.frame_buffer:
+                    self.frame_buffer.commit(self.duty_cycles, loop_time)
+                self.i2c_transactions.inc(1 if self._batched else len(self._led_data))
+                self.frames += 1
+                self.frame_meter.frame(time.perf_counter() - frame_start)
             except OSError as e:
+                self.i2c_errors.inc()
                 logger.error(f"Failed to read from i2c, {repr(e)}")
+                if self.tracer:
+                    self.tracer.snapshot(f"pca9685@0x{PCA9685_ADDRESS:x} {repr(e)}")
                 if self.enable_recovery:
-                    time.sleep(0.5)
+                    self.recoveries.inc()
+                    self.clock.sleep(0.5)
 
+                    # The driver and its open bus are kept, a new one per error would leak a descriptor
                     try:
-                        logger.debug(
-                            f"Reloading PCA9685 driver using {self.pca.frequency}hz"
-                        )
-                        frequency = self.pca.frequency
-
-                        self.pca = adafruit_pca9685.PCA9685(self.i2c)
+                        logger.debug(f"Resetting PCA9685 to {self.freq}hz")
                         self.pca.reset()
-
-                        self.pca.frequency = frequency
+                        self.pca.frequency = self.freq
                     except (OSError, RuntimeError) as e:
                         logger.error(f"Failed to recover i2c, {repr(e)}, retrying...")
                 else:
@@ -260,7 +379,24 @@ class PCA9685LedArray:
 
 
 class PCA9685ExtraChannel:
-    def __init__(self, controller: PCA9685LedArray, channel: int, sensor: NullSensor | GPIOSensor | VL53L0XSensor = NullSensor()) -> None:
+    def __init__(
+        self,
+        controller: PCA9685LedArray,
+        channel: int,
+        sensor: NullSensor | GPIOSensor | VL53L0XSensor = NullSensor(),
+        hold: float = 0.0,
+        fade_out: float = 0.0,
+        timers: TimerHeap | None = None,
+    ) -> None:
+        """
+        Args:
+            controller: Led array owning the PCA9685
+            channel: PCA9685 channel, after the main leds
+            sensor: Sensor followed by the sensor effect
+            hold: Seconds the sensor effect stays on after the sensor clears
+            fade_out: Seconds of fading out once the hold ends
+            timers: Hold timers, shared by the extra channels and run by their animation loop
+        """
         # sanity checks
         if channel < controller.get_led_count():
             logger.critical(f"An extra led channel {channel} is being initialized in the main channels 0~{controller.get_led_count()-1}. Exiting")
@@ -269,14 +405,61 @@ class PCA9685ExtraChannel:
         self.controller = controller
         self.channel = channel
         self.sensor = sensor
+        self.hold = hold
+        self.fade_out = fade_out
+        self.timers = timers if timers is not None else TimerHeap()
+
+        self._tripped = False
+        self._held = False  # On after the sensor cleared, until the hold and fade out end
+        self._fade_start: float | None = None
+
+    def _release(self):
+        self.timers.cancel(self.channel)
+        self._held = False
+        self._fade_start = None
+
+    def _hold_expired(self, deadline: float):
+        if self.fade_out > 0:
+            self._fade_start = deadline
+            self.timers.schedule(self.channel, deadline + self.fade_out, self._fade_expired)
+        else:
+            self._release()
+
+    def _fade_expired(self, deadline: float):
+        self._release()
+
+    def _sensor_level(self) -> float:
+        """1 while tripped or held, falling to 0 over the fade out"""
+        tripped = self.sensor.tripped
+        if tripped:
+            if self._held:
+                self._release()
+        elif self._tripped and (self.hold > 0 or self.fade_out > 0):
+            self._held = True
+            self.timers.schedule(
+                self.channel, self.controller.clock.time() + self.hold, self._hold_expired
+            )
+        self._tripped = tripped
+
+        if tripped:
+            return 1.0
+        if not self._held:
+            return 0.0
+        if self._fade_start is None:
+            return 1.0
+        elapsed = self.controller.clock.time() - self._fade_start
+        return min(max(1 - elapsed / self.fade_out, 0.0), 1.0)
 
     def animation_cycle(self, channel_data: ExtraLightData):
+        self.controller.i2c_transactions.inc()
         if not channel_data.power:
-            self.controller.pca.channels[self.channel].duty_cycle = 0
+            self.controller.set_raw_channel_value(self.channel, 0)
             return
         
         if channel_data.effect == ExtraEffects.STEADY:
-            self.controller.pca.channels[self.channel].duty_cycle = channel_data.brightness * 257
+            self.controller.set_raw_channel_value(self.channel, channel_data.brightness * 257)
         elif channel_data.effect == ExtraEffects.SENSOR:
-            self.controller.pca.channels[self.channel].duty_cycle = channel_data.brightness * 257 if self.sensor.tripped else 0
+            self.controller.set_raw_channel_value(
+                self.channel, int(channel_data.brightness * 257 * self._sensor_level())
+            )
 
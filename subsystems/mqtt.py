@@ -0,0 +1,467 @@
+"""
+AutoLight MQTT Subsystem
+Home Assistant publishing helpers
+"""
+
+import dataclasses
+import hashlib
+import json
+import os
+import threading
+import time
+from enum import Enum
+from typing import Callable, TypeVar
+
+from ha_mqtt_discoverable import Discoverable, Settings as HASettings
+from ha_mqtt_discoverable.sensors import BinarySensor, Sensor, Light
+from paho.mqtt.client import Client, MQTTMessage
+
+from loguru import logger
+
+from data_types import LightingData, ExtraLightData
+from metrics import REGISTRY
+from utils import clamp
+
+try:
+    import orjson
+
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+LightDataType = TypeVar("LightDataType", LightingData, ExtraLightData)
+
+
+def decode_json_payload(payload: bytes) -> dict:
+    """Decode an MQTT JSON object payload, using orjson when it is installed"""
+    decoded = _json_loads(payload)
+    if not isinstance(decoded, dict):
+        raise ValueError(f"Expected a JSON object, got {type(decoded).__name__}")
+    return decoded
+
+
+def apply_light_command(
+    data: LightDataType, payload: dict, effects: dict[str, Enum], payload_on: str
+) -> LightDataType:
+    """Apply every field of a JSON schema light command as one new state
+
+    Raises:
+        KeyError: Unknown effect name
+        ValueError: Invalid brightness
+    """
+    changes = {}
+    if "state" in payload:
+        changes["power"] = payload["state"] == payload_on
+    if "brightness" in payload:
+        changes["brightness"] = clamp(int(payload["brightness"]), 0, 255)
+    if "effect" in payload:
+        changes["effect"] = effects[payload["effect"]]
+    return dataclasses.replace(data, **changes)
+
+
+class DiscoveryCache:
+    """Hashes of the discovery configs the broker already retains, kept in a local file"""
+
+    def __init__(self, path: str | None, broker: str) -> None:
+        self.path = path
+        self.broker = broker
+        self._hashes: dict[str, str] = {}
+        self._lock = threading.Lock()
+
+        if not path or not os.path.exists(path):
+            return
+
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable discovery cache {path}, {repr(e)}")
+            return
+
+        # Retained configs live on the broker, a different broker has none of them
+        if data.get("broker") == broker:
+            self._hashes = data.get("configs", {})
+
+    @staticmethod
+    def _hash(message: str) -> str:
+        return hashlib.sha1(message.encode()).hexdigest()
+
+    def is_current(self, topic: str, message: str) -> bool:
+        return self._hashes.get(topic) == self._hash(message)
+
+    def store(self, topic: str, message: str):
+        with self._lock:
+            self._hashes[topic] = self._hash(message)
+
+    def clear(self):
+        with self._lock:
+            self._hashes.clear()
+
+    def save(self):
+        if not self.path:
+            return
+
+        with self._lock:
+            data = {"broker": self.broker, "configs": dict(self._hashes)}
+        try:
+            with open(self.path + ".tmp", "w") as f:
+                json.dump(data, f, indent=1)
+            os.replace(self.path + ".tmp", self.path)
+        except OSError as e:
+            logger.warning(f"Could not write discovery cache {self.path}, {repr(e)}")
+
+
+class MqttConnection:
+    """Single MQTT client and network loop shared by every Home Assistant entity"""
+
+    def __init__(
+        self,
+        settings: HASettings.MQTT,
+        discovery_cache_path: str | None = None,
+        client: Client | None = None,
+    ) -> None:
+        self.settings = settings
+        self._subscriptions: dict[str, Callable[[Client, object, MQTTMessage], None]] = {}
+        self._entities: list["_SharedClientEntity"] = []
+
+        # Called with (published, skipped) after every (re)connect and announce
+        self.on_ready: Callable[[int, int], None] | None = None
+
+        self.discovery_cache = DiscoveryCache(
+            discovery_cache_path, f"{settings.host}:{settings.port}"
+        )
+        # Configs published but not yet acknowledged by the broker, by message id
+        self._unconfirmed: dict[int, tuple[str, str]] = {}
+        self._unconfirmed_lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self.configs_published = REGISTRY.counter(
+            "autolight_mqtt_publishes_total", "MQTT messages published", publisher="discovery"
+        )
+        self.configs_skipped = REGISTRY.counter(
+            "autolight_mqtt_suppressed_total",
+            "MQTT messages skipped as unchanged or rate limited",
+            publisher="discovery",
+        )
+
+        self.client = client or Client(settings.client_name)
+        if settings.username:
+            self.client.username_pw_set(settings.username, password=settings.password)
+        self.client.on_connect = self._on_connect
+        self.client.on_publish = self._on_publish
+
+        # Home Assistant birth message, it may have lost every entity
+        self.subscribe(f"{settings.discovery_prefix}/status", self._on_ha_status)
+
+    def connect(self, min_retry_delay: float = 1, max_retry_delay: float = 60):
+        """Connect in the background, retrying with exponential backoff until the broker is up"""
+        self.client.reconnect_delay_set(min_retry_delay, max_retry_delay)
+        self.client.connect_async(self.settings.host, self.settings.port)
+        self.client.loop_start()
+
+    def is_connected(self) -> bool:
+        return self.client.is_connected()
+
+    def subscribe(
+        self, topic: str, callback: Callable[[Client, object, MQTTMessage], None]
+    ):
+        """Route messages on topic to callback, subscriptions are restored on reconnect"""
+        self._subscriptions[topic] = callback
+        self.client.message_callback_add(topic, callback)
+        if self.client.is_connected():
+            self.client.subscribe(topic, qos=1)
+
+    def register(self, entity: "_SharedClientEntity"):
+        self._entities.append(entity)
+
+    def publish_config(self, topic: str, message: str, force: bool = False) -> bool:
+        """Publish a retained discovery config unless the broker already has it
+
+        Returns:
+            bool: Config was published
+        """
+        if not force and self.discovery_cache.is_current(topic, message):
+            self.configs_skipped.inc()
+            return False
+
+        if not self.client.is_connected():
+            # Published by the next announce() once connected
+            return False
+
+        info = self.client.publish(topic, message, qos=1, retain=True)
+        if info.rc != 0:
+            logger.warning(f"Could not publish discovery config {topic}, code {info.rc}")
+            return False
+
+        # Only cached once the broker acknowledged it, a queued message can still be lost
+        with self._unconfirmed_lock:
+            self._unconfirmed[info.mid] = (topic, message)
+        if info.is_published():
+            self._confirm(info.mid)
+        self.configs_published.inc()
+        return True
+
+    def _confirm(self, mid: int):
+        with self._unconfirmed_lock:
+            entry = self._unconfirmed.pop(mid, None)
+            done = not self._unconfirmed
+        if entry is None:
+            return
+
+        self.discovery_cache.store(*entry)
+        if done:
+            self.discovery_cache.save()
+
+    def _on_publish(self, client: Client, user_data, mid: int):
+        self._confirm(mid)
+
+    def announce(self, force: bool = False) -> tuple[int, int]:
+        """Write the discovery configs of every entity
+
+        Returns:
+            tuple[int, int]: Number of configs published and skipped
+        """
+        published = 0
+        for entity in list(self._entities):
+            published += entity.write_config(force=force)
+
+        skipped = len(self._entities) - published
+        logger.debug(f"Discovery configs: {published} published, {skipped} skipped")
+        return published, skipped
+
+    def _on_connect(self, client: Client, user_data, flags, rc):
+        if rc != 0:
+            logger.error(f"MQTT connection refused, code {rc}")
+            return
+
+        logger.debug(f"MQTT connected, subscribing to {len(self._subscriptions)} topics")
+        for topic in list(self._subscriptions):
+            client.subscribe(topic, qos=1)
+
+        # Anything published while disconnected was dropped
+        with self._unconfirmed_lock:
+            self._unconfirmed.clear()
+        self._sync_in_background(ready=True)
+
+    def _on_ha_status(self, client: Client, user_data, message: MQTTMessage):
+        if message.payload == b"online":
+            logger.info("Home Assistant came online, re-announcing all entities")
+            self._sync_in_background(force=True)
+
+    def _sync_in_background(self, force: bool = False, ready: bool = False):
+        """Announce off the network thread, on_ready may wait and acks must keep flowing"""
+        threading.Thread(
+            target=self._sync, args=(force, ready), name="mqtt_announce", daemon=True
+        ).start()
+
+    def _sync(self, force: bool, ready: bool):
+        with self._sync_lock:
+            published, skipped = self.announce(force=force)
+            if ready and self.on_ready:
+                self.on_ready(published, skipped)
+
+
+class _SharedClientEntity:
+    """Use the MqttConnection client instead of one client per entity"""
+
+    _connection: MqttConnection
+
+    def __init__(self, settings: HASettings, connection: MqttConnection, *args):
+        self._connection = connection
+        super().__init__(settings, *args)
+
+    def _setup_client(self, on_connect=None):
+        self.mqtt_client = self._connection.client
+        self._connection.register(self)
+
+    def write_config(self, force: bool = False) -> bool:
+        """Publish the discovery config through the shared connection's cache"""
+        config_message = json.dumps(self.generate_config())
+        self.wrote_configuration = True
+        self.config_message = config_message
+
+        if self._settings.debug:
+            logger.debug("Debug mode is enabled, skipping config write.")
+            return False
+
+        return self._connection.publish_config(
+            self.config_topic, config_message, force=force
+        )
+
+    def _connect_client(self):
+        pass  # The shared connection owns the network loop
+
+    def __del__(self):
+        pass  # Never disconnect the shared client
+
+
+class SharedBinarySensor(_SharedClientEntity, BinarySensor):
+    pass
+
+
+class SharedSensor(_SharedClientEntity, Sensor):
+    pass
+
+
+class SharedLight(_SharedClientEntity, Light):
+    def __init__(
+        self,
+        settings: HASettings,
+        connection: MqttConnection,
+        command_callback: Callable[[Client, object, MQTTMessage], None],
+    ):
+        self._connection = connection
+        # Subscriber.__init__ would take over on_message of the shared client
+        Discoverable.__init__(self, settings)
+        self._command_topic = (
+            f"{self._settings.mqtt.state_prefix}/{self._entity_topic}/command"
+        )
+        connection.subscribe(self._command_topic, command_callback)
+
+        self._published = REGISTRY.counter(
+            "autolight_mqtt_publishes_total", "MQTT messages published", publisher="lights"
+        )
+
+    def publish_state(
+        self, data: LightingData | ExtraLightData, effects: dict[str, Enum]
+    ) -> None:
+        """Publish power, brightness and effect as one coalesced state message"""
+        state = {
+            "state": self._entity.payload_on if data.power else self._entity.payload_off,
+            "brightness": data.brightness,
+        }
+        for name, effect in effects.items():
+            if effect == data.effect:
+                state["effect"] = name
+                break
+        self._update_state(state)
+        self._published.inc()
+
+
+class SensorStatePublisher:
+    """Publish sensor entity states only on edges, with rate-limited distance attributes"""
+
+    def __init__(
+        self,
+        connection: MqttConnection,
+        ha_sensors: list[SharedBinarySensor],
+        distance_delta: float = 2.0,
+        distance_min_interval: float = 1.0,
+        state_min_interval: float = 0.0,
+    ) -> None:
+        self.connection = connection
+        self.ha_sensors = ha_sensors
+        self.distance_delta = distance_delta
+        self.distance_min_interval = distance_min_interval
+        # Edges inside this interval are held back and sent once it has passed
+        self.state_min_interval = state_min_interval
+
+        self._last_states: list[bool | None] = [None] * len(ha_sensors)
+        self._last_state_times: list[float] = [0.0] * len(ha_sensors)
+        self._last_distances: list[float | None] = [None] * len(ha_sensors)
+        self._last_distance_times: list[float] = [0.0] * len(ha_sensors)
+
+        self.sent = REGISTRY.counter(
+            "autolight_mqtt_publishes_total", "MQTT messages published", publisher="sensors"
+        )
+        self.suppressed = REGISTRY.counter(
+            "autolight_mqtt_suppressed_total",
+            "MQTT messages skipped as unchanged or rate limited",
+            publisher="sensors",
+        )
+
+    def reset(self):
+        """Forget published values, everything is re-sent on the next publish"""
+        self._last_states = [None] * len(self.ha_sensors)
+        self._last_state_times = [0.0] * len(self.ha_sensors)
+        self._last_distances = [None] * len(self.ha_sensors)
+        self._last_distance_times = [0.0] * len(self.ha_sensors)
+
+    def publish(self, index: int, tripped: bool, distance: float | None = None):
+        if not self.connection.is_connected():
+            # Nothing is recorded, so the current values are sent once connected
+            return
+
+        now = time.time()
+        if (
+            tripped != self._last_states[index]
+            and now - self._last_state_times[index] >= self.state_min_interval
+        ):
+            self.ha_sensors[index]._update_state(tripped)
+            self._last_states[index] = tripped
+            self._last_state_times[index] = now
+            self.sent.inc()
+        else:
+            self.suppressed.inc()
+
+        if distance is None:
+            return
+
+        last_distance = self._last_distances[index]
+        if (
+            last_distance is None or abs(distance - last_distance) >= self.distance_delta
+        ) and now - self._last_distance_times[index] >= self.distance_min_interval:
+            self.ha_sensors[index].set_attributes({"distance": distance})
+            self._last_distances[index] = distance
+            self._last_distance_times[index] = now
+            self.sent.inc()
+        else:
+            self.suppressed.inc()
+
+
+class AggregateSensorPublisher:
+    """Publish the whole sensor trip vector as a bitmask in one message per change"""
+
+    def __init__(
+        self,
+        connection: MqttConnection,
+        topic: str,
+        include_distances: bool = False,
+        distance_quantum: float = 5.0,
+    ) -> None:
+        self.connection = connection
+        self.topic = topic
+        self.include_distances = include_distances
+        self.distance_quantum = distance_quantum
+
+        self._last_message: bytes | None = None
+
+        self.sent = REGISTRY.counter(
+            "autolight_mqtt_publishes_total", "MQTT messages published", publisher="aggregate"
+        )
+        self.suppressed = REGISTRY.counter(
+            "autolight_mqtt_suppressed_total",
+            "MQTT messages skipped as unchanged or rate limited",
+            publisher="aggregate",
+        )
+
+    def reset(self):
+        """Forget the published message, it is re-sent on the next publish"""
+        self._last_message = None
+
+    def publish(self, trips: list[bool], distances: list[float | None]):
+        if not self.connection.is_connected():
+            return
+
+        # Bit i is set when sensor i is tripped
+        mask = 0
+        for index, tripped in enumerate(trips):
+            if tripped:
+                mask |= 1 << index
+
+        message = {"mask": mask, "count": len(trips)}
+        if self.include_distances:
+            message["distances"] = [
+                None
+                if distance is None
+                else int(round(distance / self.distance_quantum) * self.distance_quantum)
+                for distance in distances
+            ]
+
+        encoded = json.dumps(message, separators=(",", ":")).encode()
+        if encoded == self._last_message:
+            self.suppressed.inc()
+            return
+
+        self.connection.client.publish(self.topic, encoded, retain=True)
+        self._last_message = encoded
+        self.sent.inc()
@@ -0,0 +1,143 @@
+"""
+AutoLight PCA9685 Driver
+Talks to the PCA9685 through smbus2 on /dev/i2c-N, without the Blinka, bus device and
+Adafruit register layers, and writes whole frames in one auto-increment transaction
+"""
+
+import ctypes
+import threading
+import time
+from array import array
+
+import smbus2
+from smbus2 import i2c_msg
+
+from subsystems.i2c import TracedSMBus, get_tracer
+
+PCA9685_ADDRESS = 0x40
+PCA9685_CHANNEL_COUNT = 16
+
+_MODE1 = 0x00
+_LED0_ON_L = 0x06
+_PRESCALE = 0xFE
+
+_MODE1_SLEEP = 0x10
+_MODE1_AUTO_INCREMENT = 0x20
+_MODE1_RESTART = 0x80
+
+# ON_L, ON_H, OFF_L, OFF_H per 12 bit step, the first entry is the full-off bit and the
+# last the full-on bit, same mapping from 16 bit duty cycles as adafruit_pca9685.PWMChannel
+_DUTY_BYTES = (
+    [bytes((0, 0, 0, 0x10))]
+    + [bytes((0, 0, step & 0xFF, step >> 8)) for step in range(1, 4096)]
+    + [bytes((0, 0x10, 0, 0))]
+)
+
+
+_REGISTERS = [bytes((_LED0_ON_L + 4 * channel,)) for channel in range(PCA9685_CHANNEL_COUNT)]
+
+
+def _duty_step(duty_cycle: int) -> int:
+    return 4096 if duty_cycle == 0xFFFF else duty_cycle >> 4
+
+
+def _message(address: int, register: int, length: int) -> tuple[i2c_msg, ctypes.Array]:
+    """Write message with its own buffer, starting with the register address
+
+    Messages are built once and refilled in place, instead of one i2c_msg.write per transaction
+    """
+    buffer = ctypes.create_string_buffer(1 + length)
+    buffer[0] = bytes((register,))
+    return i2c_msg(addr=address, flags=0, len=1 + length, buf=buffer), buffer
+
+
+class SMBusPWMChannel:
+    """One output, writes on every duty_cycle assignment like adafruit_pca9685.PWMChannel"""
+
+    __slots__ = ("_pca", "_message", "_buffer", "_duty_cycle")
+
+    def __init__(self, pca: "SMBusPCA9685", index: int) -> None:
+        self._pca = pca
+        self._message, self._buffer = _message(pca.address, _LED0_ON_L + 4 * index, 4)
+        self._duty_cycle = 0
+
+    @property
+    def duty_cycle(self) -> int:
+        return self._duty_cycle
+
+    @duty_cycle.setter
+    def duty_cycle(self, value: int):
+        if not 0 <= value <= 0xFFFF:
+            raise ValueError(f"Out of range: value {value} not 0 <= value <= 65,535")
+        with self._pca.lock:
+            self._buffer[1:5] = _DUTY_BYTES[_duty_step(value)]
+            self._pca.bus.i2c_rdwr(self._message)
+            self._duty_cycle = value
+
+
+class SMBusPCA9685:
+    """Drop-in for adafruit_pca9685.PCA9685, plus write_channels for batched frames"""
+
+    def __init__(
+        self,
+        bus: "int | smbus2.SMBus" = 1,
+        address: int = PCA9685_ADDRESS,
+        reference_clock_speed: int = 25_000_000,
+    ) -> None:
+        self.bus = smbus2.SMBus(bus) if isinstance(bus, int) else bus
+        tracer = get_tracer()
+        if tracer is not None and isinstance(bus, int):
+            self.bus = TracedSMBus(self.bus, tracer)
+        self.address = address
+        self.reference_clock_speed = reference_clock_speed
+        # Extra channels are written from their own thread, between the render thread's frames
+        self.lock = threading.Lock()
+        self.channels = [SMBusPWMChannel(self, index) for index in range(PCA9685_CHANNEL_COUNT)]
+
+        # Register address followed by four bytes per channel, reused by every frame
+        self._frame_message, self._frame = _message(
+            address, _LED0_ON_L, 4 * PCA9685_CHANNEL_COUNT
+        )
+
+    def reset(self):
+        # Auto-increment stays on, write_channels depends on it
+        with self.lock:
+            self.bus.write_byte_data(self.address, _MODE1, _MODE1_AUTO_INCREMENT)
+
+    @property
+    def frequency(self) -> float:
+        with self.lock:
+            prescale = self.bus.read_byte_data(self.address, _PRESCALE)
+        return self.reference_clock_speed / 4096 / prescale
+
+    @frequency.setter
+    def frequency(self, freq: float):
+        prescale = int(self.reference_clock_speed / 4096.0 / freq + 0.5)
+        if prescale < 3:
+            raise ValueError("PCA9685 cannot output at the given frequency")
+        with self.lock:
+            old_mode = self.bus.read_byte_data(self.address, _MODE1)
+            self.bus.write_byte_data(self.address, _MODE1, (old_mode & 0x7F) | _MODE1_SLEEP)
+            self.bus.write_byte_data(self.address, _PRESCALE, prescale)
+            self.bus.write_byte_data(self.address, _MODE1, old_mode)
+            time.sleep(0.005)
+            self.bus.write_byte_data(
+                self.address, _MODE1, old_mode | _MODE1_RESTART | _MODE1_AUTO_INCREMENT
+            )
+
+    def write_channels(self, duty_cycles: array, first: int, count: int):
+        """Write channels first to first + count - 1 in a single I2C transaction"""
+        frame = self._frame
+        with self.lock:
+            frame[0] = _REGISTERS[first]
+            for offset in range(count):
+                value = duty_cycles[first + offset]
+                frame[1 + 4 * offset : 5 + 4 * offset] = _DUTY_BYTES[_duty_step(value)]
+            self._frame_message.len = 1 + 4 * count
+            self.bus.i2c_rdwr(self._frame_message)
+            for offset in range(count):
+                self.channels[first + offset]._duty_cycle = duty_cycles[first + offset]
+
+    def deinit(self):
+        self.reset()
+        self.bus.close()
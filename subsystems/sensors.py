@@ -3,13 +3,14 @@ import time
 
 from loguru import logger
 
-from gpiozero import DigitalOutputDevice, DigitalInputDevice
-from adafruit_vl53l0x import VL53L0X as _VL53L0X
+from enum import Enum
 
-import board
-import busio
+from metrics import REGISTRY
+from subsystems.i2c import get_shared_i2c, get_tracer
 
-from enum import Enum
+# gpiozero creates its default pin factory with the first device, without a lock, and
+# startup phases create sensors and extra lights at the same time
+_gpio_lock = threading.Lock()
 
 
 class _StartupWarnings(Enum):
@@ -18,7 +19,8 @@ class _StartupWarnings(Enum):
 
 
 class BaseSensor:
-    pass
+    # Reports a measured distance besides the trip state
+    has_distance = False
 
 
 class NullSensor(BaseSensor):
@@ -32,7 +34,10 @@ class GPIOSensor(BaseSensor):
     def __init__(
         self, pin: int, invert: bool, pullup: bool = False, bounce_time: float = 0.0
     ):
-        self.device = DigitalInputDevice(pin, pull_up=pullup, bounce_time=bounce_time)
+        from gpiozero import DigitalInputDevice
+
+        with _gpio_lock:
+            self.device = DigitalInputDevice(pin, pull_up=pullup, bounce_time=bounce_time)
         self.invert = invert
         self.tripped = False
         self.device.when_activated = self._activated
@@ -44,6 +49,10 @@ class GPIOSensor(BaseSensor):
     def _deactivated(self):
         self.tripped = False if not self.invert else True
 
+    def close(self):
+        """Release the pin, so a new sensor can be created on it"""
+        self.device.close()
+
     def begin():
         raise NotImplementedError("This function is not implemented")
 
@@ -58,6 +67,7 @@ class GPIOSensor(BaseSensor):
 
 
 class VL53L0XSensor(BaseSensor):
+    has_distance = True
     _address = 0x30
     _initial_address = 0x29
     _address_range = 0x30
@@ -67,16 +77,21 @@ class VL53L0XSensor(BaseSensor):
     def __init__(
         self,
         shut_pin: int,
-        root_i2c: board.I2C = busio.I2C(board.SCL, board.SDA),
+        root_i2c=None,
         trip_distance: float = 20,
     ) -> None:
+        from gpiozero import DigitalOutputDevice
 
         self._trip_distance = trip_distance
         self.shut_pin = shut_pin
-        self.xshut = DigitalOutputDevice(self.shut_pin)
+        with _gpio_lock:
+            self.xshut = DigitalOutputDevice(self.shut_pin)
         self.xshut.value = 0
-        self.root_i2c = root_i2c
+        self.root_i2c = root_i2c if root_i2c is not None else get_shared_i2c()
         self.device = None
+        # Held by the updater thread around every ranging, and by anything reconfiguring the
+        # device, so their multi-register sequences never interleave
+        self._device_lock = threading.RLock()
 
         self.tripped = False
         self.value = False
@@ -86,7 +101,9 @@ class VL53L0XSensor(BaseSensor):
         VL53L0XSensor._address += 1
         VL53L0XSensor._all_classes.append(self)
 
-        self.updater_thread = threading.Thread(target=self._update_loop, daemon=True)
+        self.updater_thread = threading.Thread(
+            target=self._update_loop, name=f"vl53l0x@0x{self._address:x}", daemon=True
+        )
 
         logger.trace(
             f"Created a new class of VL53L0XSensor, using future address 0x{self._address:x}"
@@ -115,10 +132,13 @@ class VL53L0XSensor(BaseSensor):
             self.updater_thread.start()
 
         # Device will start out as 0x29, this is incremented up from 0x30 for each class
-        self.device.set_address(self._address)
+        with self._device_lock:
+            self.device.set_address(self._address)
         logger.debug(f"Sensor set address to 0x{self._address:x}")
 
     def _create_root_device(self):
+        from adafruit_vl53l0x import VL53L0X as _VL53L0X
+
         try:
             self.device = _VL53L0X(
                 self.root_i2c, address=VL53L0XSensor._initial_address
@@ -141,7 +161,8 @@ class VL53L0XSensor(BaseSensor):
 
     def start(self):
         if self.device:
-            self.device.start_continuous()
+            with self._device_lock:
+                self.device.start_continuous()
         else:
             logger.warning(
                 f"Could not re-start sensor for {self}, device has not yet been initialized"
@@ -149,7 +170,8 @@ class VL53L0XSensor(BaseSensor):
 
     def stop(self):
         if self.device:
-            self.device.stop_continuous()
+            with self._device_lock:
+                self.device.stop_continuous()
         else:
             logger.warning(
                 f"Could not stop sensor for {self}, device has not yet been initialized"
@@ -167,12 +189,20 @@ class VL53L0XSensor(BaseSensor):
     @timing_budget.setter
     def timing_budget(self, budget: int):
         if self.device:
-            self.device.measurement_timing_budget = budget
+            with self._device_lock:
+                self.device.measurement_timing_budget = budget
         else:
             logger.error(
                 f"Could not get timing budget for {self}, device has not yet been initialized"
             )
 
+    def retune(self, timing_budget: int):
+        """Change the timing budget while running, the updater waits until ranging restarts"""
+        with self._device_lock:
+            self.stop()
+            self.timing_budget = timing_budget
+            self.start()
+
     @property
     def trip_distance(self):
         return self._trip_distance
@@ -182,19 +212,38 @@ class VL53L0XSensor(BaseSensor):
         self._trip_distance = value
 
     def _update_loop(self):
+        device = f"vl53l0x@0x{self._address:x}"
+        samples = REGISTRY.counter(
+            "autolight_sensor_samples_total", "Distance samples per sensor", sensor=device
+        )
+        transactions = REGISTRY.counter(
+            "autolight_i2c_transactions_total", "I2C transactions per device", device=device
+        )
+        errors = REGISTRY.counter(
+            "autolight_i2c_errors_total", "Failed I2C transactions per device", device=device
+        )
+
+        # The transactions themselves are recorded by the shared bus
+        tracer = get_tracer()
+
         cycle = 0
         while True:
             try:
-                self.distance = self.device.distance
+                transactions.inc()
+                with self._device_lock:
+                    self.distance = self.device.distance
                 if self.distance == -1:
                     raise OSError("Forced fail due to invalid reading")
-
+                samples.inc()
                 cycle += 1
                 if cycle % 100 == 0:
                     logger.trace(
                         f"Sensor 0x{self._address:x} cycle: {cycle}, dist:{self.distance}"
                     )
             except OSError as e:
+                errors.inc()
                 logger.error(f"Failed to read from i2c, {repr(e)}")
+                if tracer:
+                    tracer.snapshot(f"{device} {repr(e)}")
 
             self.tripped = self.distance < self._trip_distance
@@ -0,0 +1,145 @@
+"""
+AutoLight Simulated Hardware
+In-memory PCA9685, sensors and MQTT client, for running without a Pi or broker
+"""
+
+from paho.mqtt.client import Client, MQTTMessage, MQTTMessageInfo
+
+from subsystems.sensors import BaseSensor
+
+
+class SimulatedPWMChannel:
+    """PCA9685 channel keeping the last written duty cycle"""
+
+    __slots__ = ("duty_cycle",)
+
+    def __init__(self) -> None:
+        self.duty_cycle = 0
+
+
+class SimulatedPCA9685:
+    """Drop-in for adafruit_pca9685.PCA9685, see PCA9685LedArray(pca=...)"""
+
+    def __init__(self, channel_count: int = 16, frequency: int = 200) -> None:
+        self.channels = [SimulatedPWMChannel() for _ in range(channel_count)]
+        self.frequency = frequency
+
+    def reset(self):
+        for channel in self.channels:
+            channel.duty_cycle = 0
+
+    def deinit(self):
+        self.reset()
+
+    def write_channels(self, duty_cycles, first: int, count: int):
+        """Batched frame write, like subsystems.pca9685.SMBusPCA9685"""
+        for index in range(first, first + count):
+            self.channels[index].duty_cycle = duty_cycles[index]
+
+    @property
+    def duty_cycles(self) -> list[int]:
+        return [channel.duty_cycle for channel in self.channels]
+
+
+class NullSMBus:
+    """smbus2.SMBus that discards every transaction, to time the driver code alone"""
+
+    def __init__(self) -> None:
+        self.registers = bytearray(256)
+        self.transactions = 0
+
+    def i2c_rdwr(self, *messages):
+        self.transactions += 1
+
+    def write_byte_data(self, address: int, register: int, value: int):
+        self.registers[register] = value
+
+    def read_byte_data(self, address: int, register: int) -> int:
+        return self.registers[register]
+
+    def close(self):
+        pass
+
+
+class NullBusioI2C:
+    """busio.I2C that discards every transaction, for adafruit_pca9685 without a bus"""
+
+    def __init__(self) -> None:
+        self.transactions = 0
+
+    def try_lock(self) -> bool:
+        return True
+
+    def unlock(self):
+        pass
+
+    def writeto(self, address: int, buffer, *, start: int = 0, end: int | None = None):
+        self.transactions += 1
+
+    def readfrom_into(self, address: int, buffer, *, start: int = 0, end: int | None = None):
+        self.transactions += 1
+
+    def writeto_then_readfrom(
+        self,
+        address: int,
+        buffer_out,
+        buffer_in,
+        *,
+        out_start: int = 0,
+        out_end: int | None = None,
+        in_start: int = 0,
+        in_end: int | None = None,
+    ):
+        self.transactions += 1
+
+
+class SimulatedSensor(BaseSensor):
+    """Distance sensor fed by set_distance() instead of ranging"""
+
+    has_distance = True
+
+    def __init__(self, trip_distance: float = 20, distance: float = 999) -> None:
+        self.trip_distance = trip_distance
+        self.distance = distance
+        self.tripped = False
+        self.set_distance(distance)
+
+    def set_distance(self, distance: float):
+        self.distance = distance
+        self.tripped = distance < self.trip_distance
+
+    def set_reading(self, tripped: bool, distance: float | None = None):
+        """Recorded reading, the trip is kept even if this calibration disagrees"""
+        if distance is not None:
+            self.distance = distance
+        self.tripped = tripped
+
+
+class SimulatedMqttClient(Client):
+    """Always connected paho client, publishes are recorded instead of sent"""
+
+    def __init__(self, client_id: str = "autolight-sim") -> None:
+        super().__init__(client_id)
+        self.publish_count = 0
+        self.retained: dict[str, bytes | str | None] = {}
+
+    def is_connected(self) -> bool:
+        return True
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        self.publish_count += 1
+        if retain:
+            self.retained[topic] = payload
+        info = MQTTMessageInfo(self.publish_count)
+        info.rc = 0
+        info._set_as_published()
+        return info
+
+    def subscribe(self, topic, qos=0, options=None, properties=None):
+        return 0, 0
+
+    def deliver(self, topic: str, payload: bytes):
+        """Route an incoming message to the matching message_callback_add callbacks"""
+        message = MQTTMessage(topic=topic.encode())
+        message.payload = payload
+        self._handle_on_message(message)
@@ -1,9 +1,13 @@
+import heapq
 import platform
 import os
+import threading
+import time
+from typing import Callable, Hashable
 
 
-def surround_list(input: list[bool], radius=1):
-    padded_lst = input.copy()  # Create a copy of the original list
+def surround_list(input: list[bool] | tuple[bool, ...], radius=1):
+    padded_lst = list(input)  # Create a copy of the original list
     for i in range(len(input)):
         if input[i]:
             for j in range(1, radius + 1):
@@ -77,3 +81,109 @@ def square_wave(t, period, amplitude):
     if remainder < period / 2:
         return amplitude
     return -amplitude
+
+
+class SystemClock:
+    """Wall clock time and real sleeps"""
+
+    def time(self) -> float:
+        return time.time()
+
+    def sleep(self, seconds: float):
+        time.sleep(seconds)
+
+    def wait_for(
+        self, condition: threading.Condition, predicate: Callable[[], bool], timeout: float
+    ) -> bool:
+        """condition.wait_for, the caller holds condition"""
+        return condition.wait_for(predicate, timeout)
+
+
+class VirtualClock:
+    """Simulated time, every sleep advances it instantly
+
+    For a single thread driving the simulation, so an hour of traffic runs in seconds
+    """
+
+    def __init__(self, start: float = 0.0) -> None:
+        self._now = start
+        self._lock = threading.Lock()
+
+    def time(self) -> float:
+        return self._now
+
+    def sleep(self, seconds: float):
+        self.advance(seconds)
+
+    def advance(self, seconds: float):
+        with self._lock:
+            self._now += max(seconds, 0.0)
+
+    def wait_for(
+        self, condition: threading.Condition, predicate: Callable[[], bool], timeout: float
+    ) -> bool:
+        """Returns at once, after advancing by timeout when predicate is not already true"""
+        if predicate():
+            return True
+        self.advance(timeout)
+        return predicate()
+
+
+SYSTEM_CLOCK = SystemClock()
+
+
+class TimerHeap:
+    """One-shot timers by key in a binary heap, only the earliest deadline is ever looked at
+
+    Re-arming or cancelling a key leaves its old entry in the heap, skipped when it surfaces.
+    Not thread safe, schedule and run from the thread that owns the timers
+    """
+
+    def __init__(self) -> None:
+        self._heap: list[tuple[float, int, Hashable, Callable[[float], None]]] = []
+        self._entries: dict[Hashable, tuple[float, int, Hashable, Callable[[float], None]]] = {}
+        self._sequence = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def schedule(self, key: Hashable, deadline: float, callback: Callable[[float], None]):
+        """Call callback(deadline) once deadline passes, replacing the timer of key"""
+        self._sequence += 1
+        entry = (deadline, self._sequence, key, callback)
+        self._entries[key] = entry
+        heapq.heappush(self._heap, entry)
+        if len(self._heap) > 2 * len(self._entries) + 16:
+            # Mostly cancelled entries, rebuild from the live ones
+            self._heap = list(self._entries.values())
+            heapq.heapify(self._heap)
+
+    def cancel(self, key: Hashable):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._heap.clear()
+        self._entries.clear()
+
+    def next_deadline(self) -> float | None:
+        heap = self._heap
+        while heap and self._entries.get(heap[0][2]) is not heap[0]:
+            heapq.heappop(heap)
+        return heap[0][0] if heap else None
+
+    def run_expired(self, now: float) -> int:
+        """Call every timer due by now in deadline order, returns how many ran"""
+        ran = 0
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            entry = heapq.heappop(heap)
+            if self._entries.get(entry[2]) is not entry:
+                continue
+            del self._entries[entry[2]]
+            # The callback may schedule again, even for the same key
+            entry[3](entry[0])
+            ran += 1
+        return ran